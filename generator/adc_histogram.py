@@ -9,13 +9,19 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import sys
-import re
 import redis
 import numpy as np
-from hera_mc import mc, cm_sysutils
-from astropy.time import Time
+from hera_mc import mc
 from jinja2 import Environment, FileSystemLoader
 
+import antenna_index
+import eq_cache
+import mc_cache
+import mc_status
+import plotly_data
+import publish
+import time_utils
+
 
 def is_list(value):
     return isinstance(value, list)
@@ -24,17 +30,19 @@ def is_list(value):
 # Two redis instances run on this server.
 # port 6379 is the hera-digi mirror
 # port 6380 is the paper1 mirror
-def main():
-    # templates are stored relative to the script dir
-    # stored one level up, find the parent directory
-    # and split the parent directory away
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    split_dir = os.path.split(script_dir)
-    template_dir = os.path.join(split_dir[0], "templates")
-
-    env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
-    # this filter is used to see if there is more than one table
-    env.filters["islist"] = is_list
+@publish.batched
+def main(argv=None, db=None, redis_db=None, env=None):
+    if env is None:
+        # templates are stored relative to the script dir
+        # stored one level up, find the parent directory
+        # and split the parent directory away
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        split_dir = os.path.split(script_dir)
+        template_dir = os.path.join(split_dir[0], "templates")
+
+        env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
+        # this filter is used to see if there is more than one table
+        env.filters["islist"] = is_list
 
     if sys.version_info[0] < 3:
         # py2
@@ -54,128 +62,123 @@ def main():
     parser.add_argument(
         "--port", dest="port", type=int, default=6379, help="Redis port to connect."
     )
-    args = parser.parse_args()
-
-    try:
-        db = mc.connect_to_mc_db(args)
-    except RuntimeError as e:
-        raise SystemExit(str(e))
-
-    try:
-        redis_db = redis.Redis(args.redishost, port=args.port)
-        redis_db.keys()
-    except Exception as err:
-        raise SystemExit(str(err))
-
+    eq_cache.add_eq_cache_arguments(parser)
+    mc_cache.add_cache_arguments(parser)
+    plotly_data.add_webgl_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if db is None:
+        try:
+            db = mc.connect_to_mc_db(args)
+        except RuntimeError as e:
+            raise SystemExit(str(e))
+
+    if redis_db is None:
+        try:
+            redis_db = redis.Redis(args.redishost, port=args.port)
+            redis_db.ping()
+        except Exception as err:
+            raise SystemExit(str(err))
+
+    eq_medians = eq_cache.EqMedianCache(args.eq_cache_file)
     with db.sessionmaker() as session:
-        now = Time.now()
-
-        hsession = cm_sysutils.Handling(session)
-        stations = hsession.get_connected_stations(at_date="now")
-
-        ants = []
-        for station in stations:
-            if station.antenna_number not in ants:
-                ants = np.append(ants, station.antenna_number)
-        ants = np.unique(ants).astype(int)
-
-        antpos = np.genfromtxt(
-            os.path.join(mc.data_path, "HERA_350.txt"),
-            usecols=(0, 1, 2, 3),
-            dtype={
-                "names": ("ANTNAME", "EAST", "NORTH", "UP"),
-                "formats": ("<U5", "<f8", "<f8", "<f8"),
-            },
-            encoding=None,
+        # names and connected stations, cached between runs
+        index = antenna_index.load_antenna_index(session, cache_dir=args.cache_dir)
+        ants = index.connected_numbers.astype(int)
+        antnames = index.names
+
+        # latest status of every antpol and node of every station,
+        # with a fixed number of queries for the whole array
+        statuses = mc_status.get_latest_antenna_status(session, ants)
+        node_parts = mc_status.get_station_parts(
+            session, [antnames[int(ant)] for ant in ants], ["node"]
         )
-        antnames = antpos["ANTNAME"]
-        inds = [int(j[2:]) for j in antnames]
-        inds = np.argsort(inds)
-
-        antnames = np.take(antnames, inds)
 
         nodes = []
         hists = []
         bad_ants = []
         bad_node = []
-        for ant_cnt, ant in enumerate(ants):
-            ant_status = session.get_antenna_status(
-                most_recent=True, antenna_number=int(ant)
-            )
-            mc_name = antnames[int(ant)]
-            node_info = hsession.get_part_at_station_from_type(mc_name, "now", "node")
-            if len(ant_status) == 0:
+        reported_ants = set(stat.antenna_number for stat in statuses)
+        for ant in ants:
+            if ant not in reported_ants:
                 for pol in ["e", "n"]:
                     name = "{ant}:{pol}".format(ant=ant, pol=pol)
                     print("No histogram data for ", name)
                     bad_ants.append(name)
-            for stat in ant_status:
-                name = "ant{ant}{pol}".format(
-                    ant=stat.antenna_number, pol=stat.antenna_feed_pol
+
+        good_stats = []
+        good_nodes = []
+        for stat in statuses:
+            name = "{ant}:{pol}".format(
+                ant=stat.antenna_number, pol=stat.antenna_feed_pol
+            )
+
+            # try to find the associated node
+            node_info = node_parts.get(antnames[stat.antenna_number], {})
+            _node_num = mc_status.part_index(
+                mc_status.part_for_pol(
+                    node_info.get("node", {}), stat.antenna_feed_pol
+                ),
+                "N",
+            )
+            if _node_num == -1:
+                print("No Node mapping for antennna: " + name)
+                bad_node.append(name)
+            nodes.append(_node_num)
+
+            if stat.histogram_bin_centers is not None and stat.histogram is not None:
+                good_stats.append(stat)
+                good_nodes.append(_node_num)
+            else:
+                print("No histogram data for ", name)
+                bad_ants.append(name)
+
+        # parse every histogram at once into (n_antpol, n_bins) arrays
+        all_bins = mc_status.parse_list_strings(
+            [stat.histogram_bin_centers for stat in good_stats]
+        )
+        all_hists = mc_status.parse_list_strings(
+            [stat.histogram for stat in good_stats]
+        )
+        # None (no coefficients) becomes NaN, which leaves the row as is
+        eq_median = np.array(
+            [
+                eq_medians.median(
+                    "mc:eq:{:d}:{:s}".format(
+                        stat.antenna_number, stat.antenna_feed_pol
+                    ),
+                    stat.eq_coeffs,
                 )
+                for stat in good_stats
+            ],
+            dtype=np.float64,
+        )
+        eq_median[np.isnan(eq_median)] = 1.0
+        all_hists /= eq_median[:, np.newaxis] ** 2
+
+        timestamps = time_utils.gps_to_unix([stat.time for stat in good_stats])
+        timestamps_iso = time_utils.unix_to_iso(timestamps)
+        timestamps_jd = time_utils.unix_to_jd(timestamps)
+        for stat_cnt, stat in enumerate(good_stats):
+            name = "ant{ant}{pol}".format(
+                ant=stat.antenna_number, pol=stat.antenna_feed_pol
+            )
+            text = "observed at {iso}<br>(JD {jd})".format(
+                iso=timestamps_iso[stat_cnt], jd=timestamps_jd[stat_cnt]
+            )
+            # spaces cause weird wrapping issues, replace them all with \t
+            text = text.replace(" ", "\t")
+            _data = {
+                "x": plotly_data.encode_array(all_bins[stat_cnt]),
+                "y": plotly_data.encode_array(all_hists[stat_cnt]),
+                "name": name,
+                "node": good_nodes[stat_cnt],
+                # a single string is shown for every point
+                "text": text,
+                "hovertemplate": "(%{x:.1},\t%{y})<br>%{text}",
+            }
+            hists.append(_data)
 
-                # try to find the associated node
-                # get the first key in the dict to index easier
-                _key = list(node_info.keys())[0]
-                pol_key = [
-                    key
-                    for key in node_info[_key].keys()
-                    if stat.antenna_feed_pol.upper() in key
-                ]
-                if pol_key:
-                    # 'E' should be in one of the keys, extract the 0th entry
-                    pol_key = pol_key[0]
-                else:
-                    # a hacky solution for a key that should work
-                    pol_key = "E<ground"
-
-                if node_info[_key][pol_key] is not None:
-                    _node_num = re.findall(r"N(\d+)", node_info[_key][pol_key])[0]
-                else:
-                    print("No Node mapping for antennna: " + name)
-                    _node_num = -1
-                    bad_node.append(
-                        "{ant}:{pol}".format(
-                            ant=stat.antenna_number, pol=stat.antenna_feed_pol
-                        )
-                    )
-                nodes.append(_node_num)
-
-                timestamp = Time(stat.time, format="gps")
-                if (
-                    stat.histogram_bin_centers is not None
-                    and stat.histogram is not None
-                ):
-                    bins = np.fromstring(
-                        stat.histogram_bin_centers.strip("[]"), sep=","
-                    )
-                    hist = np.fromstring(stat.histogram.strip("[]"), sep=",")
-                    if stat.eq_coeffs is not None:
-                        eq_coeffs = np.fromstring(stat.eq_coeffs.strip("[]"), sep=",")
-                    else:
-                        eq_coeffs = np.ones_like(hist)
-                    hist /= np.median(eq_coeffs) ** 2
-
-                    text = "observed at {iso}<br>(JD {jd})".format(
-                        iso=timestamp.iso, jd=timestamp.jd
-                    )
-                    # spaces cause weird wrapping issues, replace them all with \t
-                    text = text.replace(" ", "\t")
-                    _data = {
-                        "x": bins.tolist(),
-                        "y": hist.tolist(),
-                        "name": name,
-                        "node": _node_num,
-                        "text": [text] * bins.size,
-                        "hovertemplate": "(%{x:.1},\t%{y})<br>%{text}",
-                    }
-                    hists.append(_data)
-                else:
-                    name = "{ant}:{pol}".format(
-                        ant=stat.antenna_number, pol=stat.antenna_feed_pol
-                    )
-                    print("No histogram data for ", name)
-                    bad_ants.append(name)
         table = {}
         table["title"] = "Ants with no Histogram"
         table["rows"] = []
@@ -206,6 +209,12 @@ def main():
             "autosize": True,
             "showlegend": True,
         }
+        plotly_data.use_webgl(
+            hists,
+            layout,
+            max_traces=args.webgl_traces,
+            max_points=args.webgl_points,
+        )
 
         # Make all the buttons for this plot
         nodes = np.unique(nodes)
@@ -306,10 +315,8 @@ def main():
         rendered_html = html_template.render(
             plotname=plotname,
             plotstyle="height: 100%",
-            gen_date=now.iso,
             js_name="adchist",
             caption=caption,
-            gen_time_unix_ms=now.unix * 1000,
             scriptname=os.path.basename(__file__),
             hostname=computer_hostname,
             table=[table, table_node],
@@ -318,11 +325,14 @@ def main():
         rendered_js = js_template.render(
             data=hists, layout=layout, plotname=plotname, updatemenus=updatemenus
         )
-        with open("adchist.html", "w") as h_file:
+        with publish.publish("adchist.html") as h_file:
             h_file.write(rendered_html)
-        with open("adchist.js", "w") as js_file:
+        with publish.publish("adchist.js") as js_file:
             js_file.write(rendered_js)
 
+    eq_medians.save()
+    print(eq_medians.report())
+
 
 if __name__ == "__main__":
     main()
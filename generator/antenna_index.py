@@ -0,0 +1,282 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""Cached antenna geometry and station lists shared by the generators.
+
+Several pages need the antenna names and centered positions from
+``HERA_350.txt`` along with the constructed and connected stations known to
+M&C. Parsing the text file and walking the hookup on every run is slow, so
+the result is stored as one structured ``.npy`` array, sorted by antenna
+number, next to a small json file recording what it was built from::
+
+    <cache_dir>/antenna_index.npy   name, number, east, north, up,
+                                    constructed and connected per antenna
+    <cache_dir>/antenna_index.json  source file, mtime and M&C state
+
+The array is rebuilt when the source file changes, when stations or
+connections are added to M&C, or when a connection starts or stops;
+otherwise it is memory-mapped in a single read.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import fcntl
+import tempfile
+import numpy as np
+from sqlalchemy import func
+from hera_mc import mc, cm_sysutils
+from hera_mc.cm_partconnect import Connections
+from hera_mc.geo_location import GeoLocation
+
+import mc_cache
+import time_utils
+
+INDEX_FILE = "antenna_index.npy"
+META_FILE = "antenna_index.json"
+LOCK_FILE = "antenna_index.lock"
+INDEX_DTYPE = np.dtype(
+    [
+        ("name", "U8"),
+        ("number", np.int64),
+        ("east", np.float64),
+        ("north", np.float64),
+        ("up", np.float64),
+        ("constructed", np.bool_),
+        ("connected", np.bool_),
+    ]
+)
+
+
+def default_source():
+    """Get the path of the antenna position file shipped with hera_mc."""
+    return os.path.join(mc.data_path, "HERA_350.txt")
+
+
+def get_mc_state(session):
+    """Summarize the M&C geo and hookup tables to detect changes.
+
+    Parameters
+    ----------
+    session : MCSession
+        Session used to query the database.
+
+    Returns
+    -------
+    state : list
+        Row counts and latest change times of the station and connection
+        tables, equal between runs unless a station or connection was added.
+    valid_until : float or None
+        GPS seconds of the next connection start or stop, after which the
+        connected stations change. None if none is scheduled.
+
+    """
+    now = int(time_utils.now_gps())
+    geo = session.query(
+        func.count(GeoLocation.station_name), func.max(GeoLocation.created_gpstime)
+    ).one()
+    conn = session.query(
+        func.count(Connections.start_gpstime),
+        func.max(Connections.start_gpstime),
+        func.max(Connections.stop_gpstime),
+    ).one()
+    next_start = (
+        session.query(func.min(Connections.start_gpstime))
+        .filter(Connections.start_gpstime > now)
+        .scalar()
+    )
+    next_stop = (
+        session.query(func.min(Connections.stop_gpstime))
+        .filter(Connections.stop_gpstime > now)
+        .scalar()
+    )
+
+    state = [None if val is None else float(val) for val in list(geo) + list(conn)]
+    changes = [float(val) for val in [next_start, next_stop] if val is not None]
+    return state, min(changes) if changes else None
+
+
+def build_index(session, source=None):
+    """Build the antenna index from the position file and M&C.
+
+    Parameters
+    ----------
+    session : MCSession
+        Session used to query the database.
+    source : str, optional
+        Antenna position file, defaults to hera_mc's HERA_350.txt.
+
+    Returns
+    -------
+    ndarray
+        Structured array with `INDEX_DTYPE`, sorted by antenna number.
+        Positions are east, north and up in meters from the array center.
+
+    """
+    if source is None:
+        source = default_source()
+    antpos = np.genfromtxt(
+        source,
+        usecols=(0, 1, 2, 3),
+        dtype={
+            "names": ("ANTNAME", "EAST", "NORTH", "UP"),
+            "formats": ("<U5", "<f8", "<f8", "<f8"),
+        },
+        encoding=None,
+    )
+    numbers = np.array([int(name[2:]) for name in antpos["ANTNAME"]])
+    order = np.argsort(numbers)
+
+    table = np.zeros(numbers.size, dtype=INDEX_DTYPE)
+    table["name"] = antpos["ANTNAME"][order]
+    table["number"] = numbers[order]
+    for key in ["east", "north", "up"]:
+        column = antpos[key.upper()]
+        table[key] = (column - column.mean())[order]
+
+    hsession = cm_sysutils.Handling(session)
+    constructed = []
+    for station_type in hsession.geo.parse_station_types_to_check("default"):
+        constructed += hsession.geo.station_types[station_type]["Stations"]
+    # station names are HH??? numbers we just want the ints
+    constructed = [int(name[2:]) for name in constructed]
+    connected = [
+        station.antenna_number
+        for station in hsession.get_connected_stations(at_date="now")
+    ]
+    table["constructed"] = np.isin(table["number"], constructed)
+    table["connected"] = np.isin(table["number"], connected)
+    return table
+
+
+class AntennaIndex(object):
+    """Antenna names, positions and station states sorted by antenna number.
+
+    Use `load_antenna_index` to get one.
+
+    Parameters
+    ----------
+    table : ndarray
+        Structured array with `INDEX_DTYPE`, sorted by antenna number.
+
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self._numbers_by_name = None
+
+    def __len__(self):
+        return self.table.shape[0]
+
+    @property
+    def names(self):
+        """Station names, e.g. "HH12"."""
+        return self.table["name"]
+
+    @property
+    def numbers(self):
+        """Antenna numbers."""
+        return self.table["number"]
+
+    @property
+    def positions(self):
+        """Array of shape (3, n_ant) of east, north and up offsets in meters."""
+        return np.array([self.table["east"], self.table["north"], self.table["up"]])
+
+    @property
+    def constructed_numbers(self):
+        """Numbers of the antennas at constructed stations."""
+        return self.numbers[self.table["constructed"]]
+
+    @property
+    def connected_numbers(self):
+        """Numbers of the antennas connected to the signal chain now."""
+        return self.numbers[self.table["connected"]]
+
+    def index_of(self, numbers):
+        """Get the rows of antenna numbers, -1 for unknown antennas."""
+        numbers = np.asarray(numbers)
+        index = np.searchsorted(self.numbers, numbers)
+        index = np.clip(index, 0, len(self) - 1)
+        return np.where(self.numbers[index] == numbers, index, -1)
+
+    def name_of(self, number):
+        """Get the station name of an antenna number."""
+        index = self.index_of(number)
+        if index < 0:
+            raise KeyError("Unknown antenna number {}".format(number))
+        return self.names[index]
+
+    def number_of(self, name):
+        """Get the antenna number of a station name."""
+        if self._numbers_by_name is None:
+            self._numbers_by_name = dict(
+                zip(self.names.tolist(), self.numbers.tolist())
+            )
+        return self._numbers_by_name[name]
+
+
+def load_antenna_index(session, cache_dir=mc_cache.DEFAULT_CACHE_DIR, source=None):
+    """Load the antenna index from the cache, rebuilding it if it is stale.
+
+    Parameters
+    ----------
+    session : MCSession
+        Session used to query the database.
+    cache_dir : str or None
+        Directory holding the cache files. If None the index is built
+        without being cached.
+    source : str, optional
+        Antenna position file, defaults to hera_mc's HERA_350.txt.
+
+    Returns
+    -------
+    AntennaIndex
+        The antenna index.
+
+    """
+    if source is None:
+        source = default_source()
+    if cache_dir is None:
+        return AntennaIndex(build_index(session, source))
+
+    index_file = os.path.join(cache_dir, INDEX_FILE)
+    meta_file = os.path.join(cache_dir, META_FILE)
+    state, valid_until = get_mc_state(session)
+    meta = {
+        "source": os.path.abspath(source),
+        "source_mtime": os.path.getmtime(source),
+        "mc_state": state,
+    }
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # the generators sharing the cache run at the same time, only one of
+    # them rebuilds it while the others wait for the result
+    with open(os.path.join(cache_dir, LOCK_FILE), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with open(meta_file, "r") as infile:
+                cached_meta = json.load(infile)
+            cached_valid_until = cached_meta.pop("valid_until", None)
+            if cached_meta == meta and (
+                cached_valid_until is None or time_utils.now_gps() < cached_valid_until
+            ):
+                return AntennaIndex(np.load(index_file, mmap_mode="r"))
+        except (IOError, OSError, ValueError):
+            pass
+
+        table = build_index(session, source)
+        # write then rename so a killed run never leaves a truncated cache
+        fd, tmp_name = tempfile.mkstemp(dir=cache_dir, suffix=".npy")
+        with os.fdopen(fd, "wb") as outfile:
+            np.save(outfile, table)
+        os.rename(tmp_name, index_file)
+        meta["valid_until"] = valid_until
+        fd, tmp_name = tempfile.mkstemp(dir=cache_dir, suffix=".json")
+        with os.fdopen(fd, "w") as outfile:
+            json.dump(meta, outfile)
+        os.rename(tmp_name, meta_file)
+    return AntennaIndex(table)
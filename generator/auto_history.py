@@ -0,0 +1,273 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""On-disk ring buffer of the processed autocorrelations.
+
+Every cycle `autospectra` can append its equalized dB spectra to a fixed
+number of time slots stored in memory-mapped ``.npy`` files::
+
+    <directory>/index.json   antpols, number of slots and the next slot
+    <directory>/freqs.npy    (n_chan,) frequencies in MHz
+    <directory>/times.npy    (n_slot,) JD of each slot, NaN if never written
+    <directory>/spectra.npy  (n_antpol, n_slot, n_chan) float32 dB spectra
+
+Once every slot is used the oldest one is overwritten. The spectra are
+stored antpol-major so the full history of one antpol is a single
+contiguous block, and reading a waterfall only slices the memory maps.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+
+DEFAULT_HISTORY_DIR = "auto_history"
+INDEX_FILE = "index.json"
+FREQS_FILE = "freqs.npy"
+TIMES_FILE = "times.npy"
+SPECTRA_FILE = "spectra.npy"
+
+
+def add_history_arguments(parser):
+    """Add the options controlling the history ring buffer to a parser."""
+    parser.add_argument(
+        "--history-dir",
+        dest="history_dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory of the autocorrelation history ring buffer. "
+            "Nothing is recorded unless this is given."
+        ),
+    )
+    parser.add_argument(
+        "--history-hours",
+        dest="history_hours",
+        type=float,
+        default=12.0,
+        help="Hours of autocorrelations to keep in the history, defaults to 12.",
+    )
+    parser.add_argument(
+        "--history-cadence",
+        dest="history_cadence",
+        type=float,
+        default=600.0,
+        help=(
+            "Expected seconds between appended spectra, used to size the "
+            "history. Defaults to 600."
+        ),
+    )
+
+
+def history_slots(hours, cadence):
+    """Get the number of slots needed to keep `hours` at a `cadence` in seconds."""
+    return max(1, int(np.ceil(hours * 3600.0 / cadence)))
+
+
+def _write_index(directory, antpols, nslots, next_slot):
+    # write then rename so readers never see a partial index
+    filename = os.path.join(directory, INDEX_FILE)
+    with open(filename + ".tmp", "w") as index_file:
+        json.dump(
+            {
+                "antpols": [[int(ant), str(pol)] for ant, pol in antpols],
+                "nslots": nslots,
+                "next_slot": next_slot,
+            },
+            index_file,
+        )
+    os.rename(filename + ".tmp", filename)
+
+
+class AutoHistory(object):
+    """Ring buffer of dB autocorrelation spectra.
+
+    Use `create` or `open_or_create` to make a new buffer.
+
+    Parameters
+    ----------
+    directory : str
+        Directory holding the buffer files.
+    mode : str
+        "r" to only read the buffer, "r+" to also append to it.
+
+    """
+
+    def __init__(self, directory, mode="r"):
+        self.directory = directory
+        self.mode = mode
+        with open(os.path.join(directory, INDEX_FILE), "r") as index_file:
+            index = json.load(index_file)
+        self.antpols = [(int(ant), str(pol)) for ant, pol in index["antpols"]]
+        self.next_slot = index["next_slot"]
+        self._rows = {antpol: row for row, antpol in enumerate(self.antpols)}
+
+        self.freqs = np.load(os.path.join(directory, FREQS_FILE), mmap_mode="r")
+        self.times = np.load(os.path.join(directory, TIMES_FILE), mmap_mode=mode)
+        self.spectra = np.load(os.path.join(directory, SPECTRA_FILE), mmap_mode=mode)
+
+    @property
+    def nslots(self):
+        return self.times.shape[0]
+
+    @property
+    def nchans(self):
+        return self.freqs.shape[0]
+
+    @classmethod
+    def create(cls, directory, antpols, freqs, nslots):
+        """Create an empty buffer, replacing any existing one.
+
+        Parameters
+        ----------
+        directory : str
+            Directory to hold the buffer files, created if needed.
+        antpols : list of tuple
+            The (ant, pol) of every antpol to record.
+        freqs : array_like
+            Frequency of each channel in MHz.
+        nslots : int
+            Number of time slots kept before the oldest is overwritten.
+
+        Returns
+        -------
+        AutoHistory
+            The new buffer, opened for appending.
+
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        freqs = np.asarray(freqs, dtype=np.float64)
+        np.save(os.path.join(directory, FREQS_FILE), freqs)
+
+        times = open_memmap(
+            os.path.join(directory, TIMES_FILE),
+            mode="w+",
+            dtype=np.float64,
+            shape=(nslots,),
+        )
+        times[:] = np.nan
+        times.flush()
+        spectra = open_memmap(
+            os.path.join(directory, SPECTRA_FILE),
+            mode="w+",
+            dtype=np.float32,
+            shape=(len(antpols), nslots, freqs.size),
+        )
+        spectra[:] = np.nan
+        spectra.flush()
+        del times, spectra
+
+        _write_index(directory, antpols, nslots, 0)
+        return cls(directory, mode="r+")
+
+    @classmethod
+    def open_or_create(cls, directory, antpols, freqs, nslots):
+        """Open an existing buffer for appending, creating one if needed.
+
+        The buffer is recreated (dropping its history) if it does not match
+        the requested number of slots or channels, or does not have room for
+        every requested antpol.
+
+        Parameters
+        ----------
+        See `create`.
+
+        Returns
+        -------
+        AutoHistory
+            The buffer, opened for appending.
+
+        """
+        if os.path.exists(os.path.join(directory, INDEX_FILE)):
+            history = cls(directory, mode="r+")
+            if (
+                history.nslots == nslots
+                and history.nchans == len(freqs)
+                and set(antpols).issubset(history._rows)
+            ):
+                return history
+            del history
+            print("Autocorrelation history layout changed, starting a new one.")
+        return cls.create(directory, antpols, freqs, nslots)
+
+    def append(self, timestamp, antpols, spectra):
+        """Write spectra into the next slot, overwriting the oldest one.
+
+        Parameters
+        ----------
+        timestamp : float
+            JD of the spectra. Nothing is written if it matches the last
+            appended timestamp.
+        antpols : list of tuple
+            The (ant, pol) of each row of `spectra`. Antpols the buffer was
+            not created with are ignored, recorded antpols missing here are
+            stored as NaN.
+        spectra : ndarray
+            Array of shape (len(antpols), n_chan) of dB spectra.
+
+        """
+        last_slot = (self.next_slot - 1) % self.nslots
+        if self.times[last_slot] == timestamp:
+            return
+
+        slot = self.next_slot
+        in_rows, out_rows = [], []
+        for in_row, antpol in enumerate(antpols):
+            if antpol in self._rows:
+                in_rows.append(in_row)
+                out_rows.append(self._rows[antpol])
+
+        self.spectra[:, slot, :] = np.nan
+        self.spectra[out_rows, slot, :] = spectra[in_rows, : self.nchans]
+        self.spectra.flush()
+        self.times[slot] = timestamp
+        self.times.flush()
+
+        self.next_slot = (slot + 1) % self.nslots
+        _write_index(self.directory, self.antpols, self.nslots, self.next_slot)
+
+    def _chronological_slices(self):
+        if np.isnan(self.times[self.next_slot]):
+            # the buffer has not wrapped around yet
+            slices = [slice(0, self.next_slot)]
+        else:
+            slices = [slice(self.next_slot, self.nslots), slice(0, self.next_slot)]
+        return [slc for slc in slices if slc.stop > slc.start]
+
+    def timeline(self):
+        """Get the times of the recorded spectra in JD, oldest first.
+
+        These are the times of the segments returned by `waterfall`,
+        concatenated, the same for every antpol.
+        """
+        slices = self._chronological_slices()
+        if not slices:
+            return np.zeros(0, dtype=self.times.dtype)
+        return np.concatenate([self.times[slc] for slc in slices])
+
+    def waterfall(self, antpol):
+        """Get the recorded history of one antpol, oldest first.
+
+        The returned arrays are views of the memory maps, nothing is copied.
+
+        Parameters
+        ----------
+        antpol : tuple
+            The (ant, pol) to read.
+
+        Returns
+        -------
+        list of tuple
+            One or two (times, spectra) segments in chronological order,
+            with times of shape (n_time,) in JD and spectra of shape
+            (n_time, n_chan) in dB. Empty if the antpol is not recorded.
+
+        """
+        if antpol not in self._rows:
+            return []
+        row = self.spectra[self._rows[antpol]]
+        return [(self.times[slc], row[slc]) for slc in self._chronological_slices()]
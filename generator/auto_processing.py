@@ -0,0 +1,180 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""Vectorized processing of the correlator autocorrelations.
+
+All autos are stacked into a single ``(n_antpol, n_chan)`` float32 array so
+the equalization, clipping, dB conversion and per-antpol statistics each
+run as one numpy pass instead of once per antpol.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+# autos are clipped to this value before taking the log
+POWER_FLOOR = 10 ** -10.0
+
+
+def stack_autos(autos, antpols=None, nchans=None):
+    """Stack autocorrelations into a single 2-D array.
+
+    Parameters
+    ----------
+    autos : dict
+        Dictionary keyed by (ant, pol) of 1-D autocorrelation arrays,
+        e.g. the output of `redis_autos.get_autos`.
+    antpols : list of tuple, optional
+        Order of the rows in the output. Antpols missing from `autos` are
+        skipped. Defaults to the sorted keys of `autos`.
+    nchans : int, optional
+        Number of channels to keep. Defaults to the size of the first auto.
+        Longer autos are truncated, shorter ones are padded with NaN.
+
+    Returns
+    -------
+    antpols : list of tuple
+        The (ant, pol) of each row.
+    spectra : ndarray of float32
+        Array of shape (n_antpol, nchans), a copy of the input data.
+
+    """
+    if antpols is None:
+        antpols = sorted(autos)
+    antpols = [antpol for antpol in antpols if antpol in autos]
+    if nchans is None:
+        nchans = autos[antpols[0]].size if antpols else 0
+
+    spectra = np.full((len(antpols), nchans), np.nan, dtype=np.float32)
+    for ind, antpol in enumerate(antpols):
+        auto = autos[antpol][:nchans]
+        spectra[ind, : auto.size] = auto
+
+    return antpols, spectra
+
+
+def get_eq_medians(eq_coeffs, antpols):
+    """Get the median equalization coefficient for each antpol.
+
+    eq_coeffs are stored as a length 1024 array but only a single number is
+    used. Taking the median to not deal with a size mismatch.
+
+    Parameters
+    ----------
+    eq_coeffs : dict
+        Dictionary keyed by (ant, pol) of coefficient arrays (or already
+        reduced scalars).
+    antpols : list of tuple
+        The (ant, pol) of each row of the spectra.
+
+    Returns
+    -------
+    ndarray of float
+        Median coefficient per antpol, 1 where no coefficients are known.
+
+    """
+    return np.array(
+        [
+            np.median(eq_coeffs[antpol]) if antpol in eq_coeffs else 1.0
+            for antpol in antpols
+        ],
+        dtype=np.float64,
+    )
+
+
+def equalize(spectra, eq_medians):
+    """Divide the equalization out of the spectra in place.
+
+    Parameters
+    ----------
+    spectra : ndarray
+        Array of shape (n_antpol, n_chan).
+    eq_medians : ndarray
+        Median coefficient per antpol, shape (n_antpol,).
+
+    Returns
+    -------
+    ndarray
+        The input spectra, modified in place.
+
+    """
+    spectra /= (eq_medians ** 2).astype(spectra.dtype)[:, np.newaxis]
+    return spectra
+
+
+def clip(spectra, floor=POWER_FLOOR):
+    """Clip the spectra to a minimum power in place."""
+    np.maximum(spectra, floor, out=spectra)
+    return spectra
+
+
+def to_db(spectra, floor=POWER_FLOOR):
+    """Clip the spectra and convert to dB in place."""
+    clip(spectra, floor=floor)
+    np.log10(spectra, out=spectra)
+    spectra *= 10
+    return spectra
+
+
+def antpol_stats(spectra, percentiles=(5, 95)):
+    """Compute statistics along the frequency axis for every antpol.
+
+    NaN padded channels are ignored.
+
+    Parameters
+    ----------
+    spectra : ndarray
+        Array of shape (n_antpol, n_chan).
+    percentiles : tuple of float
+        Percentiles to compute in addition to the median and mean.
+
+    Returns
+    -------
+    dict
+        Dictionary of arrays of shape (n_antpol,) with keys "median", "mean"
+        and "p<percentile>" for each requested percentile.
+
+    """
+    stats = {}
+    if spectra.shape[0] == 0:
+        stats["median"] = stats["mean"] = np.zeros(0, dtype=spectra.dtype)
+        for pct in percentiles:
+            stats["p{:g}".format(pct)] = np.zeros(0, dtype=spectra.dtype)
+        return stats
+
+    stats["median"] = np.nanmedian(spectra, axis=1)
+    stats["mean"] = np.nanmean(spectra, axis=1)
+    if percentiles:
+        pcts = np.nanpercentile(spectra, percentiles, axis=1)
+        for pct, vals in zip(percentiles, pcts):
+            stats["p{:g}".format(pct)] = vals
+    return stats
+
+
+def process_autos(autos, eq_coeffs, antpols=None, nchans=None):
+    """Stack, equalize, clip and convert the autos to dB.
+
+    Parameters
+    ----------
+    autos : dict
+        Dictionary keyed by (ant, pol) of 1-D autocorrelation arrays.
+    eq_coeffs : dict
+        Dictionary keyed by (ant, pol) of equalization coefficients.
+    antpols : list of tuple, optional
+        Order of the output rows, see `stack_autos`.
+    nchans : int, optional
+        Number of channels to keep, see `stack_autos`.
+
+    Returns
+    -------
+    antpols : list of tuple
+        The (ant, pol) of each row.
+    spectra : ndarray of float32
+        Equalized spectra in dB of shape (n_antpol, nchans).
+
+    """
+    antpols, spectra = stack_autos(autos, antpols=antpols, nchans=nchans)
+    equalize(spectra, get_eq_medians(eq_coeffs, antpols))
+    to_db(spectra)
+    return antpols, spectra
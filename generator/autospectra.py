@@ -12,6 +12,7 @@ Adapted from https://github.com/HERA-Team/hera_corr_cm/blob/master/hera_today/re
 from __future__ import absolute_import, division, print_function
 
 import os
+import io
 import sys
 import re
 import redis
@@ -21,24 +22,42 @@ import argparse
 from astropy.time import Time
 from jinja2 import Environment, FileSystemLoader
 
+import auto_history
+import auto_processing
+import eq_cache
+import plotly_data
+import plotly_json
+import publish
+import redis_autos
+import run_state
+
 
 def is_list(value):
     return isinstance(value, list)
 
 
+def publish_shard(filename, payload):
+    """Publish one data shard of the page, returning its versioned url."""
+    content = io.StringIO()
+    plotly_json.write_json(payload, content)
+    return publish.publish_hashed(filename, content.getvalue())
+
+
 # Two redis instances run on this server.
 # port 6379 is the hera-digi mirror
 # port 6380 is the paper1 mirror
-def main():
-    # templates are stored relative to the script dir
-    # stored one level up, find the parent directory
-    # and split the parent directory away
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    split_dir = os.path.split(script_dir)
-    template_dir = os.path.join(split_dir[0], "templates")
-
-    env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
-    env.filters["islist"] = is_list
+@publish.batched
+def main(argv=None, redis_db=None, env=None):
+    if env is None:
+        # templates are stored relative to the script dir
+        # stored one level up, find the parent directory
+        # and split the parent directory away
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        split_dir = os.path.split(script_dir)
+        template_dir = os.path.join(split_dir[0], "templates")
+
+        env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
+        env.filters["islist"] = is_list
 
     if sys.version_info[0] < 3:
         # py2
@@ -60,35 +79,46 @@ def main():
     parser.add_argument(
         "--port", dest="port", type=int, default=6379, help="Redis port to connect."
     )
-    args = parser.parse_args()
-    r = redis.Redis(args.redishost, port=args.port)
-
-    keys = [
-        k.decode()
-        for k in r.keys()
-        if k.startswith(b"auto") and not k.endswith(b"timestamp")
-    ]
-
-    ants = []
-    for key in keys:
-        match = re.search(r"auto:(?P<ant>\d+)(?P<pol>e|n)", key)
-        if match is not None:
-            ant, pol = int(match.group("ant")), match.group("pol")
-            ants.append(ant)
-
-    ants = np.unique(ants)
+    parser.add_argument(
+        "--decimate",
+        dest="decimate",
+        type=int,
+        default=None,
+        help=(
+            "Reduce each spectrum to a min/max envelope of about this many points. "
+            "The full resolution spectra are written to spectra_full_<node>.json "
+            "and loaded when the plot is zoomed."
+        ),
+    )
+    run_state.add_run_state_arguments(parser)
+    eq_cache.add_eq_cache_arguments(parser)
+    auto_history.add_history_arguments(parser)
+    plotly_data.add_webgl_arguments(parser)
+    args = parser.parse_args(argv)
+    if redis_db is None:
+        redis_db = redis.Redis(args.redishost, port=args.port)
+    r = redis_db
+
+    inputs = run_state.get_correlator_inputs(r)
+    if not args.force and run_state.inputs_unchanged(
+        "autospectra", inputs, filename=args.state_file
+    ):
+        print("No new correlator data since the last run, skipping autospectra.")
+        return
+
+    antpols = redis_autos.get_auto_antpols(r)
+    ants = np.unique([ant for (ant, pol) in antpols])
     corr_map = r.hgetall(b"corr:map")
     ant_to_snap = json.loads(corr_map[b"ant_to_snap"])
     node_map = {}
     nodes = []
+    # grab every auto and eq coefficient in a few pipelined round trips
+    all_autos = redis_autos.get_autos(r, antpols)
+    eq_medians = eq_cache.EqMedianCache(args.eq_cache_file)
+    all_eq_coeffs = eq_cache.get_eq_medians(r, all_autos.keys(), eq_medians)
     # want to be smart against the length of the autos, they sometimes change
     # depending on the mode of the array
-    for i in ants:
-        for pol in ["e", "n"]:
-            d = r.get("auto:{ant:d}{pol:s}".format(ant=i, pol=pol))
-            if d is not None:
-                auto = np.frombuffer(d, dtype=np.float32).copy()
-                break
+    auto = next(iter(all_autos.values()))
     auto_size = auto.size
     # Generate frequency axis
     # Some times we have 6144 length inputs, others 1536, this should
@@ -102,18 +132,36 @@ def main():
     frange = frange.reshape(NCHANS, NCHAN_SUM).sum(axis=1) / NCHAN_SUM
     frange_mhz = frange / 1e6
 
-    got_time = False
+    # equalize and convert every auto to dB in one vectorized pass
+    spectra_antpols, spectra = auto_processing.process_autos(
+        all_autos, all_eq_coeffs, antpols=antpols, nchans=NCHANS
+    )
+    spectra_index = {antpol: ind for ind, antpol in enumerate(spectra_antpols)}
+
+    if args.history_dir is not None and inputs["auto_timestamp"] is not None:
+        history = auto_history.AutoHistory.open_or_create(
+            args.history_dir,
+            spectra_antpols,
+            frange_mhz,
+            auto_history.history_slots(args.history_hours, args.history_cadence),
+        )
+        history.append(inputs["auto_timestamp"], spectra_antpols, spectra)
+
+    if args.decimate:
+        plot_freqs, plot_spectra = plotly_data.minmax_decimate(
+            frange_mhz, spectra, args.decimate
+        )
+    else:
+        plot_freqs, plot_spectra = frange_mhz, spectra
+
     n_signals = 0
 
-    try:
-        t_plot_jd = np.frombuffer(r["auto:timestamp"], dtype=np.float64)[0]
-        t_plot = Time(t_plot_jd, format="jd")
-        t_plot.out_subfmt = u"date_hm"
-        got_time = True
-    except:
-        pass
+    # read along with the skip check, fall back to the visdata time if missing
+    t_plot_jd = inputs["auto_timestamp"]
+    got_time = t_plot_jd is not None
     # grab data from redis and format it according to plotly's javascript api
     autospectra = []
+    full_spectra = []
 
     table_ants = {}
     table_ants["title"] = "Antennas with no Node mapping"
@@ -153,43 +201,32 @@ def main():
                 node_map[linename] = -1
                 nodes.append(-1)
 
-            d = r.get("auto:{ant:d}{pol:s}".format(ant=i, pol=pol))
-            if d is not None:
+            if (i, pol) in spectra_index:
 
                 n_signals += 1
-                auto = np.frombuffer(d, dtype=np.float32)[0:NCHANS].copy()
-
-                eq_coeffs = r.hget(
-                    bytes("eq:ant:{ant}:{pol}".format(ant=i, pol=pol).encode()),
-                    "values",
-                )
-                if eq_coeffs is not None:
-                    eq_coeffs = np.fromstring(
-                        eq_coeffs.decode("utf-8").strip("[]"), sep=","
-                    )
-                    if eq_coeffs.size == 0:
-                        eq_coeffs = np.ones_like(auto)
-                else:
-                    eq_coeffs = np.ones_like(auto)
-
-                # divide out the equalization coefficients
-                # eq_coeffs are stored as a length 1024 array but only a
-                # single number is used. Taking the median to not deal with
-                # a size mismatch
-                eq_coeffs = np.median(eq_coeffs)
-                auto /= eq_coeffs ** 2
-
-                auto[auto < 10 ** -10.0] = 10 ** -10.0
-                auto = 10 * np.log10(auto)
+                auto = plot_spectra[spectra_index[(i, pol)]]
                 _auto = {
-                    "x": frange_mhz.tolist(),
-                    "y": auto.tolist(),
+                    "x": plotly_data.shared_ref("freqs"),
+                    "y": plotly_data.encode_array(auto),
                     "name": linename,
                     "node": node_map[linename],
                     "type": "scatter",
                     "hovertemplate": "%{x:.1f}\tMHz<br>%{y:.3f}\t[dB]",
                 }
                 autospectra.append(_auto)
+                if args.decimate:
+                    full_spectra.append(
+                        {
+                            "x": plotly_data.shared_ref("freqs"),
+                            "y": plotly_data.encode_array(
+                                spectra[spectra_index[(i, pol)]]
+                            ),
+                        }
+                    )
+
+    t_plot = Time(t_plot_jd, format="jd")
+    t_plot.format = "iso"
+    t_plot.out_subfmt = u"date_hm"
 
     row = {}
     row["text"] = "\t".join(bad_ants)
@@ -201,41 +238,15 @@ def main():
     # this makes making buttons easier so the unmapped show last
     if -1 in nodes:
         nodes = np.roll(nodes, -1)
-    # create a mask to find all the matching nodes
-    node_mask = [
-        [True if s["node"] == node else False for s in autospectra] for node in nodes
-    ]
-    buttons = []
-    _button = {
-        "args": [
-            {"visible": [True for s in autospectra]},
-            {
-                "title": "",
-                # "annotations": {}
-            },
-        ],
-        "label": "All\tAnts",
-        "method": "restyle",
-    }
-    buttons.append(_button)
-    for node_cnt, node in enumerate(nodes):
+    # the page downloads the traces of the selected node only, the buttons
+    # just report the selection
+    buttons = [{"args": [], "label": "All\tAnts", "method": "skip"}]
+    for node in nodes:
         if node != -1:
             label = "Node\t{}".format(node)
         else:
             label = "Unmapped\tAnts"
-
-        _button = {
-            "args": [
-                {"visible": node_mask[node_cnt]},
-                {
-                    "title": "",
-                    # "annotations": {}
-                },
-            ],
-            "label": label,
-            "method": "update",
-        }
-        buttons.append(_button)
+        buttons.append({"args": [], "label": label, "method": "skip"})
 
     updatemenus = [
         {
@@ -265,6 +276,14 @@ def main():
         "margin": {"l": 40, "b": 30, "r": 40, "t": 46},
         "hovermode": "closest",
     }
+    shared = {"freqs": plotly_data.encode_array(plot_freqs)}
+    plotly_data.use_webgl(
+        autospectra,
+        layout,
+        shared=shared,
+        max_traces=args.webgl_traces,
+        max_points=args.webgl_points,
+    )
     plotname = "plotly-autos"
 
     caption = {}
@@ -297,27 +316,70 @@ def main():
         data_type="Auto correlations",
         plotstyle="height: 100%",
         div_height="height: 73%",
-        gen_date=Time.now().iso,
         data_date_iso=t_plot.iso,
         data_date_jd="{:.3f}".format(time_jd),
         data_date_unix_ms=time_unix * 1000,
         js_name="spectra",
-        gen_time_unix_ms=Time.now().unix * 1000,
         scriptname=os.path.basename(__file__),
         hostname=computer_hostname,
         table=table_ants,
         caption=caption,
     )
 
-    rendered_js = js_template.render(
-        data=autospectra, layout=layout, updatemenus=updatemenus, plotname=plotname
-    )
-
     print("Got {n_sig:d} signals".format(n_sig=n_signals))
-    with open("spectra.html", "w") as h_file:
+    with publish.publish("spectra.html") as h_file:
         h_file.write(rendered_html)
-    with open("spectra.js", "w") as js_file:
-        js_file.write(rendered_js)
+    # one shard per node (and one for the unmapped antennas) under names
+    # versioned by their content, listed in spectra_version.json which the
+    # page polls
+    shards = []
+    if args.decimate:
+        full_shared = {"freqs": plotly_data.encode_array(frange_mhz)}
+    for node_cnt, node in enumerate(nodes):
+        name = "node{:d}".format(node) if node != -1 else "unmapped"
+        in_node = [spec["node"] == node for spec in autospectra]
+        shard = {
+            "label": buttons[node_cnt + 1]["label"],
+            "url": publish_shard(
+                "spectra_{}.json".format(name),
+                {
+                    "shared": shared,
+                    "data": [spec for spec, keep in zip(autospectra, in_node) if keep],
+                },
+            ),
+        }
+        if args.decimate:
+            shard["full_url"] = publish_shard(
+                "spectra_full_{}.json".format(name),
+                {
+                    "shared": full_shared,
+                    "data": [spec for spec, keep in zip(full_spectra, in_node) if keep],
+                },
+            )
+        shards.append(shard)
+
+    with publish.publish("spectra_version.json") as version_file:
+        json.dump(
+            {
+                "shards": shards,
+                "updatemenus": updatemenus,
+                "data_date_iso": t_plot.iso,
+                "data_date_jd": "{:.3f}".format(time_jd),
+                "data_date_unix_ms": time_unix * 1000,
+            },
+            version_file,
+            sort_keys=True,
+        )
+    with publish.publish("spectra.js") as js_file:
+        js_file.write(
+            js_template.render(
+                layout=layout, plotname=plotname, version_url="spectra_version.json"
+            )
+        )
+
+    eq_medians.save()
+    print(eq_medians.report())
+    run_state.record_inputs("autospectra", inputs, filename=args.state_file)
 
 
 if __name__ == "__main__":
@@ -20,9 +20,12 @@ from datetime import datetime, timedelta, timezone
 from astropy.time import Time
 from jinja2 import Environment, FileSystemLoader
 
+import publish
+
 github_link_regex = r'data-url="([^"]+)"'
 
 
+@publish.batched
 def main(pem_file, app_id_file, repo_owner, repo_name, time_window, all_issues=False):
     t1 = Time.now()
     # templates are stored relative to the script dir
@@ -242,13 +245,11 @@ def main(pem_file, app_id_file, repo_owner, repo_name, time_window, all_issues=F
 
     rendered_html = html_template.render(
         tables=all_tables,
-        gen_date=Time.now().iso,
-        gen_time_unix_ms=Time.now().unix * 1000,
         scriptname=os.path.basename(__file__),
         hostname=computer_hostname,
     )
 
-    with open("issue_log.html", "w") as h_file:
+    with publish.publish("issue_log.html") as h_file:
         h_file.write(rendered_html)
 
     print("Execution Length: ", (Time.now() - t1).to("min"))
@@ -15,6 +15,11 @@ from hera_mc.librarian import LibServerStatus
 from hera_mc.rtp import RTPServerStatus
 from jinja2 import Environment, FileSystemLoader
 
+import mc_cache
+import plotly_json
+import publish
+import time_utils
+
 LIB_HOSTNAMES = [
     "qmaster",
     "pot1",
@@ -79,7 +84,56 @@ UI_HOSTNAMES = {
 }
 
 
-def get_status(session, tablecls, hostnames, cutoff):
+def fetch_status(session, tablecls, hostnames, since, aggregate="none", bucket=None):
+    """Get the status columns of every host newer than `since` in one query."""
+    if aggregate != "none":
+        return mc_cache.fetch_bucketed(
+            session,
+            tablecls.mc_time,
+            [("hostname", tablecls.hostname, str)],
+            [
+                ("load", tablecls.cpu_load_pct),
+                ("timediff", tablecls.mc_system_timediff),
+                ("mem", tablecls.memory_used_pct),
+                ("disk", tablecls.disk_space_pct),
+                ("bandwidth", tablecls.network_bandwidth_mbs),
+            ],
+            since,
+            bucket,
+            mode=aggregate,
+            filters=[tablecls.hostname.in_(hostnames)],
+        )
+
+    rows = (
+        session.query(
+            tablecls.mc_time,
+            tablecls.hostname,
+            tablecls.cpu_load_pct,
+            tablecls.mc_system_timediff,
+            tablecls.memory_used_pct,
+            tablecls.disk_space_pct,
+            tablecls.network_bandwidth_mbs,
+        )
+        .filter(tablecls.hostname.in_(hostnames))
+        .filter(tablecls.mc_time > since)
+        .order_by(tablecls.mc_time)
+        .all()
+    )
+    return mc_cache.rows_to_columns(
+        rows,
+        [
+            ("time", float),
+            ("hostname", str),
+            ("load", float),
+            ("timediff", float),
+            ("mem", float),
+            ("disk", float),
+            ("bandwidth", float),
+        ],
+    )
+
+
+def get_status(status, hostnames):
     data_dict = {
         "load": [],
         "timediff": [],
@@ -87,37 +141,28 @@ def get_status(session, tablecls, hostnames, cutoff):
         "disk": [],
         "bandwidth": [],
     }
+    isot = time_utils.gps_to_isot(status["time"])
     for host in hostnames:
-        data = (
-            session.query(tablecls)
-            .filter(tablecls.hostname == host)
-            .filter(tablecls.mc_time > cutoff.gps)
-            .order_by(tablecls.mc_time)
-            .all()
-        )
+        mask = status["hostname"] == host
         _name = UI_HOSTNAMES.get(host, host)
-        time_array = [Time(rec.mc_time, format="gps").isot for rec in data]
-        load_array = [rec.cpu_load_pct for rec in data]
-        tdiff_array = [rec.mc_system_timediff for rec in data]
-        mem_array = [rec.memory_used_pct for rec in data]
-        disk_array = [rec.disk_space_pct for rec in data]
-        net_array = [rec.network_bandwidth_mbs for rec in data]
-        data_arrays = [load_array, tdiff_array, mem_array, disk_array, net_array]
-        for pname, array in zip(data_dict.keys(), data_arrays):
-            _data = {"x": time_array, "y": array, "name": _name}
+        time_array = isot[mask]
+        for pname in data_dict.keys():
+            _data = {"x": time_array, "y": status[pname][mask], "name": _name}
             data_dict[pname].append(_data)
     return data_dict
 
 
-def main():
-    # templates are stored relative to the script dir
-    # stored one level up, find the parent directory
-    # and split the parent directory away
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    split_dir = os.path.split(script_dir)
-    template_dir = os.path.join(split_dir[0], "templates")
+@publish.batched
+def main(argv=None, db=None, env=None):
+    if env is None:
+        # templates are stored relative to the script dir
+        # stored one level up, find the parent directory
+        # and split the parent directory away
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        split_dir = os.path.split(script_dir)
+        template_dir = os.path.join(split_dir[0], "templates")
 
-    env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
+        env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
     if sys.version_info[0] < 3:
         # py2
         computer_hostname = os.uname()[1]
@@ -126,12 +171,15 @@ def main():
         computer_hostname = os.uname().nodename
 
     parser = mc.get_mc_argument_parser()
-    args = parser.parse_args()
+    mc_cache.add_cache_arguments(parser)
+    mc_cache.add_aggregate_arguments(parser)
+    args = parser.parse_args(argv)
 
-    try:
-        db = mc.connect_to_mc_db(args)
-    except RuntimeError as e:
-        raise SystemExit(str(e))
+    if db is None:
+        try:
+            db = mc.connect_to_mc_db(args)
+        except RuntimeError as e:
+            raise SystemExit(str(e))
 
     plotnames = [
         [n1 + "-" + n2 for n1 in ["lib", "rtp"]]
@@ -141,6 +189,8 @@ def main():
     TIME_WINDOW = 14  # days
     now = Time.now()
     cutoff = now - TimeDelta(TIME_WINDOW, format="jd")
+    # bucket length when aggregating, scaled to the window
+    bucket = mc_cache.bucket_size(TIME_WINDOW * 86400, args.points)
     time_axis_range = [cutoff.isot, now.isot]
 
     caption = {}
@@ -188,19 +238,38 @@ def main():
         plotname=plotnames,
         plotstyle="height: 19.5%",
         colsize=colsize,
-        gen_date=now.iso,
-        gen_time_unix_ms=now.unix * 1000,
         js_name="compute",
         hostname=computer_hostname,
         scriptname=os.path.basename(__file__),
         caption=caption,
     )
-    with open("compute.html", "w") as h_file:
+    with publish.publish("compute.html") as h_file:
         h_file.write(rendered_html)
 
     with db.sessionmaker() as session:
-        lib_data = get_status(session, LibServerStatus, LIB_HOSTNAMES, cutoff)
-        rtp_data = get_status(session, RTPServerStatus, RTP_HOSTNAMES, cutoff)
+        # only rows newer than the cached ones are fetched
+        lib_status = mc_cache.cached_columns(
+            args.cache_dir,
+            "compute_lib_status",
+            lambda since: fetch_status(
+                session, LibServerStatus, LIB_HOSTNAMES, since, args.aggregate, bucket
+            ),
+            cutoff.gps,
+            aggregate=args.aggregate,
+            bucket=bucket,
+        )
+        rtp_status = mc_cache.cached_columns(
+            args.cache_dir,
+            "compute_rtp_status",
+            lambda since: fetch_status(
+                session, RTPServerStatus, RTP_HOSTNAMES, since, args.aggregate, bucket
+            ),
+            cutoff.gps,
+            aggregate=args.aggregate,
+            bucket=bucket,
+        )
+        lib_data = get_status(lib_status, LIB_HOSTNAMES)
+        rtp_data = get_status(rtp_status, RTP_HOSTNAMES)
 
         layout = {
             "xaxis": {"range": time_axis_range},
@@ -227,24 +296,16 @@ def main():
             "bandwidth": "Network I/O",
             "timediff": "M&C time diff. ",
         }
+        bundle = plotly_json.PlotBundle(layout)
         for server_type, data_dict in zip(["lib", "rtp"], [lib_data, rtp_data]):
-            js_template = env.get_template("plotly_base.js")
-
             for pname in ["load", "disk", "mem", "bandwidth", "timediff"]:
                 layout["yaxis"]["title"] = yaxis_titles[pname]
                 layout["title"]["text"] = server_type + " " + titles[pname]
                 _name = server_type + "-" + pname
-                rendered_js = js_template.render(
-                    plotname=_name, data=data_dict[pname], layout=layout
-                )
-                if _name == "lib-load":
-                    open_type = "w"
-                else:
-                    open_type = "a"
-
-                with open("compute.js", open_type) as js_file:
-                    js_file.write(rendered_js)
-                    js_file.write("\n\n")
+                bundle.add(_name, data_dict[pname], layout)
+
+        with publish.publish("compute.js") as js_file:
+            bundle.write(js_file, env.get_template("plotly_bundle.js"))
 
 
 if __name__ == "__main__":
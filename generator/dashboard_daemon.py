@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""
+Run the dashboard generators as jobs inside one long-running process.
+
+Launching every generator from cron re-imports astropy, hera_mc,
+SQLAlchemy and jinja2, reconnects to M&C and rebuilds the template
+environment each time. This daemon pays those costs once: it keeps a single
+M&C engine (and its connection pool), a redis connection pool and a jinja
+environment with cached compiled templates alive, and calls each
+generator's ``main`` on its own interval.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+import importlib
+import traceback
+import redis
+from hera_mc import mc
+from astropy.time import Time
+from jinja2 import Environment, FileSystemLoader
+
+# generator module name -> refresh interval in seconds, uses M&C, uses redis
+JOBS = {
+    "mc_html_summary": (600, True, False),
+    "snaphookup": (600, False, True),
+    "autospectra": (600, False, True),
+    "hex_amp": (600, True, True),
+    "hookup_notes": (600, True, True),
+    "adc_histogram": (600, True, True),
+    "librarian": (600, True, False),
+    "compute": (600, True, False),
+    "qm": (600, True, False),
+    "waterfall": (600, False, False),
+}
+
+# jobs reading or writing the autocorrelation history, see --history-dir
+HISTORY_JOBS = ["autospectra", "waterfall"]
+
+
+def is_list(value):
+    return isinstance(value, list)
+
+
+def get_template_env():
+    """Build the jinja environment shared by every job."""
+    # templates are stored relative to the script dir
+    # stored one level up, find the parent directory
+    # and split the parent directory away
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    split_dir = os.path.split(script_dir)
+    template_dir = os.path.join(split_dir[0], "templates")
+
+    # templates do not change while the daemon is running, skip the
+    # up-to-date check so compiled templates are reused straight from cache
+    env = Environment(
+        loader=FileSystemLoader(template_dir), trim_blocks=True, auto_reload=False
+    )
+    # this filter is used to see if there is more than one table
+    env.filters["islist"] = is_list
+    return env
+
+
+def run_job(name, module, db, redis_pool, env, argv=None):
+    """Run a single generator, reporting (but surviving) any failure.
+
+    Parameters
+    ----------
+    name : str
+        Name of the generator module.
+    module : module
+        The imported generator.
+    db : hera_mc database object
+        The shared M&C connection.
+    redis_pool : redis.ConnectionPool
+        The shared redis connection pool.
+    env : jinja2.Environment
+        The shared template environment.
+    argv : list of str, optional
+        Command line arguments passed to the generator.
+
+    Returns
+    -------
+    bool
+        True if the job finished without raising.
+
+    """
+    _, use_mc, use_redis = JOBS[name]
+    kwargs = {"argv": argv or [], "env": env}
+    if use_mc:
+        kwargs["db"] = db
+    if use_redis:
+        kwargs["redis_db"] = redis.Redis(connection_pool=redis_pool)
+
+    t0 = time.time()
+    try:
+        module.main(**kwargs)
+    except (Exception, SystemExit):
+        print(Time.now().iso + "    {} failed:".format(name))
+        traceback.print_exc()
+        if use_mc:
+            # drop any connection left in a bad state, the pool reconnects
+            db.engine.dispose()
+        return False
+
+    print(
+        Time.now().iso
+        + "    {name} finished in {dt:.1f} s".format(name=name, dt=time.time() - t0)
+    )
+    return True
+
+
+def main():
+    parser = mc.get_mc_argument_parser()
+    parser.add_argument(
+        "--redishost",
+        dest="redishost",
+        type=str,
+        default="redishost",
+        help=('The host name for redis to connect to, defaults to "redishost"'),
+    )
+    parser.add_argument(
+        "--port", dest="port", type=int, default=6379, help="Redis port to connect."
+    )
+    parser.add_argument(
+        "--outdir",
+        dest="outdir",
+        type=str,
+        default=".",
+        help="Directory to write the generated pages into.",
+    )
+    parser.add_argument(
+        "--jobs",
+        nargs="+",
+        default=list(JOBS),
+        choices=list(JOBS),
+        help="Generators to run, defaults to all of them.",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=None,
+        help="Override the refresh interval (in seconds) of every job.",
+    )
+    parser.add_argument(
+        "--history-dir",
+        dest="history_dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory of the autocorrelation history recorded by autospectra. "
+            "The waterfall job only runs when this is given."
+        ),
+    )
+    args = parser.parse_args()
+
+    job_argv = {}
+    if args.history_dir is not None:
+        args.history_dir = os.path.abspath(args.history_dir)
+        for name in HISTORY_JOBS:
+            job_argv[name] = ["--history-dir", args.history_dir]
+    elif "waterfall" in args.jobs:
+        print("No --history-dir given, skipping the waterfall job.")
+        args.jobs.remove("waterfall")
+
+    try:
+        db = mc.connect_to_mc_db(args)
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+
+    redis_pool = redis.ConnectionPool(host=args.redishost, port=args.port)
+    env = get_template_env()
+    os.chdir(args.outdir)
+
+    modules = {}
+    for name in args.jobs:
+        try:
+            modules[name] = importlib.import_module(name)
+        except ImportError as err:
+            print(
+                "Unable to import {name}, skipping it: {err}".format(name=name, err=err)
+            )
+
+    if not modules:
+        raise SystemExit("No generators could be imported.")
+
+    next_run = {name: time.time() for name in modules}
+    while True:
+        name = min(next_run, key=next_run.get)
+        delay = next_run[name] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        start = time.time()
+        run_job(name, modules[name], db, redis_pool, env, argv=job_argv.get(name))
+
+        interval = args.interval if args.interval is not None else JOBS[name][0]
+        next_run[name] = start + interval
+
+
+if __name__ == "__main__":
+    main()
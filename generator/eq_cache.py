@@ -0,0 +1,169 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""Cache the median equalization coefficient of every antpol between runs.
+
+The coefficients are stored (in redis and in M&C) as long bracketed text
+strings which rarely change, but only their median is used. The cache keeps
+the median alongside a hash of the raw string, so a run only parses the
+strings which changed since the last one.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import fcntl
+import hashlib
+import numpy as np
+
+import redis_autos
+
+DEFAULT_CACHE_FILE = "dashboard_eq_cache.json"
+
+
+def add_eq_cache_arguments(parser):
+    """Add the --eq-cache-file option to an argument parser."""
+    parser.add_argument(
+        "--eq-cache-file",
+        dest="eq_cache_file",
+        type=str,
+        default=DEFAULT_CACHE_FILE,
+        help=(
+            "File caching the median equalization coefficients between runs, "
+            'defaults to "{}"'.format(DEFAULT_CACHE_FILE)
+        ),
+    )
+
+
+def _read_cache(cache_file):
+    cache_file.seek(0)
+    try:
+        return json.loads(cache_file.read() or "{}")
+    except ValueError:
+        # a corrupted cache just means everything gets parsed again
+        return {}
+
+
+class EqMedianCache(object):
+    """Median equalization coefficients keyed on a hash of the raw string.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the json file persisting the cache between runs.
+
+    """
+
+    def __init__(self, filename=DEFAULT_CACHE_FILE):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._updated = {}
+
+        self._entries = {}
+        if os.path.exists(filename):
+            with open(filename, "r") as cache_file:
+                fcntl.flock(cache_file, fcntl.LOCK_SH)
+                self._entries = _read_cache(cache_file)
+
+    def median(self, key, raw):
+        """Get the median coefficient of a raw coefficient string.
+
+        Parameters
+        ----------
+        key : str
+            Unique name of the coefficients, e.g. the redis key.
+        raw : bytes or str
+            The coefficients as stored, e.g. "[1.0, 1.0, ...]".
+
+        Returns
+        -------
+        float or None
+            The median coefficient, None if `raw` is None or holds no values.
+
+        """
+        if raw is None:
+            return None
+        if not isinstance(raw, bytes):
+            raw = raw.encode("utf-8")
+        digest = hashlib.sha1(raw).hexdigest()
+
+        entry = self._entries.get(key)
+        if entry is not None and entry["hash"] == digest:
+            self.hits += 1
+            return entry["median"]
+
+        self.misses += 1
+        coeffs = redis_autos.parse_eq_coeffs(raw)
+        median = None if coeffs is None else float(np.median(coeffs))
+        self._entries[key] = self._updated[key] = {"hash": digest, "median": median}
+        return median
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups answered from the cache, None before any lookup."""
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return None
+        return self.hits / lookups
+
+    def report(self):
+        """Describe the cache usage of this run."""
+        if self.hit_rate is None:
+            return "eq coefficient cache: no lookups"
+        return (
+            "eq coefficient cache: {hits:d} hits, {misses:d} misses "
+            "({rate:.1%} hit rate)".format(
+                hits=self.hits, misses=self.misses, rate=self.hit_rate
+            )
+        )
+
+    def save(self):
+        """Write the entries updated by this run back to the cache file.
+
+        The file is locked while it is updated so generators running at the
+        same time do not overwrite each other's entries.
+        """
+        if not self._updated:
+            return
+
+        with open(self.filename, "a+") as cache_file:
+            fcntl.flock(cache_file, fcntl.LOCK_EX)
+            entries = _read_cache(cache_file)
+            entries.update(self._updated)
+            cache_file.seek(0)
+            cache_file.truncate()
+            json.dump(entries, cache_file, sort_keys=True)
+            cache_file.flush()
+            os.fsync(cache_file.fileno())
+        self._updated = {}
+
+
+def get_eq_medians(redis_db, antpols, cache):
+    """Fetch the median equalization coefficient of the input antpols.
+
+    Parameters
+    ----------
+    redis_db : redis.Redis
+        Connection to the correlator redis.
+    antpols : list of tuple
+        (ant, pol) tuples to fetch.
+    cache : EqMedianCache
+        Cache of the previously parsed coefficients.
+
+    Returns
+    -------
+    dict
+        Dictionary keyed by (ant, pol) of the median coefficient.
+        Antpols with no (or empty) coefficients are not included.
+
+    """
+    medians = {}
+    for antpol, raw in redis_autos.get_eq_raw(redis_db, antpols).items():
+        ant, pol = antpol
+        median = cache.median(redis_autos.EQ_KEY.format(ant=ant, pol=pol), raw)
+        if median is not None:
+            medians[antpol] = median
+    return medians
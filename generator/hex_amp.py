@@ -10,12 +10,26 @@ from __future__ import absolute_import, division, print_function
 import os
 import sys
 import numpy as np
-import re
 import redis
-from hera_mc import mc, cm_sysutils
+from hera_mc import mc
+from hera_mc.correlator import AntennaStatus, SNAPStatus
 from astropy.time import Time
 from jinja2 import Environment, FileSystemLoader
 
+import antenna_index
+import auto_processing
+import eq_cache
+import mc_cache
+import mc_status
+import plotly_json
+import publish
+import redis_autos
+import run_state
+import time_utils
+
+# significant digits written for the positions and marker colors
+TRACE_PRECISION = {"x": 6, "y": 6, "color": 5}
+
 
 def write_csv(filename, antnames, ants, pols, stat_names, stats, built_but_not_on):
     """Write out antenna stats to csv file.
@@ -47,7 +61,7 @@ def write_csv(filename, antnames, ants, pols, stat_names, stats, built_but_not_o
     float_format_string = "{:.5f}"
     stats = np.ma.masked_invalid(stats)
 
-    with open(filename, "w") as csv_file:
+    with publish.publish(filename) as csv_file:
         csv_file.write(
             format_string.format("ANTNAME")
             + ","
@@ -87,15 +101,17 @@ def write_csv(filename, antnames, ants, pols, stat_names, stats, built_but_not_o
     return
 
 
-def main():
-    # templates are stored relative to the script dir
-    # stored one level up, find the parent directory
-    # and split the parent directory away
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    split_dir = os.path.split(script_dir)
-    template_dir = os.path.join(split_dir[0], "templates")
+@publish.batched
+def main(argv=None, db=None, redis_db=None, env=None):
+    if env is None:
+        # templates are stored relative to the script dir
+        # stored one level up, find the parent directory
+        # and split the parent directory away
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        split_dir = os.path.split(script_dir)
+        template_dir = os.path.join(split_dir[0], "templates")
 
-    env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
+        env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
     if sys.version_info[0] < 3:
         # py2
         computer_hostname = os.uname()[1]
@@ -116,112 +132,69 @@ def main():
     parser.add_argument(
         "--port", dest="port", type=int, default=6379, help="Redis port to connect."
     )
-    args = parser.parse_args()
-
-    try:
-        db = mc.connect_to_mc_db(args)
-    except RuntimeError as e:
-        raise SystemExit(str(e))
-
-    try:
-        redis_db = redis.Redis(args.redishost, port=args.port)
-        redis_db.keys()
-    except Exception as err:
-        raise SystemExit(str(err))
-
+    run_state.add_run_state_arguments(parser)
+    eq_cache.add_eq_cache_arguments(parser)
+    mc_cache.add_cache_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if db is None:
+        try:
+            db = mc.connect_to_mc_db(args)
+        except RuntimeError as e:
+            raise SystemExit(str(e))
+
+    if redis_db is None:
+        try:
+            redis_db = redis.Redis(args.redishost, port=args.port)
+            redis_db.ping()
+        except Exception as err:
+            raise SystemExit(str(err))
+
+    inputs = run_state.get_correlator_inputs(redis_db)
     with db.sessionmaker() as session:
-        # without item this will be an array which will break database queries
-        latest = Time(
-            np.frombuffer(redis_db.get("auto:timestamp"), dtype=np.float64).item(),
-            format="jd",
+        # the M&C records shown also change while the correlator is idle
+        inputs["mc_state"] = mc_status.get_mc_inputs(
+            session, [AntennaStatus.time, SNAPStatus.time]
         )
+        if not args.force and run_state.inputs_unchanged(
+            "hex_amp", inputs, filename=args.state_file
+        ):
+            print("No new correlator or M&C data since the last run, skipping.")
+            return
+
+        # read along with the skip check, a float for the database queries
+        if inputs["auto_timestamp"] is None:
+            raise SystemExit("No autocorrelation timestamp in redis.")
+        latest = Time(inputs["auto_timestamp"], format="jd")
+        latest.format = "iso"
         latest.out_subfmt = u"date_hm"
 
         now = Time.now()
-        amps = {}
-        keys = [
-            k.decode()
-            for k in redis_db.keys()
-            if k.startswith(b"auto") and not k.endswith(b"timestamp")
-        ]
+        antpols = redis_autos.get_auto_antpols(redis_db)
+        autos = redis_autos.get_autos(redis_db, antpols)
+        eq_medians = eq_cache.EqMedianCache(args.eq_cache_file)
+        all_eq_coeffs = eq_cache.get_eq_medians(redis_db, autos.keys(), eq_medians)
+
+        # equalize and clip every auto at once, then take the median
+        # of each antpol along the frequency axis
+        auto_antpols, spectra = auto_processing.stack_autos(autos, antpols=antpols)
+        auto_processing.equalize(
+            spectra, auto_processing.get_eq_medians(all_eq_coeffs, auto_antpols)
+        )
+        auto_processing.clip(spectra)
+        medians = auto_processing.antpol_stats(spectra, percentiles=())["median"]
+        amps = dict(zip(auto_antpols, 10.0 * np.log10(medians)))
 
-        for key in keys:
-            match = re.search(r"auto:(?P<ant>\d+)(?P<pol>e|n)", key)
-            if match is not None:
-                ant, pol = int(match.group("ant")), match.group("pol")
-                d = redis_db.get(key)
-                if d is not None:
-                    # need to copy because frombuffer creates a read-only array
-                    auto = np.frombuffer(d, dtype=np.float32).copy()
-
-                    eq_coeff = redis_db.hget(
-                        bytes("eq:ant:{ant}:{pol}".format(ant=ant, pol=pol).encode()),
-                        "values",
-                    )
-                    if eq_coeff is not None:
-                        eq_coeffs = np.fromstring(
-                            eq_coeff.decode("utf-8").strip("[]"), sep=","
-                        )
-                        if eq_coeffs.size == 0:
-                            eq_coeffs = np.ones_like(auto)
-                    else:
-                        eq_coeffs = np.ones_like(auto)
-
-                    # divide out the equalization coefficients
-                    # eq_coeffs are stored as a length 1024 array but only a
-                    # single number is used. Taking the median to not deal with
-                    # a size mismatch
-                    eq_coeffs = np.median(eq_coeffs)
-                    auto /= eq_coeffs ** 2
-                    auto[auto < 10 ** -10.0] = 10 ** -10.0
-                    auto = np.median(auto)
-                    amps[(ant, pol)] = 10.0 * np.log10(auto)
-
-        hsession = cm_sysutils.Handling(session)
         ants = np.unique([ant for (ant, pol) in amps.keys()])
         pols = np.unique([pol for (ant, pol) in amps.keys()])
 
-        antpos = np.genfromtxt(
-            os.path.join(mc.data_path, "HERA_350.txt"),
-            usecols=(0, 1, 2, 3),
-            dtype={
-                "names": ("ANTNAME", "EAST", "NORTH", "UP"),
-                "formats": ("<U5", "<f8", "<f8", "<f8"),
-            },
-            encoding=None,
-        )
-        antnames = antpos["ANTNAME"]
-        inds = [int(j[2:]) for j in antnames]
-        inds = np.argsort(inds)
-
-        antnames = np.take(antnames, inds)
-
-        antpos = np.array([antpos["EAST"], antpos["NORTH"], antpos["UP"]])
-        array_center = np.mean(antpos, axis=1, keepdims=True)
-        antpos -= array_center
-        antpos = np.take(antpos, inds, axis=1)
-
-        stations = hsession.get_connected_stations(at_date="now")
-
-        for station in stations:
-            if station.antenna_number not in ants:
-                ants = np.append(ants, station.antenna_number)
-        ants = np.unique(ants)
-
-        stations = []
-        for station_type in hsession.geo.parse_station_types_to_check("default"):
-            for stn in hsession.geo.station_types[station_type]["Stations"]:
-                stations.append(stn)
-
-        # stations is a list of HH??? numbers we just want the ints
-        stations = list(map(int, [j[2:] for j in stations]))
-        built_but_not_on = np.setdiff1d(stations, ants)
-        # Get node and PAM info
-        node_ind = np.zeros_like(ants, dtype=np.int)
-        pam_ind = np.zeros_like(ants, dtype=np.int)
-        # defaul the snap name to "No Data"
-        hostname = np.full_like(ants, "No\tData", dtype=object)
-        snap_serial = np.full_like(ants, "No\tData", dtype=object)
+        # names, centered positions and station lists, cached between runs
+        index = antenna_index.load_antenna_index(session, cache_dir=args.cache_dir)
+        antnames = index.names
+        antpos = index.positions
+
+        ants = np.union1d(ants, index.connected_numbers).astype(int)
+        built_but_not_on = np.setdiff1d(index.constructed_numbers, ants)
 
         pam_power = {}
         adc_power = {}
@@ -239,80 +212,40 @@ def main():
                 eq_coeffs.setdefault((ant, pol), np.Inf)
                 fem_imu_theta.setdefault((ant, pol), np.Inf)
                 fem_imu_phi.setdefault((ant, pol), np.Inf)
-                time_array.setdefault((ant, pol), now - Time(0, format="gps"))
-
-        for ant_cnt, ant in enumerate(ants):
-            station_status = session.get_antenna_status(
-                most_recent=True, antenna_number=int(ant)
-            )
-
-            for status in station_status:
-                antpol = (status.antenna_number, status.antenna_feed_pol)
-                if status.pam_power is not None:
-                    pam_power[antpol] = status.pam_power
-                if status.adc_power is not None:
-                    adc_power[antpol] = 10 * np.log10(status.adc_power)
-                if status.adc_rms is not None:
-                    adc_rms[antpol] = status.adc_rms
-                if status.time is not None:
-                    time_array[antpol] = now - Time(status.time, format="gps")
-                if status.fem_imu_phi is not None:
-                    fem_imu_phi[antpol] = status.fem_imu_phi
-                if status.fem_imu_theta is not None:
-                    fem_imu_theta[antpol] = status.fem_imu_theta
-                if status.eq_coeffs is not None:
-                    _coeffs = np.fromstring(status.eq_coeffs.strip("[]"), sep=",")
-                    # just track the median coefficient for now
-                    eq_coeffs[antpol] = np.median(_coeffs)
-
-            # Try to get the snap info. Output is a dictionary with 'e' and 'n' keys
-            mc_name = antnames[ant]
-            snap_info = hsession.get_part_at_station_from_type(mc_name, "now", "snap")
-            # get the first key in the dict to index easier
-            _key = list(snap_info.keys())[0]
-            pol_key = [key for key in snap_info[_key].keys() if "E" in key]
-            if pol_key:
-                # 'E' should be in one of the keys, extract the 0th entry
-                pol_key = pol_key[0]
-            else:
-                # a hacky solution for a key that should work
-                pol_key = "E<ground"
-            if snap_info[_key][pol_key] is not None:
-                snap_serial[ant_cnt] = snap_info[_key][pol_key]
-
-            # Try to get the pam info. Output is a dictionary with 'e' and 'n' keys
-            pam_info = hsession.get_part_at_station_from_type(
-                mc_name, "now", "post-amp"
+                time_array.setdefault(
+                    (ant, pol), (now.unix - time_utils.gps_to_unix(0)) / 3600.0
+                )
+
+        # latest status of every antpol in one query
+        for status in mc_status.get_latest_antenna_status(session, ants):
+            antpol = (status.antenna_number, status.antenna_feed_pol)
+            if status.pam_power is not None:
+                pam_power[antpol] = status.pam_power
+            if status.adc_power is not None:
+                adc_power[antpol] = 10 * np.log10(status.adc_power)
+            if status.adc_rms is not None:
+                adc_rms[antpol] = status.adc_rms
+            if status.time is not None:
+                time_array[antpol] = (
+                    now.unix - time_utils.gps_to_unix(status.time)
+                ) / 3600.0
+            if status.fem_imu_phi is not None:
+                fem_imu_phi[antpol] = status.fem_imu_phi
+            if status.fem_imu_theta is not None:
+                fem_imu_theta[antpol] = status.fem_imu_theta
+            # just track the median coefficient for now
+            _median = eq_medians.median(
+                "mc:eq:{:d}:{:s}".format(*antpol), status.eq_coeffs
             )
-            # get the first key in the dict to index easier
-            _key = list(pam_info.keys())[0]
-            if pam_info[_key][pol_key] is not None:
-                _pam_num = re.findall(r"PAM(\d+)", pam_info[_key][pol_key])[0]
-                pam_ind[ant_cnt] = np.int(_pam_num)
-            else:
-                pam_ind[ant_cnt] = -1
-
-            # Try to get the ADC info. Output is a dictionary with 'e' and 'n' keys
-            node_info = hsession.get_part_at_station_from_type(mc_name, "now", "node")
-            # get the first key in the dict to index easier
-            _key = list(node_info.keys())[0]
-            if node_info[_key][pol_key] is not None:
-                _node_num = re.findall(r"N(\d+)", node_info[_key][pol_key])[0]
-                node_ind[ant_cnt] = np.int(_node_num)
-
-                _hostname = session.get_snap_hostname_from_serial(snap_serial[ant_cnt])
+            if _median is not None:
+                eq_coeffs[antpol] = _median
 
-                if _hostname is not None:
-                    hostname[ant_cnt] = _hostname
-                else:
-                    snap_status = session.get_snap_status(
-                        most_recent=True, nodeID=np.int(_node_num)
-                    )
-                    for _status in snap_status:
-                        if _status.serial_number == snap_serial[ant_cnt]:
-                            hostname[ant_cnt] = _status.hostname
-            else:
-                node_ind[ant_cnt] = -1
+        # snap, PAM and node of every antenna, resolved in one pass
+        # "No\tData" and -1 mark hookups which could not be found
+        hookup = mc_status.get_station_hookup(session, ants, antnames)
+        hostname = hookup["hostname"]
+        pam_ind = hookup["pam"]
+        node_ind = hookup["node"]
 
         pams, _pam_ind = np.unique(pam_ind, return_inverse=True)
         nodes, _node_ind = np.unique(node_ind, return_inverse=True)
@@ -355,9 +288,8 @@ def main():
             "ant_stats.csv", antnames, ants, pols, names, powers, built_but_not_on
         )
 
-        time_array = np.array(
-            [[time_array[ant, pol].to("hour").value for ant in ants] for pol in pols]
-        )
+        # hours since the last status of each antpol
+        time_array = np.array([[time_array[ant, pol] for ant in ants] for pol in pols])
         xs = np.ma.masked_array(antpos[0, ants], mask=powers[0][0].mask)
         ys = np.ma.masked_array(
             [antpos[1, ants] + 3 * (pol_cnt - 0.5) for pol_cnt, pol in enumerate(pols)],
@@ -413,8 +345,8 @@ def main():
         # Offline antennas
         data_hex = []
         offline_ants = {
-            "x": xs_offline.compressed().tolist(),
-            "y": ys_offline.compressed().tolist(),
+            "x": xs_offline.compressed(),
+            "y": ys_offline.compressed(),
             "text": name_offline,
             "mode": "markers",
             "visible": True,
@@ -436,10 +368,8 @@ def main():
             for ant in built_but_not_on
         ]
 
-        offline_ants["marker"]["color"] = (
-            offline_ants["marker"]["color"].compressed().tolist()
-        )
-        offline_ants["text"] = offline_ants["text"].compressed().tolist()
+        offline_ants["marker"]["color"] = offline_ants["marker"]["color"].compressed()
+        offline_ants["text"] = offline_ants["text"].compressed()
         data_hex.append(offline_ants)
 
         #  for each type of power, loop over pols and print out the data
@@ -497,13 +427,13 @@ def main():
                         mask.extend([False] * 2)
 
                 _power = {
-                    "x": xs.data[~power[pol_ind].mask].tolist(),
-                    "y": ys[pol_ind].data[~power[pol_ind].mask].tolist(),
-                    "text": _text[pol_ind][~power[pol_ind].mask].tolist(),
+                    "x": xs.data[~power[pol_ind].mask],
+                    "y": ys[pol_ind].data[~power[pol_ind].mask],
+                    "text": _text[pol_ind][~power[pol_ind].mask],
                     "mode": "markers",
                     "visible": visible,
                     "marker": {
-                        "color": power[pol_ind].data[~power[pol_ind].mask].tolist(),
+                        "color": power[pol_ind].data[~power[pol_ind].mask],
                         "size": 14,
                         "cmin": vmin,
                         "cmax": vmax,
@@ -515,9 +445,9 @@ def main():
                 data_hex.append(_power)
 
                 _power_offline = {
-                    "x": xs.data[power[pol_ind].mask].tolist(),
-                    "y": ys[pol_ind].data[power[pol_ind].mask].tolist(),
-                    "text": _text[pol_ind][power[pol_ind].mask].tolist(),
+                    "x": xs.data[power[pol_ind].mask],
+                    "y": ys[pol_ind].data[power[pol_ind].mask],
+                    "text": _text[pol_ind][power[pol_ind].mask],
                     "mode": "markers",
                     "visible": visible,
                     "marker": {
@@ -617,29 +547,30 @@ def main():
             plotname=plotname,
             data_type="Auto correlations",
             plotstyle="height: 100%",
-            gen_date=now.iso,
             data_date_iso=latest.iso,
             data_date_jd="{:.3f}".format(time_jd),
             data_date_unix_ms=time_unix * 1000,
             js_name="hex_amp",
-            gen_time_unix_ms=now.unix * 1000,
             scriptname=os.path.basename(__file__),
             hostname=computer_hostname,
             caption=caption,
         )
 
-        rendered_hex_js = js_template.render(
-            data=data_hex,
-            layout=layout_hex,
-            updatemenus=updatemenus_hex,
-            plotname=plotname,
-        )
 
-        with open("hex_amp.html", "w") as h_file:
+        with publish.publish("hex_amp.html") as h_file:
             h_file.write(rendered_hex_html)
 
-        with open("hex_amp.js", "w") as js_file:
-            js_file.write(rendered_hex_js)
+        # the traces are streamed straight from the arrays
+        with publish.publish("hex_amp.js") as js_file:
+            plotly_json.write_plotly_js(
+                js_file,
+                js_template,
+                data_hex,
+                precision=TRACE_PRECISION,
+                layout=layout_hex,
+                updatemenus=updatemenus_hex,
+                plotname=plotname,
+            )
 
         # now prepare the data to be plotted vs node number
         data_node = []
@@ -712,13 +643,13 @@ def main():
                     ___text = __text[pol_ind][host_index]
 
                     _power = {
-                        "x": xs[pol_ind].data[~__power.mask].tolist(),
-                        "y": ys[pol_ind].data[~__power.mask].tolist(),
-                        "text": ___text[~__power.mask].tolist(),
+                        "x": xs[pol_ind].data[~__power.mask],
+                        "y": ys[pol_ind].data[~__power.mask],
+                        "text": ___text[~__power.mask],
                         "mode": "markers",
                         "visible": visible,
                         "marker": {
-                            "color": __power.data[~__power.mask].tolist(),
+                            "color": __power.data[~__power.mask],
                             "size": 14,
                             "cmin": vmin[pow_ind],
                             "cmax": vmax[pow_ind],
@@ -731,9 +662,9 @@ def main():
                     data_node.append(_power)
 
                     _power_offline = {
-                        "x": xs[pol_ind].data[__power.mask].tolist(),
-                        "y": ys[pol_ind].data[__power.mask].tolist(),
-                        "text": ___text[__power.mask].tolist(),
+                        "x": xs[pol_ind].data[__power.mask],
+                        "y": ys[pol_ind].data[__power.mask],
+                        "text": ___text[__power.mask],
                         "mode": "markers",
                         "visible": visible,
                         "marker": {
@@ -827,8 +758,6 @@ def main():
             plotname=plotname,
             data_type="Auto correlations",
             plotstyle="height: 100%",
-            gen_date=now.iso,
-            gen_time_unix_ms=now.unix * 1000,
             data_date_iso=latest.iso,
             data_date_jd="{:.3f}".format(time_jd),
             data_date_unix_ms=time_unix * 1000,
@@ -838,18 +767,25 @@ def main():
             caption=caption_node,
         )
 
-        rendered_node_js = js_template.render(
-            data=data_node,
-            layout=layout_node,
-            updatemenus=updatemenus_node,
-            plotname=plotname,
-        )
 
-        with open("node_amp.html", "w") as h_file:
+        with publish.publish("node_amp.html") as h_file:
             h_file.write(rendered_node_html)
 
-        with open("node_amp.js", "w") as js_file:
-            js_file.write(rendered_node_js)
+        # the traces are streamed straight from the arrays
+        with publish.publish("node_amp.js") as js_file:
+            plotly_json.write_plotly_js(
+                js_file,
+                js_template,
+                data_node,
+                precision=TRACE_PRECISION,
+                layout=layout_node,
+                updatemenus=updatemenus_node,
+                plotname=plotname,
+            )
+
+        eq_medians.save()
+        print(eq_medians.report())
+        run_state.record_inputs("hex_amp", inputs, filename=args.state_file)
 
 
 if __name__ == "__main__":
@@ -10,12 +10,19 @@ from __future__ import absolute_import, division, print_function
 import os
 import sys
 import numpy as np
-import re
 import redis
-from hera_mc import mc, cm_sysutils, cm_utils, cm_sysdef, cm_hookup
+from hera_mc import mc, cm_utils, cm_sysdef, cm_hookup
+from hera_mc.cm_partconnect import PartInfo
 from astropy.time import Time
 from jinja2 import Environment, FileSystemLoader
 
+import antenna_index
+import mc_cache
+import mc_status
+import publish
+import redis_autos
+import run_state
+
 
 def process_string(input_str, time_string_offset=37):
     # the header is already 37 characters long
@@ -34,15 +41,17 @@ def process_string(input_str, time_string_offset=37):
     return input_str
 
 
-def main():
-    # templates are stored relative to the script dir
-    # stored one level up, find the parent directory
-    # and split the parent directory away
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    split_dir = os.path.split(script_dir)
-    template_dir = os.path.join(split_dir[0], "templates")
+@publish.batched
+def main(argv=None, db=None, redis_db=None, env=None):
+    if env is None:
+        # templates are stored relative to the script dir
+        # stored one level up, find the parent directory
+        # and split the parent directory away
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        split_dir = os.path.split(script_dir)
+        template_dir = os.path.join(split_dir[0], "templates")
 
-    env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
+        env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
     if sys.version_info[0] < 3:
         # py2
         computer_hostname = os.uname()[1]
@@ -80,48 +89,53 @@ def main():
         help="Force use of specified hookup type.",
         default=None,
     )
+    run_state.add_run_state_arguments(parser)
+    mc_cache.add_cache_arguments(parser)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.hpn == "default":
         args.hpn = cm_sysdef.hera_zone_prefixes
     else:
         args.hpn = cm_utils.listify(args.hpn)
 
-    try:
-        db = mc.connect_to_mc_db(args)
-    except RuntimeError as e:
-        raise SystemExit(str(e))
+    if db is None:
+        try:
+            db = mc.connect_to_mc_db(args)
+        except RuntimeError as e:
+            raise SystemExit(str(e))
 
-    try:
-        redis_db = redis.Redis(args.redishost, port=args.port)
-        redis_db.keys()
-    except Exception as err:
-        raise SystemExit(str(err))
+    if redis_db is None:
+        try:
+            redis_db = redis.Redis(args.redishost, port=args.port)
+            redis_db.ping()
+        except Exception as err:
+            raise SystemExit(str(err))
 
+    inputs = run_state.get_correlator_inputs(redis_db)
     with db.sessionmaker() as session:
-        # without item this will be an array which will break database queries
-        latest = Time(
-            np.frombuffer(redis_db.get("auto:timestamp"), dtype=np.float64).item(),
-            format="jd",
+        # the M&C records shown also change while the correlator is idle
+        inputs["mc_state"] = mc_status.get_mc_inputs(
+            session, [PartInfo.posting_gpstime]
         )
+        if not args.force and run_state.inputs_unchanged(
+            "hookup_notes", inputs, filename=args.state_file
+        ):
+            print("No new correlator or M&C data since the last run, skipping.")
+            return
+
+        # read along with the skip check, a float for the database queries
+        if inputs["auto_timestamp"] is None:
+            raise SystemExit("No autocorrelation timestamp in redis.")
+        latest = Time(inputs["auto_timestamp"], format="jd")
+        latest.format = "iso"
         latest.out_subfmt = u"date_hm"
 
         now = Time.now()
-        online_ants = []
-        keys = [
-            k.decode()
-            for k in redis_db.keys()
-            if k.startswith(b"auto") and not k.endswith(b"timestamp")
+        online_ants = [
+            ant for (ant, pol) in redis_autos.get_auto_antpols(redis_db)
         ]
 
-        for key in keys:
-            match = re.search(r"auto:(?P<ant>\d+)(?P<pol>e|n)", key)
-            if match is not None:
-                ant = int(match.group("ant"))
-                online_ants.append(ant)
-
-        hsession = cm_sysutils.Handling(session)
         hookup = cm_hookup.Hookup(session)
 
         hookup_dict = hookup.get_hookup(
@@ -134,43 +148,13 @@ def main():
         )
         hu_notes = hookup.get_notes(hookup_dict=hookup_dict, state="all")
 
-        online_ants = np.unique(online_ants)
-
-        antpos = np.genfromtxt(
-            os.path.join(mc.data_path, "HERA_350.txt"),
-            usecols=(0, 1, 2, 3),
-            dtype={
-                "names": ("ANTNAME", "EAST", "NORTH", "UP"),
-                "formats": ("<U5", "<f8", "<f8", "<f8"),
-            },
-            encoding=None,
-        )
-        antnames = antpos["ANTNAME"]
-        inds = [int(j[2:]) for j in antnames]
-        inds = np.argsort(inds)
-
-        antnames = np.take(antnames, inds)
+        # names, centered positions and station lists, cached between runs
+        index = antenna_index.load_antenna_index(session, cache_dir=args.cache_dir)
+        antnames = index.names
+        antpos = index.positions
 
-        antpos = np.array([antpos["EAST"], antpos["NORTH"], antpos["UP"]])
-        array_center = np.mean(antpos, axis=1, keepdims=True)
-        antpos -= array_center
-        antpos = np.take(antpos, inds, axis=1)
-
-        stations = hsession.get_connected_stations(at_date="now")
-
-        for station in stations:
-            if station.antenna_number not in online_ants:
-                online_ants = np.append(online_ants, station.antenna_number)
-        online_ants = np.unique(online_ants)
-
-        stations = []
-        for station_type in hsession.geo.parse_station_types_to_check("default"):
-            for stn in hsession.geo.station_types[station_type]["Stations"]:
-                stations.append(stn)
-
-        # stations is a list of HH??? numbers we just want the ints
-        stations = list(map(int, [j[2:] for j in stations]))
-        built_but_not_on = np.setdiff1d(stations, online_ants)
+        online_ants = np.union1d(online_ants, index.connected_numbers).astype(int)
+        built_but_not_on = np.setdiff1d(index.constructed_numbers, online_ants)
         # Get node and PAM info
 
         #  get all the data
@@ -255,13 +239,11 @@ def main():
 
         rendered_html = html_template.render(
             tables=all_tables,
-            gen_date=Time.now().iso,
-            gen_time_unix_ms=Time.now().unix * 1000,
             scriptname=os.path.basename(__file__),
             hostname=computer_hostname,
         )
 
-        with open("hookup_notes_table.html", "w") as h_file:
+        with publish.publish("hookup_notes_table.html") as h_file:
             h_file.write(rendered_html)
 
         data_hex = []
@@ -332,12 +314,10 @@ def main():
             plotname=plotname,
             plotstyle="height: 100%",
             data_type="Online Antennas",
-            gen_date=now.iso,
             data_date_iso=latest.iso,
             data_date_jd="{:.3f}".format(time_jd),
             data_date_unix_ms=time_unix * 1000,
             js_name="hookup_notes",
-            gen_time_unix_ms=now.unix * 1000,
             scriptname=os.path.basename(__file__),
             hostname=computer_hostname,
             caption=caption,
@@ -349,12 +329,14 @@ def main():
             plotname=plotname,
         )
 
-        with open("hookup_notes.html", "w") as h_file:
+        with publish.publish("hookup_notes.html") as h_file:
             h_file.write(rendered_hex_html)
 
-        with open("hookup_notes.js", "w") as js_file:
+        with publish.publish("hookup_notes.js") as js_file:
             js_file.write(rendered_hex_js)
 
+        run_state.record_inputs("hookup_notes", inputs, filename=args.state_file)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,408 @@
+#! /usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""
+Run a dashboard generator while tracing its M&C and redis I/O.
+
+Every SQL statement sent through SQLAlchemy and every redis command (or
+pipeline) is recorded with its duration, the number of rows or bytes it
+returned and the generator function which issued it. For example::
+
+    python io_trace.py hex_amp --redishost redishost
+
+writes the full trace to ``hex_amp_trace.json``, prints the slowest call
+sites and appends a summary of the run to a history file shared by all
+generators, so a new per-antenna query shows up as a jump in the number of
+statements of that generator.
+
+The hooks are installed on the SQLAlchemy Engine and redis client classes,
+so the generators need no changes and nothing is recorded unless they are
+run through this script.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import argparse
+import importlib
+import numpy as np
+import redis
+import sqlalchemy
+
+DEFAULT_HISTORY_FILE = "io_trace_history.json"
+# runs of each generator kept in the history file
+HISTORY_LENGTH = 200
+
+GENERATOR_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def _response_bytes(response):
+    # approximate size of a redis reply
+    if isinstance(response, (bytes, str)):
+        return len(response)
+    if isinstance(response, dict):
+        return sum(
+            _response_bytes(key) + _response_bytes(val) for key, val in response.items()
+        )
+    if isinstance(response, (list, tuple, set)):
+        return sum(_response_bytes(item) for item in response)
+    return 0
+
+
+def _command_name(args):
+    name = args[0] if args else "?"
+    if isinstance(name, bytes):
+        name = name.decode("utf-8", "replace")
+    return str(name).upper()
+
+
+def _caller():
+    # the innermost frame in a generator script, skipping this module
+    frame = sys._getframe(1)
+    this_file = os.path.realpath(__file__)
+    while frame is not None:
+        filename = os.path.realpath(frame.f_code.co_filename)
+        if filename != this_file and os.path.dirname(filename) == GENERATOR_DIR:
+            return "{file}:{func}:{line:d}".format(
+                file=os.path.basename(filename),
+                func=frame.f_code.co_name,
+                line=frame.f_lineno,
+            )
+        frame = frame.f_back
+    return "unknown"
+
+
+class IOTracer(object):
+    """Record SQL statements and redis commands issued by a process.
+
+    Call `install` to start recording and `uninstall` to stop.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._installed = {}
+
+    def _record(self, kind, statement, duration, count, caller):
+        self.records.append(
+            {
+                "kind": kind,
+                "statement": statement,
+                "duration": duration,
+                "count": count,
+                "caller": caller,
+            }
+        )
+
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("io_trace_start", []).append(time.time())
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        duration = time.time() - conn.info["io_trace_start"].pop()
+        self._record(
+            "sql",
+            re.sub(r"\s+", " ", statement).strip(),
+            duration,
+            max(cursor.rowcount, 0),
+            _caller(),
+        )
+
+    def install(self):
+        """Hook every SQLAlchemy engine and redis client."""
+        tracer = self
+        engine_cls = sqlalchemy.engine.Engine
+        sqlalchemy.event.listen(
+            engine_cls, "before_cursor_execute", self._before_cursor_execute
+        )
+        sqlalchemy.event.listen(
+            engine_cls, "after_cursor_execute", self._after_cursor_execute
+        )
+
+        execute_command = redis.Redis.execute_command
+        pipeline_execute = redis.client.Pipeline.execute
+
+        def traced_execute_command(client, *args, **options):
+            t0 = time.time()
+            response = execute_command(client, *args, **options)
+            tracer._record(
+                "redis",
+                _command_name(args),
+                time.time() - t0,
+                _response_bytes(response),
+                _caller(),
+            )
+            return response
+
+        def traced_pipeline_execute(pipeline, *args, **kwargs):
+            names = [_command_name(entry[0]) for entry in pipeline.command_stack]
+            t0 = time.time()
+            response = pipeline_execute(pipeline, *args, **kwargs)
+            counts = {}
+            for name in names:
+                counts[name] = counts.get(name, 0) + 1
+            tracer._record(
+                "redis",
+                "PIPELINE "
+                + ", ".join(
+                    "{} x{:d}".format(name, count)
+                    for name, count in sorted(counts.items())
+                ),
+                time.time() - t0,
+                _response_bytes(response),
+                _caller(),
+            )
+            return response
+
+        redis.Redis.execute_command = traced_execute_command
+        redis.client.Pipeline.execute = traced_pipeline_execute
+        self._installed = {
+            "execute_command": execute_command,
+            "pipeline_execute": pipeline_execute,
+        }
+
+    def uninstall(self):
+        """Remove the hooks added by `install`."""
+        if not self._installed:
+            return
+        engine_cls = sqlalchemy.engine.Engine
+        sqlalchemy.event.remove(
+            engine_cls, "before_cursor_execute", self._before_cursor_execute
+        )
+        sqlalchemy.event.remove(
+            engine_cls, "after_cursor_execute", self._after_cursor_execute
+        )
+        redis.Redis.execute_command = self._installed["execute_command"]
+        redis.client.Pipeline.execute = self._installed["pipeline_execute"]
+        self._installed = {}
+
+    def totals(self, kind):
+        """Get the number of calls and their total duration of one kind."""
+        durations = [rec["duration"] for rec in self.records if rec["kind"] == kind]
+        return len(durations), float(np.sum(durations))
+
+    def top(self, ntop=20):
+        """Get the call sites which took the longest in total.
+
+        Parameters
+        ----------
+        ntop : int
+            Number of call sites to return.
+
+        Returns
+        -------
+        list of dict
+            Summaries with the "kind", "statement", "caller", number of
+            "calls", "total" and "max" durations in seconds and summed "count"
+            of rows or bytes, longest total first.
+
+        """
+        groups = {}
+        for rec in self.records:
+            key = (rec["kind"], rec["statement"], rec["caller"])
+            group = groups.setdefault(
+                key,
+                {
+                    "kind": rec["kind"],
+                    "statement": rec["statement"],
+                    "caller": rec["caller"],
+                    "calls": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "count": 0,
+                },
+            )
+            group["calls"] += 1
+            group["total"] += rec["duration"]
+            group["max"] = max(group["max"], rec["duration"])
+            group["count"] += rec["count"]
+        return sorted(groups.values(), key=lambda grp: -grp["total"])[:ntop]
+
+
+def format_top(top, statement_width=60):
+    """Format the call site summaries as a plain text table."""
+    lines = [
+        "{:<6s}{:>7s}{:>10s}{:>10s}{:>12s}  {:<32s}{}".format(
+            "kind", "calls", "total [s]", "max [s]", "rows/bytes", "caller", "statement"
+        )
+    ]
+    for group in top:
+        statement = group["statement"]
+        if len(statement) > statement_width:
+            statement = statement[: statement_width - 3] + "..."
+        lines.append(
+            "{kind:<6s}{calls:>7d}{total:>10.3f}{max:>10.3f}{count:>12d}  "
+            "{caller:<32s}{statement}".format(
+                kind=group["kind"],
+                calls=group["calls"],
+                total=group["total"],
+                max=group["max"],
+                count=group["count"],
+                caller=group["caller"],
+                statement=statement,
+            )
+        )
+    return "\n".join(lines)
+
+
+def update_history(filename, name, summary):
+    """Append a run summary to the history file and return earlier runs.
+
+    The file is locked while it is updated so generators traced at the same
+    time do not overwrite each other's runs.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the json history file.
+    name : str
+        Name of the generator.
+    summary : dict
+        Summary of this run.
+
+    Returns
+    -------
+    list of dict
+        The summaries of the earlier runs of the same generator.
+
+    """
+    with open(filename, "a+") as history_file:
+        fcntl.flock(history_file, fcntl.LOCK_EX)
+        history_file.seek(0)
+        try:
+            history = json.loads(history_file.read() or "{}")
+        except ValueError:
+            history = {}
+        runs = history.setdefault(name, [])
+        previous = list(runs)
+        runs.append(summary)
+        del runs[:-HISTORY_LENGTH]
+        history_file.seek(0)
+        history_file.truncate()
+        json.dump(history, history_file, indent=1, sort_keys=True)
+        history_file.flush()
+        os.fsync(history_file.fileno())
+    return previous
+
+
+def format_regressions(summary, previous, threshold=1.5):
+    """Describe counts and durations well above the median of earlier runs."""
+    lines = []
+    for key in ["sql_calls", "sql_time", "redis_calls", "redis_time", "wall_time"]:
+        values = [run[key] for run in previous if key in run]
+        if not values:
+            continue
+        median = float(np.median(values))
+        if median > 0 and summary[key] > threshold * median:
+            lines.append(
+                "{key} is {value:.3g}, the median of the last {n:d} runs "
+                "is {median:.3g}".format(
+                    key=key, value=summary[key], n=len(values), median=median
+                )
+            )
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Run a dashboard generator, tracing its M&C and redis I/O. "
+            "Arguments after the generator name are passed to it."
+        )
+    )
+    parser.add_argument("script", help="Name of the generator, e.g. hex_amp.")
+    parser.add_argument(
+        "--trace-file",
+        dest="trace_file",
+        type=str,
+        default=None,
+        help='File the full trace is written to, defaults to "<script>_trace.json".',
+    )
+    parser.add_argument(
+        "--history-file",
+        dest="history_file",
+        type=str,
+        default=DEFAULT_HISTORY_FILE,
+        help=(
+            "File collecting the summaries of every traced run, "
+            'defaults to "{}"'.format(DEFAULT_HISTORY_FILE)
+        ),
+    )
+    parser.add_argument(
+        "--top",
+        dest="top",
+        type=int,
+        default=20,
+        help="Number of call sites printed in the summary, defaults to 20.",
+    )
+    args, script_argv = parser.parse_known_args()
+    if args.trace_file is None:
+        args.trace_file = args.script + "_trace.json"
+
+    module = importlib.import_module(args.script)
+    # the generators parse their options from sys.argv
+    sys.argv = [module.__file__] + script_argv
+    tracer = IOTracer()
+    tracer.install()
+    status = 0
+    t0 = time.time()
+    try:
+        module.main()
+    except SystemExit as err:
+        status = err.code
+    finally:
+        wall_time = time.time() - t0
+        tracer.uninstall()
+
+    sql_calls, sql_time = tracer.totals("sql")
+    redis_calls, redis_time = tracer.totals("redis")
+    summary = {
+        "time": t0,
+        "status": status,
+        "wall_time": wall_time,
+        "sql_calls": sql_calls,
+        "sql_time": sql_time,
+        "redis_calls": redis_calls,
+        "redis_time": redis_time,
+        # rendering, numpy and anything else not waiting on I/O
+        "other_time": wall_time - sql_time - redis_time,
+    }
+    top = tracer.top(args.top)
+    with open(args.trace_file, "w") as trace_file:
+        json.dump(
+            {"summary": summary, "top": top, "records": tracer.records},
+            trace_file,
+            indent=1,
+        )
+    previous = update_history(args.history_file, args.script, summary)
+
+    print(
+        "{name}: {wall:.2f} s total, M&C {sql_calls:d} statements in {sql:.2f} s, "
+        "redis {redis_calls:d} calls in {redis:.2f} s, other {other:.2f} s".format(
+            name=args.script,
+            wall=wall_time,
+            sql_calls=sql_calls,
+            sql=sql_time,
+            redis_calls=redis_calls,
+            redis=redis_time,
+            other=summary["other_time"],
+        )
+    )
+    print(format_top(top))
+    for line in format_regressions(summary, previous):
+        print("Possible regression: " + line)
+
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
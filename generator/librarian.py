@@ -10,6 +10,7 @@ from __future__ import absolute_import, division, print_function
 import os
 import sys
 import re
+import time
 import numpy as np
 from astropy.time import Time, TimeDelta
 from html import escape
@@ -24,6 +25,11 @@ from hera_mc.librarian import (
 )
 from jinja2 import Environment, FileSystemLoader
 
+import mc_cache
+import plotly_json
+import publish
+import time_utils
+
 
 HOSTNAMES = [
     "qmaster",
@@ -74,24 +80,127 @@ UI_HOSTNAMES = {
 REMOTES = ["aoc-uploads", "shredder"]
 
 
-def do_server_loads(session, cutoff):
+def fetch_lib_status(session, since, aggregate="none", bucket=None):
+    """Get every LibStatus column used by the page in a single query."""
+    if aggregate != "none":
+        return mc_cache.fetch_bucketed(
+            session,
+            LibStatus.time,
+            [],
+            [
+                ("data_volume_gb", LibStatus.data_volume_gb),
+                ("free_space_gb", LibStatus.free_space_gb),
+                ("upload_min_elapsed", LibStatus.upload_min_elapsed),
+                ("num_files", LibStatus.num_files),
+            ],
+            since,
+            bucket,
+            mode=aggregate,
+        )
+
+    rows = (
+        session.query(
+            LibStatus.time,
+            LibStatus.data_volume_gb,
+            LibStatus.free_space_gb,
+            LibStatus.upload_min_elapsed,
+            LibStatus.num_files,
+        )
+        .filter(LibStatus.time > since)
+        .order_by(LibStatus.time)
+        .all()
+    )
+    return mc_cache.rows_to_columns(
+        rows,
+        [
+            ("time", float),
+            ("data_volume_gb", float),
+            ("free_space_gb", float),
+            ("upload_min_elapsed", float),
+            ("num_files", float),
+        ],
+    )
+
+
+def fetch_remote_status(session, since, remotes=REMOTES, aggregate="none", bucket=None):
+    """Get the LibRemoteStatus of every remote in a single query."""
+    if aggregate != "none":
+        return mc_cache.fetch_bucketed(
+            session,
+            LibRemoteStatus.time,
+            [("remote_name", LibRemoteStatus.remote_name, str)],
+            [
+                ("bandwidth_mbs", LibRemoteStatus.bandwidth_mbs),
+                ("ping_time", LibRemoteStatus.ping_time),
+            ],
+            since,
+            bucket,
+            mode=aggregate,
+            filters=[LibRemoteStatus.remote_name.in_(remotes)],
+        )
+
+    rows = (
+        session.query(
+            LibRemoteStatus.time,
+            LibRemoteStatus.remote_name,
+            LibRemoteStatus.bandwidth_mbs,
+            LibRemoteStatus.ping_time,
+        )
+        .filter(LibRemoteStatus.remote_name.in_(remotes))
+        .filter(LibRemoteStatus.time > since)
+        .order_by(LibRemoteStatus.time)
+        .all()
+    )
+    return mc_cache.rows_to_columns(
+        rows,
+        [
+            ("time", float),
+            ("remote_name", str),
+            ("bandwidth_mbs", float),
+            ("ping_time", float),
+        ],
+    )
+
+
+def fetch_server_status(
+    session, since, hostnames=HOSTNAMES, aggregate="none", bucket=None
+):
+    """Get the LibServerStatus of every host in a single query."""
+    if aggregate != "none":
+        return mc_cache.fetch_bucketed(
+            session,
+            LibServerStatus.mc_time,
+            [("hostname", LibServerStatus.hostname, str)],
+            [("cpu_load_pct", LibServerStatus.cpu_load_pct)],
+            since,
+            bucket,
+            mode=aggregate,
+            filters=[LibServerStatus.hostname.in_(hostnames)],
+        )
+
+    rows = (
+        session.query(
+            LibServerStatus.mc_time,
+            LibServerStatus.hostname,
+            LibServerStatus.cpu_load_pct,
+        )
+        .filter(LibServerStatus.hostname.in_(hostnames))
+        .filter(LibServerStatus.mc_time > since)
+        .order_by(LibServerStatus.mc_time)
+        .all()
+    )
+    return mc_cache.rows_to_columns(
+        rows, [("time", float), ("hostname", str), ("cpu_load_pct", float)]
+    )
+
+
+def do_server_loads(server_status):
     _data = []
     for host in HOSTNAMES:
-        data = (
-            session.query(LibServerStatus.mc_time, LibServerStatus.cpu_load_pct)
-            .filter(LibServerStatus.hostname == host)
-            .filter(LibServerStatus.mc_time > cutoff.gps)
-            .order_by(LibServerStatus.mc_time)
-            .all()
-        )
-        time_array = Time([t[0] for t in data], format="gps")
-        if time_array:
-            time_array = time_array.isot.tolist()
-        else:
-            time_array = []
+        mask = server_status["hostname"] == host
         __data = {
-            "x": time_array,
-            "y": [t[1] for t in data],
+            "x": server_status["isot"][mask],
+            "y": server_status["cpu_load_pct"][mask],
             "name": UI_HOSTNAMES.get(host, host),
             "type": "scatter",
         }
@@ -100,44 +209,19 @@ def do_server_loads(session, cutoff):
     return _data
 
 
-def do_disk_space(session, cutoff):
+def do_disk_space(lib_status):
     _data = []
-    data = (
-        session.query(LibStatus.time, LibStatus.data_volume_gb)
-        .filter(LibStatus.time > cutoff.gps)
-        .order_by(LibStatus.time)
-        .all()
-    )
-
-    time_array = Time([t[0] for t in data], format="gps")
-    if time_array:
-        time_array = time_array.isot.tolist()
-    else:
-        time_array = []
-
     __data = {
-        "x": time_array,
-        "y": [t[1] for t in data],
+        "x": lib_status["isot"],
+        "y": lib_status["data_volume_gb"],
         "name": "Data Volume".replace(" ", "\t"),
         "type": "scatter",
     }
     _data.append(__data)
 
-    data = (
-        session.query(LibStatus.time, LibStatus.free_space_gb)
-        .filter(LibStatus.time > cutoff.gps)
-        .order_by(LibStatus.time)
-        .all()
-    )
-
-    time_array = Time([t[0] for t in data], format="gps")
-    if time_array:
-        time_array = time_array.isot.tolist()
-    else:
-        time_array = []
     __data = {
-        "x": time_array,
-        "y": [t[1] for t in data],
+        "x": lib_status["isot"],
+        "y": lib_status["free_space_gb"],
         "name": "Free space".replace(" ", "\t"),
         "type": "scatter",
         "yaxis": "y2",
@@ -147,24 +231,11 @@ def do_disk_space(session, cutoff):
     return _data
 
 
-def do_upload_ages(session, cutoff):
+def do_upload_ages(lib_status):
     _data = []
-
-    data = (
-        session.query(LibStatus.time, LibStatus.upload_min_elapsed)
-        .filter(LibStatus.time > cutoff.gps)
-        .order_by(LibStatus.time)
-        .all()
-    )
-
-    time_array = Time([t[0] for t in data], format="gps")
-    if time_array:
-        time_array = time_array.isot.tolist()
-    else:
-        time_array = []
     __data = {
-        "x": time_array,
-        "y": [t[1] for t in data],
+        "x": lib_status["isot"],
+        "y": lib_status["upload_min_elapsed"],
         "name": "Time since last upload".replace(" ", "\t"),
         "type": "scatter",
     }
@@ -173,26 +244,13 @@ def do_upload_ages(session, cutoff):
     return _data
 
 
-def do_bandwidths(session, cutoff):
+def do_bandwidths(remote_status):
     _data = []
-
     for remote in REMOTES:
-        data = (
-            session.query(LibRemoteStatus.time, LibRemoteStatus.bandwidth_mbs)
-            .filter(LibRemoteStatus.remote_name == remote)
-            .filter(LibRemoteStatus.time > cutoff.gps)
-            .order_by(LibRemoteStatus.time)
-            .all()
-        )
-
-        time_array = Time([t[0] for t in data], format="gps")
-        if time_array:
-            time_array = time_array.isot.tolist()
-        else:
-            time_array = []
+        mask = remote_status["remote_name"] == remote
         __data = {
-            "x": time_array,
-            "y": [t[1] for t in data],
+            "x": remote_status["isot"][mask],
+            "y": remote_status["bandwidth_mbs"][mask],
             "name": ("{name} transfer rate".format(name=remote).replace(" ", "\t")),
             "type": "scatter",
         }
@@ -201,25 +259,13 @@ def do_bandwidths(session, cutoff):
     return _data
 
 
-def do_ping_times(session, cutoff):
+def do_ping_times(remote_status):
     _data = []
     for remote in REMOTES:
-        data = (
-            session.query(LibRemoteStatus.time, LibRemoteStatus.ping_time)
-            .filter(LibRemoteStatus.remote_name == remote)
-            .filter(LibRemoteStatus.time > cutoff.gps)
-            .order_by(LibRemoteStatus.time)
-            .all()
-        )
-
-        time_array = Time([t[0] for t in data], format="gps")
-        if time_array:
-            time_array = time_array.isot.tolist()
-        else:
-            time_array = []
+        mask = remote_status["remote_name"] == remote
         __data = {
-            "x": time_array,
-            "y": [1000 * t[1] for t in data],
+            "x": remote_status["isot"][mask],
+            "y": 1000 * remote_status["ping_time"][mask],
             "name": "{name} ping time".format(name=remote).replace(" ", "\t"),
             "type": "scatter",
         }
@@ -241,22 +287,11 @@ def creation_date(path_to_file):
     return stat.st_mtime
 
 
-def do_num_files(session, cutoff):
+def do_num_files(lib_status):
     _data = []
-    data = (
-        session.query(LibStatus.time, LibStatus.num_files)
-        .filter(LibStatus.time > cutoff.gps)
-        .order_by(LibStatus.time)
-        .all()
-    )
-    time_array = Time([t[0] for t in data], format="gps")
-    if time_array:
-        time_array = time_array.isot.tolist()
-    else:
-        time_array = []
     __data = {
-        "x": time_array,
-        "y": [t[1] for t in data],
+        "x": lib_status["isot"],
+        "y": lib_status["num_files"],
         "name": "Total Number of files".replace(" ", "\t"),
         "type": "scatter",
     }
@@ -280,7 +315,8 @@ def do_compare_file_types(TIME_WINDOW):
     if computer_hostname != "qmaster":
         return
     timesteps = np.linspace(-1 * TIME_WINDOW, 0, 24 * 14 * 6, endpoint=True)
-    time_array = Time.now() + TimeDelta(timesteps, format="jd")
+    # unix seconds of each step
+    time_array = time.time() + timesteps * 86400.0
     _data = []
     raw_regex = r"zen.(\d+.\d+).uvh5"
     processed_regex = r"zen.(\d+.\d+).HH.uvh5"
@@ -303,33 +339,36 @@ def do_compare_file_types(TIME_WINDOW):
         )
         return
 
-    raw_jd = Time([float(re.findall(raw_regex, f)[0]) for f in raw_names], format="jd")
-    proc_jd = Time(
-        [float(re.findall(processed_regex, f)[0]) for f in processed_names], format="jd"
+    raw_jd = np.array(
+        [float(re.findall(raw_regex, f)[0]) for f in raw_names], dtype=np.float64
+    )
+    proc_jd = np.array(
+        [float(re.findall(processed_regex, f)[0]) for f in processed_names],
+        dtype=np.float64,
     )
 
-    # try to find the times they were created
-    raw_times = Time(
-        [creation_date(os.path.join(data_dir, n)) for n in raw_names], format="unix"
+    # try to find the times they were created, as unix seconds
+    raw_times = np.array(
+        [creation_date(os.path.join(data_dir, n)) for n in raw_names], dtype=np.float64
     )
 
-    hh_times = Time(
+    hh_times = np.array(
         [creation_date(os.path.join(data_dir, n)) for n in processed_names],
-        format="unix",
+        dtype=np.float64,
     )
     # Only consider processed files if their JD is equal to or newer than
     # the oldest raw file
-    hh_times = hh_times[proc_jd >= raw_jd.min()]
+    if raw_jd.size > 0:
+        hh_times = hh_times[proc_jd >= raw_jd.min()]
 
-    n_files_raw = []
-    n_files_processed = []
-    for _t in time_array:
-        n_files_raw.append(int(sum(list(_t >= raw_times))))
-        n_files_processed.append(int(sum(list(_t >= hh_times))))
+    # number of files created at or before each step
+    n_files_raw = np.searchsorted(np.sort(raw_times), time_array, side="right")
+    n_files_processed = np.searchsorted(np.sort(hh_times), time_array, side="right")
+    time_iso = time_utils.unix_to_iso(time_array).tolist()
 
     __data = {
-        "x": time_array.isot.tolist(),
-        "y": n_files_raw,
+        "x": time_iso,
+        "y": n_files_raw.tolist(),
         "name": "Raw files".replace(" ", "\t"),
         "type": "scatter",
     }
@@ -337,8 +376,8 @@ def do_compare_file_types(TIME_WINDOW):
     _data.append(__data)
 
     __data = {
-        "x": time_array.isot.tolist(),
-        "y": n_files_processed,
+        "x": time_iso,
+        "y": n_files_processed.tolist(),
         "name": "Processed files".replace(" ", "\t"),
         "type": "scatter",
     }
@@ -363,7 +402,7 @@ def do_raid_errors(session, cutoff):
 
     for rec in q:
         _row = {}
-        _row["time"] = Time(rec.time, format="gps").iso.replace(" ", "\t")
+        _row["time"] = time_utils.gps_to_iso(rec.time).replace(" ", "\t")
         _row["hostname"] = rec.hostname
         _row["disk"] = rec.disk
         _row["message"] = escape(rec.log)
@@ -388,7 +427,7 @@ def do_raid_status(session, cutoff):
 
     for rec in q:
         _row = {}
-        _row["time"] = Time(rec.time, format="gps").iso.replace(" ", "\t")
+        _row["time"] = time_utils.gps_to_iso(rec.time).replace(" ", "\t")
         _row["hostname"] = rec.hostname
         _row["disk"] = rec.num_disks
         _row["message"] = escape(rec.info)
@@ -398,15 +437,17 @@ def do_raid_status(session, cutoff):
     return table
 
 
-def main():
-    # templates are stored relative to the script dir
-    # stored one level up, find the parent directory
-    # and split the parent directory away
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    split_dir = os.path.split(script_dir)
-    template_dir = os.path.join(split_dir[0], "templates")
+@publish.batched
+def main(argv=None, db=None, env=None):
+    if env is None:
+        # templates are stored relative to the script dir
+        # stored one level up, find the parent directory
+        # and split the parent directory away
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        split_dir = os.path.split(script_dir)
+        template_dir = os.path.join(split_dir[0], "templates")
 
-    env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
+        env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
     if sys.version_info[0] < 3:
         # py2
         computer_hostname = os.uname()[1]
@@ -414,17 +455,22 @@ def main():
         # py3
         computer_hostname = os.uname().nodename
     parser = mc.get_mc_argument_parser()
-    args = parser.parse_args()
+    mc_cache.add_cache_arguments(parser)
+    mc_cache.add_aggregate_arguments(parser)
+    args = parser.parse_args(argv)
 
-    try:
-        db = mc.connect_to_mc_db(args)
-    except RuntimeError as e:
-        raise SystemExit(str(e))
+    if db is None:
+        try:
+            db = mc.connect_to_mc_db(args)
+        except RuntimeError as e:
+            raise SystemExit(str(e))
 
     colsize = 6
     TIME_WINDOW = 14  # days
     now = Time.now()
     cutoff = now - TimeDelta(TIME_WINDOW, format="jd")
+    # bucket length when aggregating, scaled to the window
+    bucket = mc_cache.bucket_size(TIME_WINDOW * 86400, args.points)
     time_axis_range = [cutoff.isot, now.isot]
     plotnames = [
         ["server-loads", "upload-ages"],
@@ -445,31 +491,57 @@ def main():
     }
 
     html_template = env.get_template("librarian_table.html")
-    js_template = env.get_template("plotly_base.js")
+    bundle_template = env.get_template("plotly_bundle.js")
 
     with db.sessionmaker() as session:
+        # one query per table, split into the plotted series in memory,
+        # only rows newer than the cached ones are fetched
+        lib_status = mc_cache.cached_columns(
+            args.cache_dir,
+            "librarian_lib_status",
+            lambda since: fetch_lib_status(
+                session, since, aggregate=args.aggregate, bucket=bucket
+            ),
+            cutoff.gps,
+            aggregate=args.aggregate,
+            bucket=bucket,
+        )
+        remote_status = mc_cache.cached_columns(
+            args.cache_dir,
+            "librarian_remote_status",
+            lambda since: fetch_remote_status(
+                session, since, aggregate=args.aggregate, bucket=bucket
+            ),
+            cutoff.gps,
+            aggregate=args.aggregate,
+            bucket=bucket,
+        )
+        server_status = mc_cache.cached_columns(
+            args.cache_dir,
+            "librarian_server_status",
+            lambda since: fetch_server_status(
+                session, since, aggregate=args.aggregate, bucket=bucket
+            ),
+            cutoff.gps,
+            aggregate=args.aggregate,
+            bucket=bucket,
+        )
+        for status in [lib_status, remote_status, server_status]:
+            status["isot"] = time_utils.gps_to_isot(status["time"])
 
-        data = do_server_loads(session, cutoff)
+        # the plots are written to librarian.js in one go at the end
+        bundle = plotly_json.PlotBundle(layout)
+        data = do_server_loads(server_status)
         layout["title"]["text"] = "CPU Loads"
-        rendered_js = js_template.render(
-            plotname="server-loads", data=data, layout=layout
-        )
-        with open("librarian.js", "w") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("server-loads", data, layout)
 
-        data = do_upload_ages(session, cutoff)
+        data = do_upload_ages(lib_status)
         layout["yaxis"]["title"] = "Minutes"
         layout["yaxis"]["zeroline"] = False
         layout["title"]["text"] = "Time Since last upload"
-        rendered_js = js_template.render(
-            plotname="upload-ages", data=data, layout=layout
-        )
-        with open("librarian.js", "a") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("upload-ages", data, layout)
 
-        data = do_disk_space(session, cutoff)
+        data = do_disk_space(lib_status)
         layout["yaxis"]["title"] = "Data Volume [GiB]"
         layout["yaxis"]["zeroline"] = True
         layout["yaxis2"] = {
@@ -479,44 +551,26 @@ def main():
         }
         layout["title"]["text"] = "Disk Usage"
 
-        rendered_js = js_template.render(
-            plotname="disk-space", data=data, layout=layout
-        )
-        with open("librarian.js", "a") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("disk-space", data, layout)
 
         layout.pop("yaxis2", None)
-        data = do_bandwidths(session, cutoff)
+        data = do_bandwidths(remote_status)
         layout["yaxis"]["title"] = "MB/s"
         layout["title"]["text"] = "Librarian Transfer Rates"
-        rendered_js = js_template.render(
-            plotname="bandwidths", data=data, layout=layout
-        )
-        with open("librarian.js", "a") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("bandwidths", data, layout)
 
-        data = do_num_files(session, cutoff)
+        data = do_num_files(lib_status)
         layout["yaxis"]["title"] = "Number"
         layout["yaxis"]["zeroline"] = False
         layout["title"]["text"] = "Total Number of Files in Librarian"
-        rendered_js = js_template.render(plotname="num-files", data=data, layout=layout)
-        with open("librarian.js", "a") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("num-files", data, layout)
 
-        data = do_ping_times(session, cutoff)
+        data = do_ping_times(remote_status)
         layout["yaxis"]["title"] = "ms"
         layout["yaxis"]["rangemode"] = "tozero"
         layout["yaxis"]["zeroline"] = True
         layout["title"]["text"] = "Server Ping Times"
-        rendered_js = js_template.render(
-            plotname="ping-times", data=data, layout=layout
-        )
-        with open("librarian.js", "a") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("ping-times", data, layout)
 
         data = do_compare_file_types(TIME_WINDOW)
         if data is not None:
@@ -524,12 +578,7 @@ def main():
             layout["yaxis"]["zeroline"] = True
             layout["margin"]["l"] = 60
             layout["title"]["text"] = "Files in <b>Temporary Staging</b>"
-            rendered_js = js_template.render(
-                plotname="file-compare", data=data, layout=layout
-            )
-            with open("librarian.js", "a") as js_file:
-                js_file.write(rendered_js)
-                js_file.write("\n\n")
+            bundle.add("file-compare", data, layout)
 
         tables = []
         tables.append(do_raid_errors(session, cutoff))
@@ -575,8 +624,6 @@ def main():
             title="Librarian",
             plotstyle="height: 24.5%",
             colsize=colsize,
-            gen_date=now.iso,
-            gen_time_unix_ms=now.unix * 1000,
             js_name="librarian",
             hostname=computer_hostname,
             scriptname=os.path.basename(__file__),
@@ -584,7 +631,10 @@ def main():
             caption=caption,
         )
 
-        with open("librarian.html", "w") as h_file:
+        with publish.publish("librarian.js") as js_file:
+            bundle.write(js_file, bundle_template)
+
+        with publish.publish("librarian.html") as h_file:
             h_file.write(rendered_html)
 
 
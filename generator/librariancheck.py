@@ -8,6 +8,8 @@ from astropy.time import Time
 from hera_librarian import LibrarianClient
 from jinja2 import Environment, FileSystemLoader
 
+import publish
+
 connection_name = ['aoc-manual', 'local-rtp']
 
 search = '''
@@ -16,6 +18,7 @@ search = '''
 }'''
 
 
+@publish.batched
 def main():
     if platform.python_version().startswith('3'):
         hostname = os.uname().nodename
@@ -81,13 +84,11 @@ def main():
     template = env.get_template("tables_with_footer.html")
     rendered_html = template.render(
         tables=tables,
-        gen_date=Time.now().iso,
-        gen_time_unix_ms=Time.now().unix * 1000,
         scriptname=os.path.basename(__file__),
         hostname=hostname,
     )
 
-    with open("librariancheck.html", "w") as h_file:
+    with publish.publish("librariancheck.html") as h_file:
         h_file.write(rendered_html)
 
 
@@ -0,0 +1,271 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""Incremental local cache of the M&C time series behind the trend pages.
+
+The trend pages plot the last 14 days of a table but refresh every 10
+minutes, so nearly every row they need was already fetched by the previous
+run. Each series is stored as columns in one ``.npz`` file; a run only
+queries the rows newer than the cached ones (minus a small overlap, to pick
+up rows which arrived late), appends them and drops rows which fell out of
+the window. A missing or unreadable file is simply rebuilt from M&C.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import numpy as np
+import sqlalchemy
+
+DEFAULT_CACHE_DIR = "dashboard_cache"
+# seconds of already cached data queried again on every update
+DEFAULT_OVERLAP = 600.0
+
+
+def add_cache_arguments(parser):
+    """Add the --cache-dir and --no-cache options to an argument parser."""
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help=(
+            "Directory caching the M&C time series between runs, "
+            'defaults to "{}"'.format(DEFAULT_CACHE_DIR)
+        ),
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache_dir",
+        action="store_const",
+        const=None,
+        help="Query the full time window from M&C without using the cache.",
+    )
+
+
+def rows_to_columns(rows, dtypes):
+    """Split query result rows into a dictionary of numpy arrays.
+
+    Parameters
+    ----------
+    rows : list of tuple
+        Rows returned by a query.
+    dtypes : list of tuple
+        (name, dtype) of each column of the rows, in order. None values in
+        float columns become NaN.
+
+    Returns
+    -------
+    dict
+        Dictionary of arrays keyed by column name.
+
+    """
+    return {
+        name: np.array([row[ind] for row in rows], dtype=dtype)
+        for ind, (name, dtype) in enumerate(dtypes)
+    }
+
+
+def _load(filename):
+    try:
+        with np.load(filename) as npz:
+            return {key: npz[key] for key in npz.files}
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _save(filename, columns):
+    # write then rename so a killed run never leaves a truncated cache
+    tmp_filename = filename + ".tmp.npz"
+    np.savez(tmp_filename, **columns)
+    os.rename(tmp_filename, filename)
+
+
+def cached_columns(
+    cache_dir,
+    name,
+    fetch,
+    cutoff,
+    overlap=DEFAULT_OVERLAP,
+    time_column="time",
+    aggregate="none",
+    bucket=None,
+):
+    """Get the columns of a time series, only querying rows not cached yet.
+
+    Parameters
+    ----------
+    cache_dir : str or None
+        Directory holding the cache files. If None the whole window is
+        fetched and nothing is cached.
+    name : str
+        Unique name of the series, used as the cache file name.
+    fetch : callable
+        ``fetch(since)`` returns the columns (as from `rows_to_columns`) of
+        every row with a time greater than `since` GPS seconds, ordered by
+        time.
+    cutoff : float
+        GPS seconds of the start of the window, older rows are dropped.
+    overlap : float
+        Seconds before the newest cached row which are queried again,
+        replacing the cached rows, to catch rows inserted late.
+    time_column : str
+        Name of the column holding the GPS time of each row.
+    aggregate : str
+        Aggregation mode of `fetch`, see `fetch_bucketed`. Aggregated
+        series are cached separately from the raw rows.
+    bucket : int
+        Bucket length in seconds if `aggregate` is not "none". At least one
+        full bucket is queried again on every update.
+
+    Returns
+    -------
+    dict
+        Dictionary of column arrays for every row newer than `cutoff`.
+
+    """
+    if cache_dir is None:
+        return fetch(cutoff)
+
+    if aggregate != "none":
+        name = "{name}_{aggregate}{bucket:d}".format(
+            name=name, aggregate=aggregate, bucket=bucket
+        )
+        overlap = max(overlap, bucket)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    filename = os.path.join(cache_dir, name + ".npz")
+
+    cached = _load(filename)
+    if cached is None or time_column not in cached or cached[time_column].size == 0:
+        cached = None
+        since = cutoff
+    else:
+        since = max(cutoff, float(cached[time_column].max()) - overlap)
+
+    new = fetch(since)
+    if cached is None or set(cached) != set(new):
+        if cached is not None:
+            # the columns changed, start over
+            new = fetch(cutoff)
+        columns = new
+    else:
+        times = cached[time_column]
+        keep = (times > cutoff) & (times <= since)
+        columns = {key: np.concatenate([cached[key][keep], new[key]]) for key in new}
+
+    _save(filename, columns)
+    return columns
+
+
+def add_aggregate_arguments(parser):
+    """Add the --aggregate and --points options to an argument parser."""
+    parser.add_argument(
+        "--aggregate",
+        dest="aggregate",
+        choices=["none", "mean", "minmax"],
+        default="none",
+        help=(
+            "Reduce each series in the database to time buckets, plotting "
+            "either the mean or the min and max of each bucket. "
+            'Defaults to "none", plotting every row.'
+        ),
+    )
+    parser.add_argument(
+        "--points",
+        dest="points",
+        type=int,
+        default=500,
+        help=(
+            "Number of time buckets covering the plotted window when "
+            "aggregating, defaults to 500."
+        ),
+    )
+
+
+def bucket_size(window, npoints):
+    """Get the bucket length in whole seconds splitting `window` seconds."""
+    return max(1, int(np.ceil(window / npoints)))
+
+
+def fetch_bucketed(
+    session, time_column, groups, values, since, bucket, mode="mean", filters=()
+):
+    """Query the values aggregated per group in time buckets.
+
+    Rows are grouped on ``floor(time / bucket)`` in the database, so only one
+    (or two) rows per bucket are transferred. Only buckets whose center is
+    after `since` are returned, and each of them is aggregated over all of
+    its rows, so the result can be appended to a `cached_columns` cache.
+
+    Parameters
+    ----------
+    session : MCSession
+        Session used to query the database.
+    time_column : sqlalchemy column
+        Column holding the GPS time of the rows.
+    groups : list of tuple
+        (name, column, dtype) of the columns each series is grouped by,
+        e.g. the hostname.
+    values : list of tuple
+        (name, column) of the columns to aggregate.
+    since : float
+        GPS seconds after which buckets are returned.
+    bucket : int
+        Length of the buckets in seconds.
+    mode : str
+        "mean" returns one row per bucket with the average values. "minmax"
+        returns two rows per bucket, with the minimum then the maximum
+        values, so spikes stay visible when plotted as a line.
+    filters : list
+        Extra filter expressions applied to the query.
+
+    Returns
+    -------
+    dict
+        Dictionary of arrays keyed by column name, with the bucket centers
+        under "time", ordered by time.
+
+    """
+    index = sqlalchemy.func.floor(time_column / bucket).label("bucket")
+    group_columns = [column for _, column, _ in groups]
+    aggregates = []
+    for _, column in values:
+        if mode == "minmax":
+            aggregates += [sqlalchemy.func.min(column), sqlalchemy.func.max(column)]
+        else:
+            aggregates.append(sqlalchemy.func.avg(column))
+
+    query = session.query(index, *(group_columns + aggregates)).filter(
+        time_column >= np.floor(since / bucket) * bucket
+    )
+    for expression in filters:
+        query = query.filter(expression)
+    rows = query.group_by(index, *group_columns).order_by(index, *group_columns).all()
+
+    dtypes = [("time", float)]
+    dtypes += [(name, dtype) for name, _, dtype in groups]
+    if mode == "minmax":
+        for name, _ in values:
+            dtypes += [(name + "_min", float), (name + "_max", float)]
+    else:
+        dtypes += [(name, float) for name, _ in values]
+    columns = rows_to_columns(rows, dtypes)
+    columns["time"] = (columns["time"] + 0.5) * bucket
+
+    # drop the bucket straddling `since`, it is already cached
+    keep = columns["time"] > since
+    columns = {key: val[keep] for key, val in columns.items()}
+
+    if mode == "minmax":
+        # interleave the min and max of each bucket into one series
+        for name, _ in values:
+            envelope = np.empty(2 * columns["time"].size, dtype=float)
+            envelope[0::2] = columns.pop(name + "_min")
+            envelope[1::2] = columns.pop(name + "_max")
+            columns[name] = envelope
+        for key in ["time"] + [name for name, _, _ in groups]:
+            columns[key] = np.repeat(columns[key], 2)
+    return columns
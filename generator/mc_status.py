@@ -0,0 +1,293 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""Bulk M&C lookups of the antenna status and hookup of every station.
+
+The hera_mc session helpers answer one antenna or station per call, which
+costs several round trips per antenna on every page update. These helpers
+fetch the same information for the whole array with a fixed number of
+queries and return it as arrays aligned with the requested antennas.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import re
+import warnings
+import numpy as np
+from sqlalchemy import and_, func
+from hera_mc import cm_hookup
+from hera_mc.correlator import AntennaStatus, SNAPStatus
+
+import antenna_index
+
+# the hookup part types resolved by `get_station_hookup`
+HOOKUP_PART_TYPES = ["snap", "post-amp", "node"]
+
+
+def get_latest_antenna_status(session, antennas=None):
+    """Get the most recent AntennaStatus of every antpol in a single query.
+
+    Parameters
+    ----------
+    session : MCSession
+        Session used to query the database.
+    antennas : array_like of int, optional
+        Antenna numbers to get the status of, defaults to every antenna.
+
+    Returns
+    -------
+    list of AntennaStatus
+        The latest status row of each antpol, ordered by antenna number
+        then polarization.
+
+    """
+    latest = session.query(
+        AntennaStatus.antenna_number,
+        AntennaStatus.antenna_feed_pol,
+        func.max(AntennaStatus.time).label("time"),
+    )
+    if antennas is not None:
+        latest = latest.filter(
+            AntennaStatus.antenna_number.in_([int(ant) for ant in antennas])
+        )
+    latest = latest.group_by(
+        AntennaStatus.antenna_number, AntennaStatus.antenna_feed_pol
+    ).subquery()
+
+    return (
+        session.query(AntennaStatus)
+        .join(
+            latest,
+            and_(
+                AntennaStatus.antenna_number == latest.c.antenna_number,
+                AntennaStatus.antenna_feed_pol == latest.c.antenna_feed_pol,
+                AntennaStatus.time == latest.c.time,
+            ),
+        )
+        .order_by(AntennaStatus.antenna_number, AntennaStatus.antenna_feed_pol)
+        .all()
+    )
+
+
+def get_mc_inputs(session, columns=()):
+    """Read the values which identify the M&C records shown by a page.
+
+    The M&C counterpart of `run_state.get_correlator_inputs`: pages
+    skipping runs while the correlator inputs are unchanged still have to
+    be updated when these change.
+
+    Parameters
+    ----------
+    session : MCSession
+        Session used to query the database.
+    columns : list of sqlalchemy columns
+        GPS time columns of the records shown, e.g. ``AntennaStatus.time``.
+
+    Returns
+    -------
+    list of float
+        The station and hookup state from `antenna_index.get_mc_state`,
+        the time of the next scheduled hookup change and the latest time of
+        each column, None where a table is empty.
+
+    """
+    state, valid_until = antenna_index.get_mc_state(session)
+    # one query per table, they cannot be joined
+    latest = [session.query(func.max(column)).scalar() for column in columns]
+    return (
+        state + [valid_until] + [None if val is None else float(val) for val in latest]
+    )
+
+
+def parse_list_strings(strings):
+    """Parse list-like strings of numbers into the rows of one array.
+
+    M&C stores arrays such as the ADC histograms as text like "[1, 2, 3]".
+    All of the strings are parsed in a single pass, unless one of them is
+    malformed, then they are parsed one by one.
+
+    Parameters
+    ----------
+    strings : list of str
+        Strings of comma separated numbers, optionally within brackets.
+
+    Returns
+    -------
+    ndarray of float
+        Array of shape (len(strings), longest length), rows of shorter
+        strings are padded with NaN. Rows of strings which cannot be parsed
+        (e.g. "None" or "1,2,") are all NaN.
+
+    """
+    strings = [(string or "").strip("[] ") for string in strings]
+    lengths = np.array(
+        [string.count(",") + 1 if string else 0 for string in strings], dtype=int
+    )
+    try:
+        with warnings.catch_warnings():
+            # older numpy only warns about unparsed text
+            warnings.simplefilter("error", DeprecationWarning)
+            values = np.fromstring(
+                ",".join(string for string in strings if string), sep=","
+            )
+    except (ValueError, DeprecationWarning):
+        values = None
+
+    parsed = np.full((len(strings), lengths.max(initial=0)), np.nan)
+    if values is not None and values.size == lengths.sum():
+        parsed[np.arange(parsed.shape[1]) < lengths[:, np.newaxis]] = values
+        return parsed
+
+    for row, string in zip(parsed, strings):
+        if not string:
+            continue
+        try:
+            row[: string.count(",") + 1] = [float(val) for val in string.split(",")]
+        except ValueError:
+            pass
+    return parsed
+
+
+def get_snap_hostnames(session, serials=None):
+    """Get the latest reported hostname of each SNAP in a single query.
+
+    Parameters
+    ----------
+    session : MCSession
+        Session used to query the database.
+    serials : array_like of str, optional
+        SNAP serial numbers to look up, defaults to every SNAP.
+
+    Returns
+    -------
+    dict
+        Hostname keyed by serial number.
+
+    """
+    latest = session.query(
+        SNAPStatus.serial_number, func.max(SNAPStatus.time).label("time")
+    )
+    if serials is not None:
+        latest = latest.filter(SNAPStatus.serial_number.in_(list(serials)))
+    latest = latest.group_by(SNAPStatus.serial_number).subquery()
+
+    rows = (
+        session.query(SNAPStatus.serial_number, SNAPStatus.hostname)
+        .join(
+            latest,
+            and_(
+                SNAPStatus.serial_number == latest.c.serial_number,
+                SNAPStatus.time == latest.c.time,
+            ),
+        )
+        .all()
+    )
+    return {serial: hostname for serial, hostname in rows if hostname is not None}
+
+
+def get_station_parts(session, stations, part_types, at_date="now"):
+    """Get the parts of the given types hooked up to each station.
+
+    The hookup of every station is resolved with a single `get_hookup` call.
+
+    Parameters
+    ----------
+    session : MCSession
+        Session used to query the database.
+    stations : list of str
+        Station names, e.g. "HH12".
+    part_types : list of str
+        Part types to find, e.g. "snap" or "node".
+    at_date : anything interpretable by cm_utils.get_astropytime
+        Date of the hookup.
+
+    Returns
+    -------
+    dict
+        {station: {part_type: {pol_key: part_number or None}}}. Stations
+        without a hookup are missing.
+
+    """
+    hookup = cm_hookup.Hookup(session)
+    hookup_dict = hookup.get_hookup(
+        hpn=list(stations), pol="all", at_date=at_date, exact_match=True
+    )
+    parts = {}
+    for key, entry in hookup_dict.items():
+        # keys are "station:rev"
+        station = key.split(":")[0]
+        parts[station] = {
+            part_type: entry.get_part_from_type(part_type) for part_type in part_types
+        }
+    return parts
+
+
+def part_for_pol(part_info, pol):
+    """Get the part hooked up to the feed polarization `pol`, or None."""
+    pol_keys = [key for key in part_info.keys() if pol.upper() in key]
+    if pol_keys:
+        return part_info[pol_keys[0]]
+    # a hacky solution for a key that should work
+    return part_info.get("E<ground")
+
+
+def part_index(part, prefix):
+    """Get the number of a part named like "<prefix><number>", -1 if None."""
+    if part is None:
+        return -1
+    return int(re.findall(prefix + r"(\d+)", part)[0])
+
+
+def get_station_hookup(session, ants, antnames, at_date="now"):
+    """Resolve the SNAP, PAM and node of many antennas at once.
+
+    Parameters
+    ----------
+    session : MCSession
+        Session used to query the database.
+    ants : array_like of int
+        Antenna numbers to resolve.
+    antnames : array_like of str
+        Station name of every antenna, indexed by antenna number.
+    at_date : anything interpretable by cm_utils.get_astropytime
+        Date of the hookup.
+
+    Returns
+    -------
+    dict
+        Arrays aligned with `ants`: "snap_serial" and "hostname" (objects,
+        "No\\tData" when unknown), "pam" and "node" (ints, -1 when unknown).
+        The east feed hookup is used for every antenna.
+
+    """
+    nants = len(ants)
+    hookup = {
+        "snap_serial": np.full(nants, "No\tData", dtype=object),
+        "hostname": np.full(nants, "No\tData", dtype=object),
+        "pam": np.full(nants, -1, dtype=int),
+        "node": np.full(nants, -1, dtype=int),
+    }
+    station_names = [antnames[int(ant)] for ant in ants]
+    parts = get_station_parts(session, station_names, HOOKUP_PART_TYPES, at_date)
+
+    for ant_cnt, name in enumerate(station_names):
+        if name not in parts:
+            continue
+        snap = part_for_pol(parts[name]["snap"], "e")
+        if snap is not None:
+            hookup["snap_serial"][ant_cnt] = snap
+        hookup["pam"][ant_cnt] = part_index(
+            part_for_pol(parts[name]["post-amp"], "e"), "PAM"
+        )
+        hookup["node"][ant_cnt] = part_index(
+            part_for_pol(parts[name]["node"], "e"), "N"
+        )
+
+    # only antennas with a node mapping get a hostname, as before
+    serials = hookup["snap_serial"][hookup["node"] >= 0]
+    hostnames = get_snap_hostnames(session, np.unique(serials.astype(str)))
+    for ant_cnt, serial in enumerate(hookup["snap_serial"]):
+        if hookup["node"][ant_cnt] >= 0 and serial in hostnames:
+            hookup["hostname"][ant_cnt] = hostnames[serial]
+    return hookup
@@ -0,0 +1,240 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""Compact encodings for the numeric arrays of Plotly traces.
+
+Writing arrays as JSON number lists costs ~18 bytes per value and repeats
+shared axes in every trace. Instead arrays are written as base64 encoded
+little-endian typed arrays::
+
+    {"dtype": "f4", "bdata": "..."}
+
+or, when some precision can be given up, as int16 values quantized to a
+fixed step::
+
+    {"dtype": "i2", "bdata": "...", "scale": 0.01, "offset": -20.0}
+
+Arrays common to many traces (e.g. a frequency axis) are written once in
+a ``shared`` dictionary and referenced from the traces as
+``{"shared_ref": "<name>"}``. ``templates/plotly_base.js`` decodes all of
+these back into javascript typed arrays before plotting.
+
+Plots with many traces or points are switched to WebGL (``scattergl``)
+traces by `use_webgl`, as SVG traces become slow to pan, hover and restyle.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import base64
+import numpy as np
+
+# int16 value reserved to mark NaN in quantized arrays
+QUANTIZED_NAN = -32768
+# above either limit a plot is drawn with WebGL instead of SVG traces
+DEFAULT_WEBGL_TRACES = 200
+DEFAULT_WEBGL_POINTS = 200000
+# bytes per value of the encoded dtypes
+_ITEMSIZE = {"f4": 4, "i2": 2}
+
+
+def _b64(array):
+    return base64.b64encode(array.tobytes()).decode("ascii")
+
+
+def encode_array(array):
+    """Encode a numeric array as a base64 float32 typed array.
+
+    Parameters
+    ----------
+    array : array_like
+        Values to encode, flattened.
+
+    Returns
+    -------
+    dict
+        The encoded payload.
+
+    """
+    array = np.ascontiguousarray(array, dtype="<f4").ravel()
+    return {"dtype": "f4", "bdata": _b64(array)}
+
+
+def encode_quantized(array, step=0.01):
+    """Encode a numeric array as int16 values quantized to a fixed step.
+
+    Values are stored relative to the midpoint of their range, so any set of
+    values spanning less than ``65534 * step`` is represented to within
+    ``step / 2``. NaNs are preserved.
+
+    Parameters
+    ----------
+    array : array_like
+        Values to encode, flattened.
+    step : float
+        Quantization step, e.g. 0.01 for dB values.
+
+    Returns
+    -------
+    dict
+        The encoded payload.
+
+    """
+    array = np.asarray(array, dtype=np.float64).ravel()
+    finite = np.isfinite(array)
+    if np.any(finite):
+        offset = float(
+            np.round((array[finite].max() + array[finite].min()) / 2.0 / step) * step
+        )
+    else:
+        offset = 0.0
+
+    quantized = np.full(array.shape, QUANTIZED_NAN, dtype="<i2")
+    quantized[finite] = np.clip(
+        np.round((array[finite] - offset) / step), QUANTIZED_NAN + 1, 32767
+    )
+    return {"dtype": "i2", "bdata": _b64(quantized), "scale": step, "offset": offset}
+
+
+def shared_ref(name):
+    """Reference an array stored in the shared dictionary."""
+    return {"shared_ref": name}
+
+
+def minmax_decimate(x, y, npoints):
+    """Reduce spectra to a min/max envelope of about `npoints` points.
+
+    The channels are split into ``npoints // 2`` contiguous bins and each bin
+    is replaced by its minimum and maximum, both placed at the bin center.
+    Unlike plain subsampling or averaging, narrow RFI spikes and the band
+    edges stay visible in the plot.
+
+    Parameters
+    ----------
+    x : array_like
+        1-D channel axis, e.g. frequencies.
+    y : array_like
+        Spectra of shape (..., x.size). NaNs are ignored unless a whole bin
+        is NaN.
+    npoints : int
+        Target number of points per spectrum.
+
+    Returns
+    -------
+    x : ndarray
+        Decimated axis of size ``2 * (npoints // 2)``.
+    y : ndarray
+        Decimated spectra, shape (..., 2 * (npoints // 2)).
+        The inputs are returned unchanged if they already have no more than
+        `npoints` channels.
+
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    nbins = npoints // 2
+    if nbins < 1 or 2 * nbins >= x.size:
+        return x, y
+
+    starts = np.linspace(0, x.size, nbins + 1).astype(int)[:-1]
+    counts = np.diff(np.append(starts, x.size))
+    centers = np.add.reduceat(x, starts) / counts
+
+    envelope = np.empty(y.shape[:-1] + (2 * nbins,), dtype=y.dtype)
+    envelope[..., 0::2] = np.fmin.reduceat(y, starts, axis=-1)
+    envelope[..., 1::2] = np.fmax.reduceat(y, starts, axis=-1)
+    return np.repeat(centers, 2), envelope
+
+
+def payload_size(value, shared=None):
+    """Get the number of values of an array as written in a trace.
+
+    Parameters
+    ----------
+    value : dict, list or ndarray
+        An encoded payload, a shared reference or a plain array.
+    shared : dict, optional
+        The shared arrays the references point to.
+
+    Returns
+    -------
+    int
+        The number of values, 0 for anything else.
+
+    """
+    if isinstance(value, dict):
+        if "shared_ref" in value:
+            return payload_size((shared or {}).get(value["shared_ref"]), shared)
+        if "bdata" in value:
+            nbytes = len(value["bdata"]) * 3 // 4 - value["bdata"].count("=")
+            return nbytes // _ITEMSIZE[value["dtype"]]
+        return 0
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return len(value)
+    return 0
+
+
+def use_webgl(
+    traces,
+    layout,
+    shared=None,
+    max_traces=DEFAULT_WEBGL_TRACES,
+    max_points=DEFAULT_WEBGL_POINTS,
+):
+    """Draw scatter traces with WebGL if a plot has too many to draw as SVG.
+
+    The traces are changed in place, so buttons restyling them by index
+    (e.g. the node dropdowns setting "visible") keep working.
+
+    Parameters
+    ----------
+    traces : list of dict
+        The Plotly traces of one plot.
+    layout : dict
+        The layout of the plot. Hovering is switched to the closest point,
+        as hovering every trace at once is slow with WebGL.
+    shared : dict, optional
+        The shared arrays referenced by the traces.
+    max_traces : int
+        Number of traces above which WebGL is used.
+    max_points : int
+        Total number of points above which WebGL is used.
+
+    Returns
+    -------
+    bool
+        True if the traces were switched to WebGL.
+
+    """
+    npoints = sum(payload_size(trace.get("y"), shared) for trace in traces)
+    if len(traces) <= max_traces and npoints <= max_points:
+        return False
+
+    for trace in traces:
+        if trace.get("type", "scatter") == "scatter":
+            trace["type"] = "scattergl"
+    layout["hovermode"] = "closest"
+    return True
+
+
+def add_webgl_arguments(parser):
+    """Add the command line options of `use_webgl` to a parser."""
+    parser.add_argument(
+        "--webgl-traces",
+        dest="webgl_traces",
+        type=int,
+        default=DEFAULT_WEBGL_TRACES,
+        help=(
+            "Draw plots with more traces than this with WebGL, "
+            "defaults to {:d}.".format(DEFAULT_WEBGL_TRACES)
+        ),
+    )
+    parser.add_argument(
+        "--webgl-points",
+        dest="webgl_points",
+        type=int,
+        default=DEFAULT_WEBGL_POINTS,
+        help=(
+            "Draw plots with more points than this with WebGL, "
+            "defaults to {:d}.".format(DEFAULT_WEBGL_POINTS)
+        ),
+    )
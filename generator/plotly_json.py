@@ -0,0 +1,255 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""Stream Plotly traces holding numpy arrays into the page javascript.
+
+Rendering the traces with jinja's ``tojson`` needs every array converted to
+a list first and builds the whole JSON document as one string. Instead
+`write_plotly_js` renders ``templates/plotly_base.js`` around a placeholder
+and writes the traces into the file piece by piece, formatting numpy arrays
+in chunks with a fixed number of significant digits per field.
+
+Arrays may be plain, masked (masked values become null) or hold strings.
+NaN and infinite values are written as null, which Plotly shows as gaps.
+
+Pages with many plots collect them in a `PlotBundle`, which writes a single
+javascript file from ``templates/plotly_bundle.js``: the decoding helpers
+and the layout shared by the plots appear once, and every plot only lists
+the layout keys it changes.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import copy
+import json
+import numpy as np
+
+# marks where the streamed traces go in the rendered template
+DATA_PLACEHOLDER = "/* plotly streamed data */"
+# significant digits of float fields without an explicit precision
+DEFAULT_PRECISION = 7
+# number of array elements formatted at once
+CHUNK_SIZE = 4096
+
+
+def _write_numeric(array, outfile, digits):
+    if array.dtype.kind == "b":
+        fmt = None
+    elif array.dtype.kind in "iu":
+        fmt = "%d"
+    else:
+        fmt = "%.{:d}g".format(digits)
+
+    outfile.write("[")
+    for start in range(0, array.size, CHUNK_SIZE):
+        chunk = array[start : start + CHUNK_SIZE]
+        if fmt is None:
+            strings = np.where(chunk, "true", "false").astype(object)
+        else:
+            strings = np.char.mod(fmt, chunk).astype(object)
+            if fmt != "%d":
+                strings[~np.isfinite(chunk)] = "null"
+        if start > 0:
+            outfile.write(",")
+        outfile.write(",".join(strings))
+    outfile.write("]")
+
+
+def _write_array(array, outfile, digits):
+    if isinstance(array, np.ma.MaskedArray):
+        mask = np.ma.getmaskarray(array)
+        if np.any(mask):
+            if array.dtype.kind in "fc":
+                array = array.astype(np.float64).filled(np.nan)
+            else:
+                filled = array.data.astype(object)
+                filled[mask] = None
+                array = filled
+        else:
+            array = array.data
+    if array.ndim == 0:
+        write_json(array.item(), outfile, digits)
+    elif array.ndim > 1:
+        outfile.write("[")
+        for row_cnt, row in enumerate(array):
+            if row_cnt > 0:
+                outfile.write(",")
+            _write_array(row, outfile, digits)
+        outfile.write("]")
+    elif array.dtype.kind in "biuf":
+        _write_numeric(array, outfile, digits)
+    else:
+        # strings, datetimes and objects are written element by element
+        outfile.write("[")
+        for item_cnt, item in enumerate(array.tolist()):
+            if item_cnt > 0:
+                outfile.write(",")
+            write_json(item, outfile, digits)
+        outfile.write("]")
+
+
+def write_json(obj, outfile, precision=None):
+    """Write an object holding numpy arrays as JSON to an open file.
+
+    Parameters
+    ----------
+    obj : dict, list, ndarray or scalar
+        Object to write. Dictionary keys must be strings, they are written
+        sorted like jinja's ``tojson`` does.
+    outfile : file
+        Open text file to write into.
+    precision : int or dict, optional
+        Significant digits of float values. A dict gives the digits per
+        dictionary key (e.g. ``{"x": 6, "y": 4}``), applying to everything
+        below that key; other values use `DEFAULT_PRECISION`.
+
+    """
+    if isinstance(precision, dict):
+        digits = DEFAULT_PRECISION
+        field_digits = precision
+    else:
+        digits = DEFAULT_PRECISION if precision is None else precision
+        field_digits = {}
+    _write(obj, outfile, digits, field_digits)
+
+
+def _write(obj, outfile, digits, field_digits):
+    if isinstance(obj, dict):
+        outfile.write("{")
+        for item_cnt, (key, val) in enumerate(sorted(obj.items())):
+            if item_cnt > 0:
+                outfile.write(",")
+            outfile.write(json.dumps(key) + ":")
+            _write(val, outfile, field_digits.get(key, digits), field_digits)
+        outfile.write("}")
+    elif isinstance(obj, (list, tuple)):
+        outfile.write("[")
+        for item_cnt, item in enumerate(obj):
+            if item_cnt > 0:
+                outfile.write(",")
+            _write(item, outfile, digits, field_digits)
+        outfile.write("]")
+    elif obj is np.ma.masked:
+        outfile.write("null")
+    elif isinstance(obj, np.ndarray):
+        _write_array(obj, outfile, digits)
+    elif isinstance(obj, (float, np.floating)):
+        if np.isfinite(obj):
+            outfile.write("%.{:d}g".format(digits) % obj)
+        else:
+            outfile.write("null")
+    elif isinstance(obj, np.generic):
+        outfile.write(json.dumps(obj.item()))
+    else:
+        outfile.write(json.dumps(obj))
+
+
+def write_plotly_js(outfile, template, data, precision=None, **context):
+    """Render a plotly template into a file, streaming the traces.
+
+    Parameters
+    ----------
+    outfile : file
+        Open text file to write into.
+    template : jinja2.Template
+        Template with a ``streamed_data`` placeholder, e.g. plotly_base.js.
+    data : list of dict
+        The Plotly traces, may hold numpy arrays.
+    precision : int or dict, optional
+        Significant digits of the float values, see `write_json`.
+    context
+        Other variables used to render the template, e.g. the layout.
+
+    """
+    rendered = template.render(streamed_data=DATA_PLACEHOLDER, **context)
+    head, tail = rendered.split(DATA_PLACEHOLDER, 1)
+    outfile.write(head)
+    write_json(data, outfile, precision=precision)
+    outfile.write(tail)
+
+
+def layout_overrides(base, layout):
+    """Get the keys of a Plotly layout which differ from a base layout.
+
+    Parameters
+    ----------
+    base : dict
+        The shared layout.
+    layout : dict
+        The layout of one plot.
+
+    Returns
+    -------
+    dict
+        Nested dict of the changed keys. Keys missing from `layout` map to
+        None, which removes them from the base layout when merged.
+
+    """
+    overrides = {}
+    for key in sorted(set(base) | set(layout)):
+        if key not in layout:
+            overrides[key] = None
+        elif key not in base:
+            overrides[key] = copy.deepcopy(layout[key])
+        elif isinstance(base[key], dict) and isinstance(layout[key], dict):
+            nested = layout_overrides(base[key], layout[key])
+            if nested:
+                overrides[key] = nested
+        elif base[key] != layout[key]:
+            overrides[key] = copy.deepcopy(layout[key])
+    return overrides
+
+
+class PlotBundle(object):
+    """Plots sharing a layout, written to one javascript file.
+
+    Parameters
+    ----------
+    layout : dict
+        Plotly layout shared by the plots, copied when the bundle is made.
+
+    """
+
+    def __init__(self, layout):
+        self.layout = copy.deepcopy(layout)
+        self.plots = []
+
+    def add(self, plotname, data, layout):
+        """Add a plot to the bundle.
+
+        Parameters
+        ----------
+        plotname : str
+            Id of the div the plot is drawn in.
+        data : list of dict
+            The Plotly traces, may hold numpy arrays.
+        layout : dict
+            Full layout of this plot. Only its differences from the shared
+            layout are kept, so the caller may keep modifying it.
+
+        """
+        self.plots.append(
+            {
+                "plotname": plotname,
+                "data": data,
+                "layout": layout_overrides(self.layout, layout),
+            }
+        )
+
+    def write(self, outfile, template, precision=None):
+        """Write every plot of the bundle into an open file.
+
+        Parameters
+        ----------
+        outfile : file
+            Open text file to write into.
+        template : jinja2.Template
+            The plotly_bundle.js template.
+        precision : int or dict, optional
+            Significant digits of the float values, see `write_json`.
+
+        """
+        write_plotly_js(
+            outfile, template, self.plots, precision=precision, layout=self.layout
+        )
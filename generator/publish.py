@@ -0,0 +1,420 @@
+#! /usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""Atomically publish the generated pages with precompressed copies.
+
+The pages are copied to the web server while the generators may still be
+writing them. `publish` writes into a temporary file next to the output,
+syncs it to disk and only then renames it over the output, so a reader
+sees either the previous or the new file, never a partial one.
+
+Every published file also gets a gzip compressed ``<name>.gz`` sibling
+(and ``<name>.br`` if the ``brotli`` package is installed), which nginx
+serves directly with ``gzip_static on`` instead of compressing the large
+javascript files on every request.
+
+The SHA-256 hash and generation time of each file are recorded in
+``manifest.json`` in the output directory. A file whose content did not
+change is not rewritten, only its generation time is updated; the pages
+read that time from the manifest, so it is not part of their content.
+The generators decorate their ``main`` with `batched`, so the manifest is
+read once per run and its entries are all written at the end.
+Running this module lists the files changed since the last upload, which
+are recorded as uploaded by a second call once they were copied::
+
+    python publish.py --outdir html > changed.txt
+    rsync --files-from=changed.txt html/ server:html/
+    python publish.py --outdir html --mark-uploaded
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+import time
+import fcntl
+import gzip
+import shutil
+import hashlib
+import argparse
+import tempfile
+import functools
+import contextlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+# permissions of the published files, mkstemp only allows the owner
+FILE_MODE = 0o644
+# relative to the directory the generators are run in
+MANIFEST_FILE = "manifest.json"
+DEFAULT_UPLOADED_FILE = "uploaded_manifest.json"
+COMPRESSED_SUFFIXES = [".gz", ".br"]
+
+# the open batches, see `batch`
+_batches = []
+
+
+def _temp_file(filename, mode):
+    directory, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp_name = tempfile.mkstemp(prefix="." + basename + ".", dir=directory)
+    return os.fdopen(fd, mode), tmp_name
+
+
+def _commit(outfile, tmp_name, filename):
+    outfile.flush()
+    os.fsync(outfile.fileno())
+    outfile.close()
+    os.chmod(tmp_name, FILE_MODE)
+    os.rename(tmp_name, filename)
+
+
+@contextlib.contextmanager
+def _atomic_file(filename, mode):
+    outfile, tmp_name = _temp_file(filename, mode)
+    try:
+        yield outfile
+        _commit(outfile, tmp_name, filename)
+    except BaseException:
+        outfile.close()
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+def write_compressed(source, filename):
+    """Write the precompressed siblings of a file.
+
+    Parameters
+    ----------
+    source : str
+        File holding the content to compress.
+    filename : str
+        Name of the published file, the siblings are named
+        ``<filename>.gz`` and ``<filename>.br``.
+
+    """
+    with open(source, "rb") as infile, _atomic_file(filename + ".gz", "wb") as raw:
+        # mtime=0 keeps the output identical for identical content
+        with gzip.GzipFile(
+            filename=os.path.basename(filename),
+            mode="wb",
+            compresslevel=GZIP_LEVEL,
+            fileobj=raw,
+            mtime=0,
+        ) as gz_file:
+            shutil.copyfileobj(infile, gz_file)
+
+    if brotli is not None:
+        with open(source, "rb") as infile:
+            content = infile.read()
+        with _atomic_file(filename + ".br", "wb") as br_file:
+            br_file.write(brotli.compress(content, quality=BROTLI_QUALITY))
+    elif os.path.exists(filename + ".br"):
+        # never leave a stale copy behind for the server to pick up
+        os.remove(filename + ".br")
+
+
+def file_digest(filename):
+    """Get the hex SHA-256 hash of a file's content."""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as infile:
+        for block in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(manifest=MANIFEST_FILE):
+    """Read the manifest entries, keyed by path relative to the manifest.
+
+    Returns an empty dict if the manifest does not exist yet.
+    """
+    try:
+        with open(manifest, "r") as infile:
+            return json.load(infile)["files"]
+    except (IOError, OSError, ValueError, KeyError):
+        return {}
+
+
+def update_manifest(entries, manifest=MANIFEST_FILE):
+    """Merge entries into the manifest.
+
+    The manifest is locked while it is updated so generators running at the
+    same time do not drop each other's entries. It is replaced atomically,
+    as the pages read it while it is being updated.
+
+    Parameters
+    ----------
+    entries : dict
+        Entries with the "sha256", "size", "gen_time" (unix seconds) and
+        "gen_date" (UTC) of each file, keyed by path relative to the
+        manifest.
+    manifest : str
+        Path of the manifest.
+
+    """
+    with open(manifest + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        files = read_manifest(manifest)
+        files.update(entries)
+        with _atomic_file(manifest, "w") as outfile:
+            json.dump({"files": files}, outfile, sort_keys=True, indent=1)
+
+
+def _manifest_key(filename, manifest):
+    return os.path.relpath(
+        os.path.abspath(filename), os.path.dirname(os.path.abspath(manifest))
+    )
+
+
+class Manifest(object):
+    """Manifest entries collected to be merged in a single update.
+
+    Parameters
+    ----------
+    manifest : str
+        Path of the manifest, read once when created.
+
+    """
+
+    def __init__(self, manifest=MANIFEST_FILE):
+        self.path = os.path.abspath(manifest)
+        self.files = read_manifest(manifest)
+        self.entries = {}
+
+    def get(self, key):
+        """Get the entry of a file, None if it is not recorded."""
+        return self.entries.get(key, self.files.get(key))
+
+    def add(self, key, entry):
+        """Add an entry, written by the next call to `write`."""
+        self.entries[key] = entry
+
+    def write(self):
+        """Merge the collected entries into the manifest."""
+        if self.entries:
+            update_manifest(self.entries, self.path)
+            self.files.update(self.entries)
+            self.entries = {}
+
+
+@contextlib.contextmanager
+def batch(manifest=MANIFEST_FILE):
+    """Collect the manifest entries of the files published in a block.
+
+    Every `publish` in the block checks and records its file with the
+    manifest as it was read on entry, which is updated once on exit (also
+    if the block raises, the files published so far are kept).
+
+    Parameters
+    ----------
+    manifest : str
+        Path of the manifest.
+
+    """
+    collected = Manifest(manifest)
+    _batches.append(collected)
+    try:
+        yield collected
+    finally:
+        _batches.remove(collected)
+        collected.write()
+
+
+def batched(func):
+    """Decorate a generator's main function to run it in a `batch`."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with batch():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def _open_manifest(manifest):
+    for collected in reversed(_batches):
+        if collected.path == os.path.abspath(manifest):
+            return collected
+    return Manifest(manifest)
+
+
+def _unchanged(filename, digest, compress, manifest):
+    entry = manifest.get(_manifest_key(filename, manifest.path))
+    if entry is None or entry["sha256"] != digest or not os.path.exists(filename):
+        return False
+    return not compress or os.path.exists(filename + ".gz")
+
+
+@contextlib.contextmanager
+def publish(filename, mode="w", compress=True, manifest=MANIFEST_FILE):
+    """Open an output file which is published atomically when closed.
+
+    Use as ``with publish("page.js") as js_file:``. If the block raises, the
+    previously published file is left untouched.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the output file.
+    mode : str
+        "w" for text or "wb" for binary content.
+    compress : bool
+        Also publish the gzip (and brotli) compressed siblings.
+    manifest : str or None
+        Manifest recording the hash and generation time of the file. If the
+        content is the same as recorded there, the published file is kept
+        as it is. None disables the manifest. Inside a `batch` of the same
+        manifest, the entry is written when the batch ends.
+
+    """
+    if manifest is not None:
+        manifest = _open_manifest(manifest)
+    outfile, tmp_name = _temp_file(filename, mode)
+    try:
+        yield outfile
+        outfile.flush()
+        gen_time = time.time()
+        digest = file_digest(tmp_name)
+        if manifest is not None and _unchanged(filename, digest, compress, manifest):
+            outfile.close()
+            os.remove(tmp_name)
+        else:
+            if compress:
+                # the siblings go first, so they are never older than the file
+                write_compressed(tmp_name, filename)
+            _commit(outfile, tmp_name, filename)
+    except BaseException:
+        outfile.close()
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+    if manifest is not None:
+        entry = {
+            "sha256": digest,
+            "size": os.path.getsize(filename),
+            "gen_time": gen_time,
+            "gen_date": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(gen_time)),
+        }
+        manifest.add(_manifest_key(filename, manifest.path), entry)
+        if manifest not in _batches:
+            manifest.write()
+
+
+def publish_hashed(filename, content):
+    """Publish json data under a url holding a hash of its content.
+
+    The data is written as ``{"version": <hash>, "payload": <content>}``.
+    Pages load it from ``<filename>?v=<hash>``: browsers cache every version
+    while the server keeps a single file, and a page fetching the url before
+    the new file was uploaded can tell from the version it got.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the data file.
+    content : str
+        JSON text of the payload.
+
+    Returns
+    -------
+    str
+        The url of this version, relative to the directory of the file.
+
+    """
+    version = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+    with publish(filename) as outfile:
+        outfile.write('{"version": ' + json.dumps(version) + ', "payload": ')
+        outfile.write(content)
+        outfile.write("}")
+    return os.path.basename(filename) + "?v=" + version
+
+
+def changed_files(files, uploaded):
+    """List the files whose content differs from the uploaded manifest.
+
+    Parameters
+    ----------
+    files : dict
+        Current manifest entries.
+    uploaded : dict
+        Manifest entries as of the last upload.
+
+    Returns
+    -------
+    list of str
+        Paths of the changed files relative to the manifest, sorted.
+
+    """
+    return sorted(
+        name
+        for name, entry in files.items()
+        if uploaded.get(name, {}).get("sha256") != entry["sha256"]
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=(
+            "List the generated files which changed since the last upload, "
+            "with their compressed copies and the manifest itself."
+        )
+    )
+    parser.add_argument(
+        "--outdir",
+        dest="outdir",
+        type=str,
+        default=".",
+        help="Directory the generators write into.",
+    )
+    parser.add_argument(
+        "--uploaded",
+        dest="uploaded",
+        type=str,
+        default=DEFAULT_UPLOADED_FILE,
+        help=(
+            "Copy of the manifest as of the last upload, relative to the output "
+            'directory, defaults to "{}"'.format(DEFAULT_UPLOADED_FILE)
+        ),
+    )
+    parser.add_argument(
+        "--mark-uploaded",
+        dest="mark_uploaded",
+        action="store_true",
+        help="Record the files of the last listing as uploaded.",
+    )
+    args = parser.parse_args(argv)
+
+    manifest = os.path.join(args.outdir, MANIFEST_FILE)
+    uploaded = os.path.join(args.outdir, args.uploaded)
+    # the manifest as listed, files published since then are not uploaded yet
+    pending = uploaded + ".pending"
+    if args.mark_uploaded:
+        if os.path.exists(pending):
+            os.rename(pending, uploaded)
+        return
+
+    files = read_manifest(manifest)
+    with _atomic_file(pending, "w") as outfile:
+        json.dump({"files": files}, outfile, sort_keys=True, indent=1)
+
+    paths = []
+    for name in changed_files(files, read_manifest(uploaded)):
+        paths.append(name)
+        for suffix in COMPRESSED_SUFFIXES:
+            if os.path.exists(os.path.join(args.outdir, name + suffix)):
+                paths.append(name + suffix)
+    paths.append(MANIFEST_FILE)
+    sys.stdout.write("\n".join(paths) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,84 +16,119 @@ from hera_mc.qm import AntMetrics, ArrayMetrics
 import sqlalchemy
 from jinja2 import Environment, FileSystemLoader
 
+import mc_cache
+import plotly_json
+import publish
+import time_utils
 
-def do_ant_metric(
-    session, metric, yexpression, ymode="lines", yname="NONAME", cutoff=None
-):
-    data = (
-        session.query(AntMetrics.obsid, yexpression)
-        .filter(AntMetrics.metric == metric)
-        .filter(AntMetrics.obsid > cutoff.gps)
-        .group_by(AntMetrics.obsid)
+# metrics are computed by RTP up to a day after the observation, so the
+# cached metrics of the last day are queried again on every run
+METRIC_OVERLAP = 86400.0
+
+
+# AntMetrics and ArrayMetrics plotted on the page
+ANT_METRICS = [
+    "ant_metrics_xants",
+    "ant_metrics_meanVij",
+    "ant_metrics_redCorr",
+    "ant_metrics_meanVijXPol",
+]
+ARRAY_METRICS = [
+    "firstcal_metrics_agg_std_x",
+    "firstcal_metrics_agg_std_y",
+    "firstcal_metrics_max_std_x",
+    "firstcal_metrics_max_std_y",
+    "omnical_metrics_ant_phs_std_max_XX",
+    "omnical_metrics_ant_phs_std_max_YY",
+    "omnical_metrics_chisq_tot_avg_XX",
+    "omnical_metrics_chisq_tot_avg_YY",
+]
+
+
+def fetch_ant_metrics(session, metrics, since):
+    """Get the per observation count and mean of several AntMetrics at once."""
+    rows = (
+        session.query(
+            AntMetrics.metric,
+            AntMetrics.obsid,
+            sqlalchemy.func.count(),
+            sqlalchemy.func.avg(AntMetrics.val),
+        )
+        .filter(AntMetrics.metric.in_(metrics))
+        .filter(AntMetrics.obsid > since)
+        .group_by(AntMetrics.metric, AntMetrics.obsid)
         .order_by(AntMetrics.obsid)
         .all()
     )
+    return mc_cache.rows_to_columns(
+        rows, [("metric", str), ("time", float), ("count", float), ("avg", float)]
+    )
+
+
+def fetch_array_metrics(session, metrics, since):
+    """Get the values of several ArrayMetrics at once."""
+    rows = (
+        session.query(
+            ArrayMetrics.metric,
+            ArrayMetrics.obsid,
+            sqlalchemy.func.avg(ArrayMetrics.val),
+        )
+        .filter(ArrayMetrics.metric.in_(metrics))
+        .filter(ArrayMetrics.obsid > since)
+        .group_by(ArrayMetrics.metric, ArrayMetrics.obsid)
+        .order_by(ArrayMetrics.obsid)
+        .all()
+    )
+    return mc_cache.rows_to_columns(
+        rows, [("metric", str), ("time", float), ("val", float)]
+    )
+
+
+def metric_trace(metrics, metric, column, name, mode):
+    """Select the rows of one metric from fetched metrics as a plotly trace."""
+    mask = metrics["metric"] == metric
     # 300s are added here ONLY because it was this way in the
     # legacy pdoubled_slotter.
-    time_array = Time([t[0] + 300 for t in data], format="gps")
-    if time_array:
-        time_array = time_array.isot.tolist()
-    else:
-        time_array = []
-    _data = [
-        {
-            "x": time_array,
-            "y": (np.ma.masked_invalid([t[1] for t in data]).filled(None).tolist()),
-            "name": yname,
-            "mode": ymode,
-        }
-    ]
-    return _data
+    time_array = time_utils.gps_to_isot(metrics["time"][mask] + 300)
+    return {
+        "x": time_array,
+        "y": np.ma.masked_invalid(metrics[column][mask]),
+        "name": name,
+        "mode": mode,
+    }
+
+
+def do_ant_metric(ant_metrics, metric, column="avg", ymode="lines", yname="NONAME"):
+    return [metric_trace(ant_metrics, metric, column, yname, ymode)]
 
 
 def do_xy_array_metric(
-    session,
+    array_metrics,
     metric_base,
-    yexpression=ArrayMetrics.val,
     doubled_suffix=False,
     ymode="lines",
-    cutoff=None,
 ):
     if doubled_suffix:
         suffixes = ["_XX", "_YY"]
     else:
         suffixes = ["_x", "_y"]
-    _data = []
-    for desc, suffix in zip("XY", suffixes):
-        data = (
-            session.query(ArrayMetrics.obsid, yexpression)
-            .filter(ArrayMetrics.metric == metric_base + suffix)
-            .filter(ArrayMetrics.obsid > cutoff.gps)
-            .order_by(ArrayMetrics.obsid)
-            .all()
-        )
-        # 300s are added here ONLY because it was this way in the
-        # legacy pdoubled_slotter.
-        time_array = Time([t[0] + 300 for t in data], format="gps")
-        if time_array:
-            time_array = time_array.isot.tolist()
-        else:
-            time_array = []
-        __data = {
-            "x": time_array,
-            "y": (np.ma.masked_invalid([t[1] for t in data]).filled(None).tolist()),
-            "name": desc,
-            "mode": ymode,
-        }
-        _data.append(__data)
-
-    return _data
+    return [
+        metric_trace(array_metrics, metric_base + suffix, "val", desc, ymode)
+        for desc, suffix in zip("XY", suffixes)
+    ]
 
 
-def main():
-    # templates are stored relative to the script dir
-    # stored one level up, find the parent directory
-    # and split the parent directory away
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    split_dir = os.path.split(script_dir)
-    template_dir = os.path.join(split_dir[0], "templates")
+@publish.batched
+def main(argv=None, db=None, env=None):
+    if env is None:
+        # templates are stored relative to the script dir
+        # stored one level up, find the parent directory
+        # and split the parent directory away
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        split_dir = os.path.split(script_dir)
+        template_dir = os.path.join(split_dir[0], "templates")
 
-    env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
+        env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
     if sys.version_info[0] < 3:
         # py2
         computer_hostname = os.uname()[1]
@@ -102,12 +137,14 @@ def main():
         computer_hostname = os.uname().nodename
 
     parser = mc.get_mc_argument_parser()
-    args = parser.parse_args()
+    mc_cache.add_cache_arguments(parser)
+    args = parser.parse_args(argv)
 
-    try:
-        db = mc.connect_to_mc_db(args)
-    except RuntimeError as e:
-        raise SystemExit(str(e))
+    if db is None:
+        try:
+            db = mc.connect_to_mc_db(args)
+        except RuntimeError as e:
+            raise SystemExit(str(e))
 
     plotnames = [
         ["am-xants", "am-meanVij"],
@@ -157,17 +194,15 @@ def main():
         plotname=plotnames,
         plotstyle="height: 24.5%",
         colsize=colsize,
-        gen_date=now.iso,
-        gen_time_unix_ms=now.unix * 1000,
         js_name="qm",
         hostname=computer_hostname,
         scriptname=os.path.basename(__file__),
         caption=caption,
     )
-    with open("qm.html", "w") as h_file:
+    with publish.publish("qm.html") as h_file:
         h_file.write(rendered_html)
 
-    js_template = env.get_template("plotly_base.js")
+    bundle_template = env.get_template("plotly_bundle.js")
 
     with db.sessionmaker() as session:
 
@@ -182,127 +217,85 @@ def main():
             "hovermode": "closest",
         }
 
+        # one query per metrics table, split into the plots in memory
+        ant_metrics = mc_cache.cached_columns(
+            args.cache_dir,
+            "qm_ant_metrics",
+            lambda since: fetch_ant_metrics(session, ANT_METRICS, since),
+            cutoff.gps,
+            overlap=METRIC_OVERLAP,
+        )
+        array_metrics = mc_cache.cached_columns(
+            args.cache_dir,
+            "qm_array_metrics",
+            lambda since: fetch_array_metrics(session, ARRAY_METRICS, since),
+            cutoff.gps,
+            overlap=METRIC_OVERLAP,
+        )
+
+        # the plots are written to qm.js in one go at the end
+        bundle = plotly_json.PlotBundle(layout)
+
         # If an antpol is detected as bad (`val` not used).
         data = do_ant_metric(
-            session,
-            "ant_metrics_xants",
-            sqlalchemy.func.count(),
-            ymode="markers",
-            yname="Data",
-            cutoff=cutoff,
+            ant_metrics, "ant_metrics_xants", "count", ymode="markers", yname="Data"
         )
 
         layout["yaxis"]["title"] = "Count"
         layout["title"]["text"] = "Ant Metrics # of Xants"
-        rendered_js = js_template.render(plotname="am-xants", data=data, layout=layout)
-        with open("qm.js", "w") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("am-xants", data, layout)
 
         # "Mean of the absolute value of all visibilities associated with an
         # antenna".
-        data = do_ant_metric(
-            session,
-            "ant_metrics_meanVij",
-            sqlalchemy.func.avg(AntMetrics.val),
-            yname="Data",
-            cutoff=cutoff,
-        )
+        data = do_ant_metric(ant_metrics, "ant_metrics_meanVij", yname="Data")
         layout["yaxis"]["title"] = "Average Amplitude"
         layout["title"]["text"] = "Ant Metrics MeanVij"
-        rendered_js = js_template.render(
-            plotname="am-meanVij", data=data, layout=layout
-        )
-        with open("qm.js", "a") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("am-meanVij", data, layout)
 
         # "Extent to which baselines involving an antenna do not correlate
         # with others they are nominmally redundant with".
-        data = do_ant_metric(
-            session,
-            "ant_metrics_redCorr",
-            sqlalchemy.func.avg(AntMetrics.val),
-            yname="Data",
-            cutoff=cutoff,
-        )
+        data = do_ant_metric(ant_metrics, "ant_metrics_redCorr", yname="Data")
         layout["yaxis"]["title"] = "Average Amplitude"
         layout["title"]["text"] = "Ant Metrics redCorr"
-        rendered_js = js_template.render(
-            plotname="am-redCorr", data=data, layout=layout
-        )
-        with open("qm.js", "a") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("am-redCorr", data, layout)
 
         # "Ratio of mean cross-pol visibilities to mean same-pol visibilities:
         # (Vxy+Vyx)/(Vxx+Vyy)".
-        data = do_ant_metric(
-            session,
-            "ant_metrics_meanVijXPol",
-            sqlalchemy.func.avg(AntMetrics.val),
-            yname="Data",
-            cutoff=cutoff,
-        )
+        data = do_ant_metric(ant_metrics, "ant_metrics_meanVijXPol", yname="Data")
         layout["yaxis"]["title"] = "Average Amplitude"
         layout["title"]["text"] = "Ant Metrics MeanVij CrossPol"
-        rendered_js = js_template.render(
-            plotname="am-meanVijXpol", data=data, layout=layout
-        )
-        with open("qm.js", "a") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("am-meanVijXpol", data, layout)
 
         # "Aggregate standard deviation of delay solutions".
-        data = do_xy_array_metric(session, "firstcal_metrics_agg_std", cutoff=cutoff)
+        data = do_xy_array_metric(array_metrics, "firstcal_metrics_agg_std")
         layout["yaxis"]["title"] = "std"
         layout["title"]["text"] = "FirstCal Metrics Agg Std"
-        rendered_js = js_template.render(
-            plotname="fc-agg_std", data=data, layout=layout
-        )
-        with open("qm.js", "a") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("fc-agg_std", data, layout)
 
         # "Maximum antenna standard deviation of delay solutions".
-        data = do_xy_array_metric(session, "firstcal_metrics_max_std", cutoff=cutoff)
+        data = do_xy_array_metric(array_metrics, "firstcal_metrics_max_std")
         layout["yaxis"]["title"] = "FC max_std"
         layout["title"]["text"] = "FirstCal Metrics Max Std"
-        rendered_js = js_template.render(
-            plotname="fc-max_std", data=data, layout=layout
-        )
-        with open("qm.js", "a") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("fc-max_std", data, layout)
 
         # Maximum of "gain phase standard deviation per-antenna across file".
         data = do_xy_array_metric(
-            session,
-            "omnical_metrics_ant_phs_std_max",
-            doubled_suffix=True,
-            cutoff=cutoff,
+            array_metrics, "omnical_metrics_ant_phs_std_max", doubled_suffix=True
         )
         layout["yaxis"]["title"] = "OC ant_phs_std_max"
         layout["title"]["text"] = "OmniCal Metrics Ant Phase Std max"
-        rendered_js = js_template.render(
-            plotname="oc-ant_phs_std_max", data=data, layout=layout
-        )
-        with open("qm.js", "a") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("oc-ant_phs_std_max", data, layout)
 
         # "Median of chi-square across entire file".
         data = do_xy_array_metric(
-            session, "omnical_metrics_chisq_tot_avg", doubled_suffix=True, cutoff=cutoff
+            array_metrics, "omnical_metrics_chisq_tot_avg", doubled_suffix=True
         )
         layout["yaxis"]["title"] = "OC chisq_tot_avg"
         layout["title"]["text"] = "OmniCal Metrics Chi-square total avg"
-        rendered_js = js_template.render(
-            plotname="oc-chisq_tot_avg", data=data, layout=layout
-        )
-        with open("qm.js", "a") as js_file:
-            js_file.write(rendered_js)
-            js_file.write("\n\n")
+        bundle.add("oc-chisq_tot_avg", data, layout)
+
+        with publish.publish("qm.js") as js_file:
+            bundle.write(js_file, bundle_template)
 
 
 if __name__ == "__main__":
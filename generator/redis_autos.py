@@ -0,0 +1,146 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""Batched access to the autocorrelations stored in the correlator redis.
+
+The correlator publishes one ``auto:<ant><pol>`` key per antpol and one
+``eq:ant:<ant>:<pol>`` hash holding the equalization coefficients.
+Rather than walking the whole keyspace with ``KEYS`` and issuing a ``GET``
+and ``HGET`` per antpol, these helpers discover keys with a cursor based
+``SCAN`` (or from a known antenna list) and fetch everything with a handful
+of pipelined ``MGET``/``HGET`` round trips.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import re
+import numpy as np
+
+AUTO_KEY = "auto:{ant:d}{pol:s}"
+EQ_KEY = "eq:ant:{ant:d}:{pol:s}"
+AUTO_KEY_REGEX = re.compile(r"^auto:(?P<ant>\d+)(?P<pol>e|n)$")
+POLS = ["e", "n"]
+
+# number of keys requested per MGET/SCAN call, large enough to keep the
+# number of round trips small without building enormous single replies.
+CHUNK_SIZE = 256
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    for ind in range(0, len(items), size):
+        yield items[ind : ind + size]
+
+
+def get_auto_antpols(redis_db, ants=None, pols=POLS):
+    """Find the antpols which have an autocorrelation in redis.
+
+    Parameters
+    ----------
+    redis_db : redis.Redis
+        Connection to the correlator redis.
+    ants : array_like of int, optional
+        Known antenna numbers. If given, no key discovery is performed and
+        every (ant, pol) combination is returned, missing keys are dropped
+        when the data is fetched.
+    pols : list of str
+        Feed polarizations to consider.
+
+    Returns
+    -------
+    list of tuple
+        Sorted list of (ant, pol) tuples.
+
+    """
+    if ants is not None:
+        return sorted((int(ant), pol) for ant in np.unique(ants) for pol in pols)
+
+    antpols = set()
+    for key in redis_db.scan_iter(match="auto:*", count=CHUNK_SIZE * 4):
+        if isinstance(key, bytes):
+            key = key.decode("utf-8")
+        match = AUTO_KEY_REGEX.match(key)
+        if match is not None and match.group("pol") in pols:
+            antpols.add((int(match.group("ant")), match.group("pol")))
+
+    return sorted(antpols)
+
+
+def get_autos(redis_db, antpols):
+    """Fetch the autocorrelations for the input antpols.
+
+    Parameters
+    ----------
+    redis_db : redis.Redis
+        Connection to the correlator redis.
+    antpols : list of tuple
+        (ant, pol) tuples to fetch.
+
+    Returns
+    -------
+    dict
+        Dictionary keyed by (ant, pol) of read-only float32 arrays.
+        Antpols with no data in redis are not included.
+
+    """
+    antpols = list(antpols)
+    pipe = redis_db.pipeline(transaction=False)
+    for chunk in _chunks(antpols):
+        pipe.mget([AUTO_KEY.format(ant=ant, pol=pol) for ant, pol in chunk])
+
+    values = [val for reply in pipe.execute() for val in reply]
+
+    autos = {}
+    for antpol, val in zip(antpols, values):
+        if val is not None:
+            autos[antpol] = np.frombuffer(val, dtype=np.float32)
+    return autos
+
+
+def parse_eq_coeffs(raw):
+    """Parse a bracketed, comma separated string of coefficients.
+
+    Parameters
+    ----------
+    raw : bytes or str
+        The coefficients as stored in redis or M&C, e.g. "[1.0, 1.0, ...]".
+
+    Returns
+    -------
+    ndarray or None
+        The parsed coefficients, None if the string held no values.
+
+    """
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8")
+    coeffs = np.fromstring(raw.strip("[]"), sep=",")
+    if coeffs.size == 0:
+        return None
+    return coeffs
+
+
+def get_eq_raw(redis_db, antpols):
+    """Fetch the unparsed equalization coefficients for the input antpols.
+
+    Parameters
+    ----------
+    redis_db : redis.Redis
+        Connection to the correlator redis.
+    antpols : list of tuple
+        (ant, pol) tuples to fetch.
+
+    Returns
+    -------
+    dict
+        Dictionary keyed by (ant, pol) of the raw coefficient strings.
+        Antpols with no coefficients are not included.
+
+    """
+    antpols = list(antpols)
+    pipe = redis_db.pipeline(transaction=False)
+    for ant, pol in antpols:
+        pipe.hget(EQ_KEY.format(ant=ant, pol=pol), "values")
+
+    return {
+        antpol: val for antpol, val in zip(antpols, pipe.execute()) if val is not None
+    }
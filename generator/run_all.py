@@ -0,0 +1,264 @@
+#! /usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""
+Run the dashboard generators concurrently and report how long each took.
+
+The generators are independent and mostly wait on M&C, redis or GitHub, so
+running them side by side makes a full refresh take about as long as the
+slowest page. Each generator runs as its own process; at most ``--workers``
+run at once and any still running after ``--timeout`` seconds is killed.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import publish
+
+# generator script name -> (uses redis, files written). Patterns of files
+# whose number varies are only reported for the files they match.
+SCRIPTS = {
+    "librarian": (False, ["librarian.html", "librarian.js"]),
+    "compute": (False, ["compute.html", "compute.js"]),
+    "qm": (False, ["qm.html", "qm.js"]),
+    "hex_amp": (
+        True,
+        [
+            "hex_amp.html",
+            "hex_amp.js",
+            "node_amp.html",
+            "node_amp.js",
+            "ant_stats.csv",
+        ],
+    ),
+    "adc_histogram": (True, ["adchist.html", "adchist.js"]),
+    "hookup_notes": (
+        True,
+        ["hookup_notes.html", "hookup_notes.js", "hookup_notes_table.html"],
+    ),
+    "autospectra": (
+        True,
+        [
+            "spectra.html",
+            "spectra.js",
+            "spectra_version.json",
+            # the per node shards
+            "spectra_*.json",
+        ],
+    ),
+    "snaphookup": (True, ["snaphookup.html"]),
+}
+
+DEFAULT_SUMMARY_FILE = "run_all_summary.json"
+
+
+def run_script(name, argv, timeout, outdir, trace=False):
+    """Run one generator script in a subprocess.
+
+    Parameters
+    ----------
+    name : str
+        Name of the generator script, without the ".py".
+    argv : list of str
+        Command line arguments passed to the script.
+    timeout : float
+        Seconds after which the script is killed.
+    outdir : str
+        Directory the script is run in, where it writes its pages.
+    trace : bool
+        Run the script through io_trace.py, recording its M&C and redis
+        calls in "<name>_trace.json" and the shared trace history.
+
+    Returns
+    -------
+    dict
+        Summary of the run with keys "name", "status" (the exit code, or
+        "timeout"), "wall_time" in seconds, "output_bytes" (dict of the size
+        of each output, None if missing), "output_fresh" (dict telling if
+        each output was published by this run, even with unchanged content)
+        and "log" (the combined stdout and stderr).
+
+    """
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    command = [sys.executable, os.path.join(script_dir, name + ".py")]
+    if trace:
+        command = [sys.executable, os.path.join(script_dir, "io_trace.py"), name]
+    t0 = time.time()
+    try:
+        proc = subprocess.run(
+            command + argv,
+            cwd=outdir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=timeout,
+        )
+        status = proc.returncode
+        log = proc.stdout
+    except subprocess.TimeoutExpired as err:
+        status = "timeout"
+        log = err.stdout or b""
+    wall_time = time.time() - t0
+
+    # unchanged outputs are not rewritten, the manifest records when they
+    # were last published
+    manifest = publish.read_manifest(os.path.join(outdir, publish.MANIFEST_FILE))
+    output_bytes = {}
+    output_fresh = {}
+    for pattern in SCRIPTS[name][1]:
+        paths = sorted(glob.glob(os.path.join(outdir, pattern)))
+        if not paths and not glob.has_magic(pattern):
+            output_bytes[pattern] = None
+            output_fresh[pattern] = False
+        for path in paths:
+            filename = os.path.relpath(path, outdir)
+            entry = manifest.get(filename, {})
+            output_bytes[filename] = os.path.getsize(path)
+            output_fresh[filename] = entry.get("gen_time", 0) >= t0
+
+    return {
+        "name": name,
+        "status": status,
+        "wall_time": wall_time,
+        "output_bytes": output_bytes,
+        "output_fresh": output_fresh,
+        "log": log.decode("utf-8", "replace"),
+    }
+
+
+def format_summary(results, wall_time):
+    """Format the run summaries as a plain text table."""
+    lines = [
+        "{:<16s}{:>10s}{:>12s}{:>14s}{:>10s}".format(
+            "script", "status", "time [s]", "output [B]", "updated"
+        )
+    ]
+    for result in results:
+        sizes = [size for size in result["output_bytes"].values() if size is not None]
+        lines.append(
+            "{name:<16s}{status:>10s}{wall_time:>12.1f}{size:>14d}{updated:>10s}".format(
+                name=result["name"],
+                status=str(result["status"]),
+                wall_time=result["wall_time"],
+                size=sum(sizes),
+                updated="{:d}/{:d}".format(
+                    sum(result["output_fresh"].values()), len(result["output_fresh"])
+                ),
+            )
+        )
+    lines.append("{:<16s}{:>10s}{:>12.1f}".format("total", "", wall_time))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the heranow dashboard generators concurrently."
+    )
+    parser.add_argument(
+        "--scripts",
+        nargs="+",
+        default=list(SCRIPTS),
+        choices=list(SCRIPTS),
+        help="Generators to run, defaults to all of them.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Maximum number of generators running at once, defaults to 4.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=540.0,
+        help="Seconds after which a generator is killed, defaults to 540.",
+    )
+    parser.add_argument(
+        "--redishost",
+        dest="redishost",
+        type=str,
+        default="redishost",
+        help=('The host name for redis to connect to, defaults to "redishost"'),
+    )
+    parser.add_argument(
+        "--port", dest="port", type=int, default=6379, help="Redis port to connect."
+    )
+    parser.add_argument(
+        "--outdir",
+        dest="outdir",
+        type=str,
+        default=".",
+        help="Directory to write the generated pages into.",
+    )
+    parser.add_argument(
+        "--summary-file",
+        dest="summary_file",
+        type=str,
+        default=DEFAULT_SUMMARY_FILE,
+        help=(
+            "File (in the output directory) the run summary is written to, "
+            'defaults to "{}"'.format(DEFAULT_SUMMARY_FILE)
+        ),
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help=(
+            "Trace the M&C and redis calls of every generator, "
+            "see io_trace.py for the files written."
+        ),
+    )
+    args = parser.parse_args()
+
+    redis_argv = ["--redishost", args.redishost, "--port", str(args.port)]
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = [
+            pool.submit(
+                run_script,
+                name,
+                redis_argv if SCRIPTS[name][0] else [],
+                args.timeout,
+                args.outdir,
+                args.trace,
+            )
+            for name in args.scripts
+        ]
+        results = [future.result() for future in futures]
+    wall_time = time.time() - t0
+
+    for result in results:
+        if result["log"]:
+            print("----- {} -----".format(result["name"]))
+            print(result["log"].rstrip())
+
+    summary = format_summary(results, wall_time)
+    print(summary)
+    with open(os.path.join(args.outdir, args.summary_file), "w") as summary_file:
+        json.dump(
+            {
+                "wall_time": wall_time,
+                "scripts": [
+                    {key: val for key, val in result.items() if key != "log"}
+                    for result in results
+                ],
+            },
+            summary_file,
+            indent=2,
+        )
+
+    if any(result["status"] != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
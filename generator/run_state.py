@@ -0,0 +1,138 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""Track which correlator inputs each generator last consumed.
+
+The correlator publishes a new ``auto:timestamp`` whenever new autos are
+available and bumps the ``update_time`` of ``corr:map`` whenever the
+hookup changes. Generators record the values they rendered in a small json
+file so the next cron tick can exit early when nothing new was published,
+e.g. during maintenance or while the correlator is off. Pages also showing
+M&C records add the values from `mc_status.get_mc_inputs` to their inputs.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import fcntl
+import numpy as np
+
+DEFAULT_STATE_FILE = "dashboard_run_state.json"
+
+
+def add_run_state_arguments(parser):
+    """Add the --force and --state-file options to an argument parser."""
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate the page even if its inputs are unchanged.",
+    )
+    parser.add_argument(
+        "--state-file",
+        dest="state_file",
+        type=str,
+        default=DEFAULT_STATE_FILE,
+        help=(
+            "File recording the inputs consumed by the last run, "
+            'defaults to "{}"'.format(DEFAULT_STATE_FILE)
+        ),
+    )
+
+
+def get_correlator_inputs(redis_db, autos=True, corr_map=True):
+    """Read the values which identify the current correlator inputs.
+
+    Parameters
+    ----------
+    redis_db : redis.Redis
+        Connection to the correlator redis.
+    autos : bool
+        Include the JD from "auto:timestamp".
+    corr_map : bool
+        Include the unix "update_time" of "corr:map".
+
+    Returns
+    -------
+    dict
+        Dictionary of the requested inputs, None for any missing value.
+
+    """
+    inputs = {}
+    if autos:
+        timestamp = redis_db.get("auto:timestamp")
+        if timestamp is not None:
+            timestamp = np.frombuffer(timestamp, dtype=np.float64).item()
+        inputs["auto_timestamp"] = timestamp
+    if corr_map:
+        update_time = redis_db.hget("corr:map", "update_time")
+        if update_time is not None:
+            update_time = float(update_time)
+        inputs["corr_map_update_time"] = update_time
+    return inputs
+
+
+def _read_state(state_file):
+    state_file.seek(0)
+    try:
+        return json.loads(state_file.read() or "{}")
+    except ValueError:
+        # a corrupted state file just means everything gets regenerated
+        return {}
+
+
+def inputs_unchanged(name, inputs, filename=DEFAULT_STATE_FILE):
+    """Check if the generator already consumed these inputs.
+
+    Parameters
+    ----------
+    name : str
+        Name of the generator.
+    inputs : dict
+        Current inputs, from `get_correlator_inputs` and possibly
+        `mc_status.get_mc_inputs`.
+    filename : str
+        Path to the run-state file.
+
+    Returns
+    -------
+    bool
+        True if every input is known and matches the last recorded run.
+
+    """
+    if any(val is None for val in inputs.values()) or not os.path.exists(filename):
+        return False
+
+    with open(filename, "r") as state_file:
+        fcntl.flock(state_file, fcntl.LOCK_SH)
+        state = _read_state(state_file)
+
+    return state.get(name) == inputs
+
+
+def record_inputs(name, inputs, filename=DEFAULT_STATE_FILE):
+    """Record the inputs consumed by a successful run of a generator.
+
+    The file is locked while it is updated so generators running at the
+    same time do not overwrite each other's entries.
+
+    Parameters
+    ----------
+    name : str
+        Name of the generator.
+    inputs : dict
+        Inputs from `get_correlator_inputs` used to build the page.
+    filename : str
+        Path to the run-state file.
+
+    """
+    with open(filename, "a+") as state_file:
+        fcntl.flock(state_file, fcntl.LOCK_EX)
+        state = _read_state(state_file)
+        state[name] = inputs
+        state_file.seek(0)
+        state_file.truncate()
+        json.dump(state, state_file, sort_keys=True, indent=2)
+        state_file.flush()
+        os.fsync(state_file.fileno())
@@ -19,19 +19,24 @@ import argparse
 from astropy.time import Time
 from jinja2 import Environment, FileSystemLoader
 
+import publish
+import run_state
+
 
 # Two redis instances run on this server.
 # port 6379 is the hera-digi mirror
 # port 6380 is the paper1 mirror
-def main():
-    # templates are stored relative to the script dir
-    # stored one level up, find the parent directory
-    # and split the parent directory away
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    split_dir = os.path.split(script_dir)
-    template_dir = os.path.join(split_dir[0], "templates")
-
-    env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
+@publish.batched
+def main(argv=None, redis_db=None, env=None):
+    if env is None:
+        # templates are stored relative to the script dir
+        # stored one level up, find the parent directory
+        # and split the parent directory away
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        split_dir = os.path.split(script_dir)
+        template_dir = os.path.join(split_dir[0], "templates")
+
+        env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
 
     if sys.version_info[0] < 3:
         # py2
@@ -53,9 +58,18 @@ def main():
     parser.add_argument(
         "--port", dest="port", type=int, default=6379, help="Redis port to connect."
     )
-    args = parser.parse_args()
+    run_state.add_run_state_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if redis_db is None:
+        redis_db = redis.Redis(args.redishost, port=args.port)
+    inputs = run_state.get_correlator_inputs(redis_db, autos=False)
+    if not args.force and run_state.inputs_unchanged(
+        "snaphookup", inputs, filename=args.state_file
+    ):
+        print("No new correlator data since the last run, skipping snaphookup.")
+        return
 
-    redis_db = redis.Redis(args.redishost, port=args.port)
     corr_map = redis_db.hgetall("corr:map")
 
     update_time = Time(float(corr_map[b"update_time"]), format="unix")
@@ -172,15 +186,15 @@ def main():
         data_date_iso=update_time.iso,
         data_date_jd="{:.3f}".format(time_jd),
         data_date_unix_ms=time_unix * 1000,
-        gen_date=Time.now().iso,
-        gen_time_unix_ms=Time.now().unix * 1000,
         scriptname=os.path.basename(__file__),
         hostname=computer_hostname,
     )
 
-    with open("snaphookup.html", "w") as h_file:
+    with publish.publish("snaphookup.html") as h_file:
         h_file.write(rendered_html)
 
+    run_state.record_inputs("snaphookup", inputs, filename=args.state_file)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,160 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""Vectorized conversions between the time formats used by the pages.
+
+M&C stores GPS seconds and the correlator JDs, while plotly wants ISO
+strings or epoch milliseconds. Building an astropy `Time` per record (or
+even per array) dominates the runtime of the trend pages, so these helpers
+convert whole arrays in a single numpy pass. Leap seconds come from the
+static table below, which needs a new entry whenever IERS announces one.
+
+JDs and unix times are on the UTC scale, matching astropy's defaults.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import numpy as np
+
+# unix time of the GPS epoch, 1980-01-06 00:00:00 UTC
+GPS_EPOCH_UNIX = 315964800.0
+# JD of the unix epoch, 1970-01-01 00:00:00 UTC
+UNIX_EPOCH_JD = 2440587.5
+
+# unix times at which GPS - UTC increased by one second
+LEAP_SECONDS_UNIX = np.array(
+    [
+        362793600,  # 1981-07-01
+        394329600,  # 1982-07-01
+        425865600,  # 1983-07-01
+        489024000,  # 1985-07-01
+        567993600,  # 1988-01-01
+        631152000,  # 1990-01-01
+        662688000,  # 1991-01-01
+        709948800,  # 1992-07-01
+        741484800,  # 1993-07-01
+        773020800,  # 1994-07-01
+        820454400,  # 1996-01-01
+        867715200,  # 1997-07-01
+        915148800,  # 1999-01-01
+        1136073600,  # 2006-01-01
+        1230768000,  # 2009-01-01
+        1341100800,  # 2012-07-01
+        1435708800,  # 2015-07-01
+        1483228800,  # 2017-01-01
+    ],
+    dtype=np.float64,
+)
+# the same instants in GPS seconds, including the leap seconds so far
+LEAP_SECONDS_GPS = (
+    LEAP_SECONDS_UNIX - GPS_EPOCH_UNIX + np.arange(1, LEAP_SECONDS_UNIX.size + 1)
+)
+
+
+def _scalar_or_array(values, scalar):
+    return values.item() if scalar else values
+
+
+def gps_to_unix(gps):
+    """Convert GPS seconds to unix seconds (UTC).
+
+    Parameters
+    ----------
+    gps : float or array_like of float
+        GPS seconds.
+
+    Returns
+    -------
+    float or ndarray of float
+        Unix seconds, a float if `gps` is a scalar.
+
+    """
+    gps = np.asarray(gps, dtype=np.float64)
+    leaps = np.searchsorted(LEAP_SECONDS_GPS, gps, side="right")
+    return _scalar_or_array(gps + GPS_EPOCH_UNIX - leaps, gps.ndim == 0)
+
+
+def unix_to_gps(unix):
+    """Convert unix seconds (UTC) to GPS seconds."""
+    unix = np.asarray(unix, dtype=np.float64)
+    leaps = np.searchsorted(LEAP_SECONDS_UNIX, unix, side="right")
+    return _scalar_or_array(unix - GPS_EPOCH_UNIX + leaps, unix.ndim == 0)
+
+
+def now_gps():
+    """Get the current time in GPS seconds."""
+    return unix_to_gps(time.time())
+
+
+def jd_to_unix(jd):
+    """Convert JDs (UTC) to unix seconds."""
+    jd = np.asarray(jd, dtype=np.float64)
+    return _scalar_or_array((jd - UNIX_EPOCH_JD) * 86400.0, jd.ndim == 0)
+
+
+def unix_to_jd(unix):
+    """Convert unix seconds to JDs (UTC)."""
+    unix = np.asarray(unix, dtype=np.float64)
+    return _scalar_or_array(unix / 86400.0 + UNIX_EPOCH_JD, unix.ndim == 0)
+
+
+def unix_to_ms(unix):
+    """Convert unix seconds to epoch milliseconds, as used by javascript."""
+    unix = np.asarray(unix, dtype=np.float64)
+    return _scalar_or_array(unix * 1000.0, unix.ndim == 0)
+
+
+def unix_to_isot(unix, sep="T"):
+    """Format unix seconds as ISO strings with millisecond precision.
+
+    Parameters
+    ----------
+    unix : float or array_like of float
+        Unix seconds.
+    sep : str
+        Separator between the date and the time, "T" gives astropy's "isot"
+        format and " " its "iso" format.
+
+    Returns
+    -------
+    str or ndarray of str
+        Strings like "2020-01-01T00:00:00.000", a str if `unix` is a scalar.
+        NaN inputs give "NaT".
+
+    """
+    unix = np.asarray(unix, dtype=np.float64)
+    ms = np.round(unix * 1000.0)
+    nat = ~np.isfinite(ms)
+    stamps = np.where(nat, 0, ms).astype(np.int64).astype("datetime64[ms]")
+    stamps[nat] = np.datetime64("NaT")
+    strings = np.datetime_as_string(stamps, unit="ms")
+    if sep != "T" and strings.size:
+        strings = np.char.replace(strings, "T", sep)
+    return _scalar_or_array(strings, unix.ndim == 0)
+
+
+def unix_to_iso(unix):
+    """Format unix seconds as "2020-01-01 00:00:00.000" strings."""
+    return unix_to_isot(unix, sep=" ")
+
+
+def gps_to_isot(gps):
+    """Format GPS seconds as "2020-01-01T00:00:00.000" strings (UTC)."""
+    return unix_to_isot(gps_to_unix(gps))
+
+
+def gps_to_iso(gps):
+    """Format GPS seconds as "2020-01-01 00:00:00.000" strings (UTC)."""
+    return unix_to_iso(gps_to_unix(gps))
+
+
+def jd_to_isot(jd):
+    """Format JDs (UTC) as "2020-01-01T00:00:00.000" strings."""
+    return unix_to_isot(jd_to_unix(jd))
+
+
+def jd_to_iso(jd):
+    """Format JDs (UTC) as "2020-01-01 00:00:00.000" strings."""
+    return unix_to_iso(jd_to_unix(jd))
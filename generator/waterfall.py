@@ -0,0 +1,167 @@
+#! /usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2020 the HERA Collaboration
+# Licensed under the 2-clause BSD license.
+
+"""
+Generate a dashboard page of autocorrelation waterfalls.
+
+The spectra are read from the history ring buffer `autospectra` appends to
+(see auto_history.py), no redis connection is needed.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from astropy.time import Time
+from jinja2 import Environment, FileSystemLoader
+
+import auto_history
+import plotly_data
+import publish
+import time_utils
+
+# waterfalls are written one file per antpol into this directory
+DATA_DIR = "waterfalls"
+
+
+def is_list(value):
+    return isinstance(value, list)
+
+
+@publish.batched
+def main(argv=None, env=None):
+    if env is None:
+        # templates are stored relative to the script dir
+        # stored one level up, find the parent directory
+        # and split the parent directory away
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        split_dir = os.path.split(script_dir)
+        template_dir = os.path.join(split_dir[0], "templates")
+
+        env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
+        env.filters["islist"] = is_list
+
+    if sys.version_info[0] < 3:
+        # py2
+        computer_hostname = os.uname()[1]
+    else:
+        # py3
+        computer_hostname = os.uname().nodename
+
+    parser = argparse.ArgumentParser(
+        description=("Create auto-correlation waterfall plots for heranow dashboard")
+    )
+    parser.add_argument(
+        "--history-dir",
+        dest="history_dir",
+        type=str,
+        default=auto_history.DEFAULT_HISTORY_DIR,
+        help=(
+            "Directory of the autocorrelation history written by autospectra, "
+            'defaults to "{}"'.format(auto_history.DEFAULT_HISTORY_DIR)
+        ),
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        history = auto_history.AutoHistory(args.history_dir)
+    except (IOError, OSError) as err:
+        raise SystemExit("Unable to open the autocorrelation history: " + str(err))
+
+    if not os.path.isdir(DATA_DIR):
+        os.makedirs(DATA_DIR)
+
+    # every antpol is recorded at the same times
+    times = history.timeline()
+    times_iso = time_utils.jd_to_iso(times).tolist()
+    shared = {"freqs": plotly_data.encode_array(history.freqs)}
+    antpol_names = []
+    latest_jd = None
+    for ant, pol in history.antpols:
+        segments = history.waterfall((ant, pol))
+        if not segments:
+            # nothing appended to the history yet
+            continue
+        rows = [row for _, seg_spectra in segments for row in seg_spectra]
+        if np.all(np.isnan(rows[-1])):
+            # not in the latest autos
+            continue
+
+        linename = "ant{ant:d}{pol:s}".format(ant=ant, pol=pol)
+        waterfall = {
+            "type": "heatmap",
+            "x": plotly_data.shared_ref("freqs"),
+            "y": times_iso,
+            "z": [plotly_data.encode_quantized(row, step=0.01) for row in rows],
+            "colorscale": "Viridis",
+            "colorbar": {"title": {"text": "Power [dB]"}},
+            "hovertemplate": "%{x:.1f}\tMHz<br>%{y}<br>%{z:.2f}\t[dB]",
+            "name": linename,
+        }
+        with publish.publish(os.path.join(DATA_DIR, linename + ".json")) as data_file:
+            json.dump(
+                {"shared": shared, "data": [waterfall]}, data_file, sort_keys=True
+            )
+        antpol_names.append(linename)
+        latest_jd = times[-1]
+
+    if latest_jd is None:
+        raise SystemExit("No autocorrelations recorded in the history yet.")
+
+    t_plot = Time(latest_jd, format="jd")
+    t_plot.format = "iso"
+    t_plot.out_subfmt = "date_hm"
+
+    layout = {
+        "xaxis": {"title": "Frequency [MHz]"},
+        "yaxis": {"title": "Time [UTC]", "type": "date"},
+        "autosize": True,
+        "margin": {"l": 120, "b": 40, "r": 40, "t": 46},
+        "hovermode": "closest",
+    }
+    plotname = "plotly-waterfall"
+
+    caption = {}
+    caption["text"] = (
+        "Waterfalls (time versus frequency) of the autocorrelations "
+        "from the correlator (in dB) with equalization coefficients "
+        "divided out, covering the history kept by the autospectra page.\n "
+        "<br><br>Select an antpol from the list above the plot to show it."
+    )
+    caption["title"] = "Waterfall Help"
+
+    html_template = env.get_template("waterfall.html")
+    js_template = env.get_template("waterfall.js")
+
+    rendered_html = html_template.render(
+        plotname=plotname,
+        data_type="Auto correlations",
+        plotstyle="height: 100%",
+        div_height="height: 80%",
+        data_date_iso=t_plot.iso,
+        data_date_jd="{:.3f}".format(t_plot.jd),
+        data_date_unix_ms=t_plot.unix * 1000,
+        js_name="waterfall",
+        scriptname=os.path.basename(__file__),
+        hostname=computer_hostname,
+        caption=caption,
+    )
+
+    rendered_js = js_template.render(
+        antpols=antpol_names, layout=layout, plotname=plotname, data_dir=DATA_DIR
+    )
+
+    print("Got {n:d} waterfalls".format(n=len(antpol_names)))
+    with publish.publish("waterfall.html") as h_file:
+        h_file.write(rendered_html)
+    with publish.publish("waterfall.js") as js_file:
+        js_file.write(rendered_js)
+
+
+if __name__ == "__main__":
+    main()
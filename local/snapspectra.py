@@ -8,6 +8,7 @@
 from __future__ import absolute_import, division, print_function
 
 import os
+import json
 import sys
 import re
 import numpy as np
@@ -17,6 +18,13 @@ from astropy.time import Time
 import hera_corr_cm
 from jinja2 import Environment, FileSystemLoader
 
+# the payload encoding is shared with the generators
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'generator'))
+import antenna_index  # noqa
+import mc_cache  # noqa
+import plotly_data  # noqa
+
 
 def is_list(value):
     return isinstance(value, list)
@@ -50,6 +58,12 @@ def main():
                         help=('The host name for redis to connect to, defualts to "redishost"'))
     parser.add_argument('--port', dest='port', type=int, default=6379,
                         help='Redis port to connect.')
+    parser.add_argument('--decimate', dest='decimate', type=int, default=None,
+                        help=('Reduce each spectrum to a min/max envelope of about '
+                              'this many points. The full resolution spectra are '
+                              'written to snapspectra_full.json and loaded when '
+                              'the plot is zoomed.'))
+    mc_cache.add_cache_arguments(parser)
     args = parser.parse_args()
 
     try:
@@ -66,24 +80,10 @@ def main():
     with db.sessionmaker() as session:
         corr_cm = hera_corr_cm.HeraCorrCM(redishost=args.redishost)
         hsession = cm_sysutils.Handling(session)
-        stations = hsession.get_connected_stations(at_date='now')
-
-        antpos = np.genfromtxt(os.path.join(mc.data_path, "HERA_350.txt"),
-                               usecols=(0, 1, 2, 3),
-                               dtype={'names': ('ANTNAME', 'EAST', 'NORTH', 'UP'),
-                                      'formats': ('<U5', '<f8', '<f8', '<f8')},
-                               encoding=None)
-        antnames = antpos['ANTNAME']
-        inds = [int(j[2:]) for j in antnames]
-        inds = np.argsort(inds)
-
-        antnames = np.take(antnames, inds)
-
-        ants = []
-        for station in stations:
-            if station.antenna_number not in ants:
-                ants = np.append(ants, station.antenna_number)
-        ants = np.unique(ants).astype(int)
+        # names and connected stations, cached between runs
+        index = antenna_index.load_antenna_index(session, cache_dir=args.cache_dir)
+        antnames = index.names
+        ants = index.connected_numbers.astype(int)
 
         hostname_lookup = {}
 
@@ -244,8 +244,12 @@ def main():
         # Generate frequency axis
         freqs = np.linspace(0, 250e6, 1024)
         freqs /= 1e6
+        plot_freqs = freqs
+        if args.decimate:
+            plot_freqs, _ = plotly_data.minmax_decimate(freqs, freqs, args.decimate)
 
         data = []
+        full_data = []
         for host_cnt, host in enumerate(sorted(hostname_lookup.keys())):
             if host_cnt == 0:
                 visible = True
@@ -258,8 +262,14 @@ def main():
                 name = '{loc}:{mcname}'.format(loc=loc_num,
                                                mcname=mc_name.replace(":", ""))
                 try:
-                    _data = {"x": freqs.tolist(),
-                             "y": snapautos[host][loc_num].tolist(),
+                    spectrum = snapautos[host][loc_num]
+                    if args.decimate:
+                        full_data.append({"x": plotly_data.shared_ref("freqs"),
+                                          "y": plotly_data.encode_array(spectrum)})
+                        _, spectrum = plotly_data.minmax_decimate(freqs, spectrum,
+                                                                  args.decimate)
+                    _data = {"x": plotly_data.shared_ref("freqs"),
+                             "y": plotly_data.encode_array(spectrum),
                              "name": name,
                              "visible": visible,
                              "hovertemplate": "%{x:.1f}\tMHz<br>%{y:.3f}\t[dB]"
@@ -346,6 +356,8 @@ def main():
                                    }
                                   ]
                   }
+        plotly_data.use_webgl(data, layout,
+                              shared={"freqs": plotly_data.encode_array(plot_freqs)})
 
         caption = {}
         caption["title"] = "Snap Spectra Help"
@@ -389,9 +401,12 @@ def main():
                                              caption=caption
                                              )
         rendered_js = js_template.render(data=data,
+                                         shared={"freqs": plotly_data.encode_array(plot_freqs)},
                                          layout=layout,
                                          updatemenus=updatemenus,
-                                         plotname=plotname)
+                                         plotname=plotname,
+                                         full_res_url=('snapspectra_full.json'
+                                                       if args.decimate else None))
 
         with open('snapspectra.html', 'w') as h_file:
             h_file.write(rendered_html)
@@ -399,6 +414,11 @@ def main():
         with open('snapspectra.js', 'w') as js_file:
             js_file.write(rendered_js)
 
+        if args.decimate:
+            with open('snapspectra_full.json', 'w') as full_file:
+                json.dump({"shared": {"freqs": plotly_data.encode_array(freqs)},
+                           "data": full_data}, full_file)
+
 
 if __name__ == '__main__':
     main()
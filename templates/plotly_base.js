@@ -1,11 +1,171 @@
-var data = {{ data|tojson|wordwrap(break_long_words=False) }};
+{% include "plotly_decode.js" %}
 
+// the traces are decimated, swap in the full resolution data on first zoom
+var fullResLoaded = false;
+function loadFullResOnZoom(gd, loadFullRes) {
+  gd.on("plotly_relayout", function (eventdata) {
+    if (fullResLoaded || !("xaxis.range[0]" in eventdata)) {
+      return;
+    }
+    fullResLoaded = true;
+    loadFullRes().then(function (traces) {
+      if (traces === null) {
+        // the plotted traces changed in the meantime
+        fullResLoaded = false;
+        return;
+      }
+      Plotly.restyle(gd, {
+        x: traces.map(function (trace) { return trace.x; }),
+        y: traces.map(function (trace) { return trace.y; })
+      });
+    }).catch(function () {
+      fullResLoaded = false;
+    });
+  });
+}
 
 var layout = {{ layout|tojson }};
 
+{% if version_url is defined %}
+// the traces are published in shards (e.g. one per node) listed in a small
+// version stamp. The stamp is polled and only the shards of the dropdown
+// selection are downloaded, when selected or when they changed.
+var stamp = null;
+// index of the dropdown selection, 0 shows every shard, i shard i - 1
+var selected = null;
+// the urls of the plotted shards, joined
+var plotted = null;
+// decoded traces by versioned url
+var shardCache = {};
+
+function fetchShard(url) {
+  if (!(url in shardCache)) {
+    shardCache[url] = fetch(url).then(function (response) {
+      return response.json();
+    }).then(function (published) {
+      // the stamp may be copied to the server before the shard, try again
+      // at the next poll
+      if (url.split("?v=")[1] !== published.version) {
+        throw new Error("outdated shard " + url);
+      }
+      var payload = published.payload;
+      return decodePlotlyPayload(payload.data, decodePlotlyPayload(payload.shared, {}));
+    });
+    shardCache[url].catch(function () {
+      delete shardCache[url];
+    });
+  }
+  return shardCache[url];
+}
+
+function selectedUrls(key) {
+  var shards = selected === 0 ? stamp.shards : [stamp.shards[selected - 1]];
+  return shards.map(function (shard) { return shard[key]; });
+}
+
+function fetchTraces(urls) {
+  return Promise.all(urls.map(fetchShard)).then(function (shards) {
+    return [].concat.apply([], shards);
+  });
+}
+
+function plotSelected() {
+  var urls = selectedUrls("url");
+  var key = urls.join(" ");
+  if (key === plotted) {
+    return Promise.resolve();
+  }
+  return fetchTraces(urls).then(function (data) {
+    var gd = document.getElementById("{{ plotname }}");
+    var menus = stamp.updatemenus.map(function (menu) {
+      return Object.assign({}, menu, {active: selected});
+    });
+    var first = plotted === null;
+    plotted = key;
+    fullResLoaded = false;
+    if (!first) {
+      // keep the zoom of the current plot
+      return Plotly.react(gd, data, Object.assign({}, gd.layout, {updatemenus: menus}));
+    }
+    layout.updatemenus = menus;
+    return Plotly.newPlot(gd, data, layout, {responsive: true}).then(function (gd) {
+      gd.on("plotly_buttonclicked", function (event) {
+        selected = event.active;
+        plotSelected();
+      });
+      loadFullResOnZoom(gd, function () {
+        var fullUrls = selectedUrls("full_url");
+        if (fullUrls.indexOf(undefined) >= 0) {
+          return Promise.reject(new Error("no full resolution data"));
+        }
+        var shown = plotted;
+        return fetchTraces(fullUrls).then(function (traces) {
+          return shown === plotted ? traces : null;
+        });
+      });
+    });
+  });
+}
+
+function refreshData() {
+  return fetch("{{ version_url }}", {cache: "no-store"}).then(function (response) {
+    return response.json();
+  }).then(function (version) {
+    stamp = version;
+    // forget the shards replaced by newer versions
+    var current = {};
+    stamp.shards.forEach(function (shard) {
+      current[shard.url] = true;
+      current[shard.full_url] = true;
+    });
+    Object.keys(shardCache).forEach(function (url) {
+      if (!(url in current)) {
+        delete shardCache[url];
+      }
+    });
+    if (selected === null || selected > stamp.shards.length) {
+      // start with the first node, all of them are only loaded on request
+      selected = Math.min(1, stamp.shards.length);
+    }
+    document.getElementById("data_date").textContent = stamp.data_date_iso + " JD: " + stamp.data_date_jd;
+    if (typeof show_data_age === "function") {
+      show_data_age(stamp.data_date_unix_ms);
+    }
+    if (typeof load_report_age === "function") {
+      load_report_age();
+    }
+    return plotSelected();
+  }).catch(function () {});
+}
+refreshData();
+{% else %}
+{% if shared is defined %}
+var shared = decodePlotlyPayload({{ shared|tojson }}, {});
+{% else %}
+var shared = {};
+{% endif %}
+{% if streamed_data is defined %}
+var data = decodePlotlyPayload({{ streamed_data }}, shared);
+{% else %}
+var data = decodePlotlyPayload({{ data|tojson }}, shared);
+{% endif %}
+
 {% if updatemenus is defined %}
 var updatemenus = {{ updatemenus|tojson }};
 layout.updatemenus = updatemenus;
 {% endif %}
 
+{% if full_res_url %}
+Plotly.plot("{{ plotname }}", data, layout, {responsive: true}).then(function (gd) {
+  loadFullResOnZoom(gd, function () {
+    return fetch("{{ full_res_url }}").then(function (response) {
+      return response.json();
+    }).then(function (full) {
+      return decodePlotlyPayload(full.data, decodePlotlyPayload(full.shared, {}));
+    });
+  });
+});
+{% else %}
 Plotly.plot("{{ plotname }}", data, layout, {responsive: true});
+{% endif %}
+{% endif %}
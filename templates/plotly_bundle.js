@@ -0,0 +1,29 @@
+{% include "plotly_decode.js" %}
+
+// merge the keys a plot changes into a copy of the shared layout, null
+// values remove the key
+function mergeLayout(base, overrides) {
+  var merged = {};
+  Object.keys(base).forEach(function (key) {
+    var val = base[key];
+    merged[key] = (val !== null && typeof val === "object" && !Array.isArray(val)) ? mergeLayout(val, {}) : val;
+  });
+  Object.keys(overrides).forEach(function (key) {
+    var val = overrides[key];
+    if (val === null) {
+      delete merged[key];
+    } else if (typeof val === "object" && !Array.isArray(val) && typeof merged[key] === "object" && merged[key] !== null && !Array.isArray(merged[key])) {
+      merged[key] = mergeLayout(merged[key], val);
+    } else {
+      merged[key] = val;
+    }
+  });
+  return merged;
+}
+
+var layout = {{ layout|tojson }};
+var plots = {{ streamed_data }};
+
+plots.forEach(function (plot) {
+  Plotly.plot(plot.plotname, decodePlotlyPayload(plot.data, {}), mergeLayout(layout, plot.layout), {responsive: true});
+});
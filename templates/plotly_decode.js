@@ -0,0 +1,37 @@
+// decode the base64 typed arrays and shared references written by
+// generator/plotly_data.py back into javascript typed arrays
+function decodePlotlyPayload(obj, shared) {
+  if (Array.isArray(obj)) {
+    if (obj.length === 0 || typeof obj[0] !== "object") {
+      return obj;
+    }
+    return obj.map(function (item) { return decodePlotlyPayload(item, shared); });
+  }
+  if (obj === null || typeof obj !== "object") {
+    return obj;
+  }
+  if ("shared_ref" in obj) {
+    return shared[obj.shared_ref];
+  }
+  if ("bdata" in obj) {
+    var raw = atob(obj.bdata);
+    var bytes = new Uint8Array(raw.length);
+    for (var i = 0; i < raw.length; i++) {
+      bytes[i] = raw.charCodeAt(i);
+    }
+    if (obj.dtype === "i2") {
+      var quantized = new Int16Array(bytes.buffer);
+      var values = new Float32Array(quantized.length);
+      for (var j = 0; j < quantized.length; j++) {
+        values[j] = quantized[j] === -32768 ? NaN : quantized[j] * obj.scale + obj.offset;
+      }
+      return values;
+    }
+    return new Float32Array(bytes.buffer);
+  }
+  var out = {};
+  for (var key in obj) {
+    out[key] = decodePlotlyPayload(obj[key], shared);
+  }
+  return out;
+}
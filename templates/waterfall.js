@@ -0,0 +1,28 @@
+{% include "plotly_decode.js" %}
+
+var antpols = {{ antpols|tojson }};
+var layout = {{ layout|tojson }};
+var select = document.getElementById("{{ plotname }}-select");
+
+// each antpol is stored in its own file, only fetch the one being shown
+function showWaterfall(antpol) {
+  fetch("{{ data_dir }}/" + antpol + ".json").then(function (response) {
+    return response.json();
+  }).then(function (payload) {
+    var data = decodePlotlyPayload(payload.data, decodePlotlyPayload(payload.shared, {}));
+    layout.title = {text: "Autocorrelation waterfall of " + antpol};
+    Plotly.react("{{ plotname }}", data, layout, {responsive: true});
+  });
+}
+
+antpols.forEach(function (antpol) {
+  var option = document.createElement("option");
+  option.text = antpol;
+  select.add(option);
+});
+select.onchange = function () {
+  showWaterfall(select.value);
+};
+if (antpols.length > 0) {
+  showWaterfall(antpols[0]);
+}